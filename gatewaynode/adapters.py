@@ -0,0 +1,156 @@
+import threading
+import time
+
+from scanner import ScannerThread
+
+
+class AdapterManager:
+    """Spreads scanning and connections over several BLE adapters (HCI
+    interfaces). If scan_iface is given that adapter only scans and the others
+    only connect, otherwise every adapter scans and connects. Each connection
+    goes to the working adapter with the fewest connections, and between
+    those to the one that hears the node best. An adapter is taken out for
+    retry_after seconds after failing to connect to failures_to_drop
+    different nodes in a row, and a failed scan moves to another adapter.
+    A node that failed to connect on an adapter tries the others first.
+    """
+
+    def __init__(self, exit_event, thread_output, watch, backend, ifaces=(0,), scan_iface=None,
+                 max_connections=3, failures_to_drop=3, retry_after=60):
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._watch = watch
+        self._backend = backend
+        self._ifaces = list(ifaces)
+        self._scan_iface = scan_iface
+        self._max_connections = max_connections
+        self._failures_to_drop = failures_to_drop
+        self._retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._connections = {i: set() for i in self._connect_ifaces()}  # iface -> addrs
+        self._failures = {i: set() for i in self._ifaces}  # nodes failed in a row
+        self._down = {}  # iface -> time it can be tried again
+        self._rssi = {}  # (iface, addr) -> last rssi
+        self._failed_at = {}  # (iface, addr) -> time of the last failed connect
+
+        # Shared by the scanners of every adapter
+        self.advertisement = threading.Event()
+        self.enabled = threading.Event()
+        self.enabled.set()
+        self._scanners = [self._scanner(i) for i in
+                          ([scan_iface] if scan_iface is not None else self._ifaces)]
+
+    def _connect_ifaces(self):
+        others = [i for i in self._ifaces if i != self._scan_iface]
+        return others or list(self._ifaces)
+
+    def _scanner(self, iface):
+        return ScannerThread(self._exit_event, self._thread_output, self._watch,
+                             backend=self._backend, iface=iface, advertisement=self.advertisement,
+                             enabled=self.enabled, on_seen=self._seen)
+
+    @property
+    def capacity(self):
+        """Maximum number of simultaneous connections over all the adapters"""
+        return self._max_connections * len(self._connections)
+
+    def start(self):
+        for scanner in self._scanners:
+            scanner.start()
+
+    def join(self):
+        for scanner in self._scanners:
+            scanner.join()
+
+    def session_ended(self, addr, t):
+        """Tells the scanners that a session with a node ended at time t"""
+        for scanner in self._scanners:
+            scanner.session_ended(addr, t)
+
+    def _seen(self, iface, addr, rssi):
+        self._rssi[(iface, addr)] = rssi
+
+    def present(self):
+        """Presence index of all the scanners, see ScannerThread.present"""
+        present = {}
+        for scanner in self._scanners:
+            for addr, d in scanner.present().items():
+                if addr not in present:
+                    present[addr] = d
+                else:
+                    # Latest time seen, best rssi and earliest first seen
+                    p = present[addr]
+                    present[addr] = (max(p[0], d[0]), max(p[1], d[1]), min(p[2], d[2]))
+        return present
+
+    def failed(self):
+        """Checks the scanners. Returns True if no adapter can scan."""
+        for scanner in [s for s in self._scanners if s.failed.is_set()]:
+            self._scanners.remove(scanner)
+            self._mark_down(scanner.iface)
+        if self._scanners:
+            return False
+        # Scan on another adapter that is working
+        for iface in self._ifaces:
+            if not self.is_down(iface):
+                self._thread_output.put("Scanning moved to hci{}".format(iface))
+                scanner = self._scanner(iface)
+                self._scanners.append(scanner)
+                scanner.start()
+                return False
+        return True
+
+    def assign(self, addr):
+        """Picks the adapter for a new connection to a node and counts the
+        connection on it. Returns None if all the adapters are full or down.
+        """
+        with self._lock:
+            best = None
+            for iface, addrs in self._connections.items():
+                if self._is_down(iface) or len(addrs) >= self._max_connections:
+                    continue
+                failed = time.time() - self._failed_at.get((iface, addr), 0) < self._retry_after
+                score = (failed, len(addrs), -self._rssi.get((iface, addr), -100))
+                if best is None or score < best[0]:
+                    best = (score, iface)
+            if best is None:
+                return None
+            self._connections[best[1]].add(addr)
+            return best[1]
+
+    def release(self, addr, iface):
+        """Called when a connection assigned to an adapter is closed"""
+        with self._lock:
+            self._connections.get(iface, set()).discard(addr)
+
+    def connected(self, iface, addr):
+        with self._lock:
+            self._failures[iface].clear()
+            self._failed_at.pop((iface, addr), None)
+
+    def connect_failed(self, iface, addr):
+        """Counts a failed connection. Returns True if the adapter was taken out."""
+        with self._lock:
+            self._failures[iface].add(addr)
+            self._failed_at[(iface, addr)] = time.time()
+            if len(self._failures[iface]) < self._failures_to_drop:
+                return False
+        self._mark_down(iface)
+        return True
+
+    def is_down(self, iface):
+        with self._lock:
+            return self._is_down(iface)
+
+    def _mark_down(self, iface):
+        self._thread_output.put(
+            "Adapter hci{} is not working, retrying in {}s".format(iface, self._retry_after))
+        with self._lock:
+            self._down[iface] = time.time() + self._retry_after
+            self._failures[iface].clear()
+
+    def _is_down(self, iface):
+        if iface in self._down and time.time() >= self._down[iface]:
+            del self._down[iface]
+        return iface in self._down
@@ -0,0 +1,291 @@
+"""End-to-end benchmark of the gateway without radios. Runs the gateway in
+headless mode with simulated s1 and a1 nodes (see simulator.py) and scripted
+users connected over loopback, then reports the sensor -> user and user ->
+actuator latencies, the throughput and the memory used.
+
+    python3 bench.py --sensors 20 --actuators 4 --users 5 --duration 60
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import secrets
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import codec
+from blebackend import SimulatedBackend
+from framing import FrameDecoder, encode_frame
+from headless import setup_logging
+from metrics import METRICS
+from node import Node
+from registry import PeripheralRegistry
+from simulator import SimulatedA1, SimulatedS1
+
+_values = itertools.count(1)  # unique values set on the actuators
+
+
+class BenchUser(threading.Thread):
+    """Scripted user. Records the delay of every sensor reading it receives
+    and sends set-value commands to the actuators at command_rate per second.
+    """
+
+    def __init__(self, port, key, binary, sensors, actuators, command_rate, stop_event):
+        threading.Thread.__init__(self)
+        self._port = port
+        self._aesgcm = AESGCM(key)
+        self._binary = binary
+        self._sensors = sensors
+        self._actuators = actuators
+        self._command_rate = command_rate
+        self._stop_event = stop_event
+        self._nodes = []
+        self.sensor_latency = []
+        self.commands = []  # [(node id, value, time sent)]
+        self.updates = 0
+        self.received_bytes = 0
+        self.error = None
+
+    def send(self, sock, message):
+        nonce = os.urandom(12)
+        data = json.dumps(message).encode('utf-8')
+        sock.sendall(encode_frame(nonce + self._aesgcm.encrypt(nonce, data, None)))
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as e:
+            self.error = e.__class__.__name__
+
+    def _run(self):
+        deadline = time.time() + 10
+        while True:
+            try:
+                sock = socket.create_connection(("127.0.0.1", self._port))
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        sock.settimeout(0.05)
+        self.send(sock, ["hello", {"encoding": "binary"} if self._binary else {}])
+        decoder = FrameDecoder()
+        next_command = time.time()
+        while not self._stop_event.is_set():
+            if self._command_rate and self._actuators and time.time() >= next_command:
+                next_command += 1 / self._command_rate
+                node_id = secrets.choice(list(self._actuators))
+                value = str(next(_values))
+                self.commands.append((node_id, value, time.time()))
+                self.send(sock, ["set-value", node_id, 0, value])
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionError("Gateway closed the connection")
+            now = time.time()
+            self.received_bytes += len(data)
+            for frame in decoder.feed(data):
+                for update in self._updates(self._aesgcm.decrypt(frame[:12], frame[12:], None)):
+                    self._received(update, now)
+        sock.close()
+
+    def _updates(self, payload):
+        """Node updates in a frame, as [id, field, values]"""
+        if self._binary:
+            if payload[0] == codec.FRAME_UPDATES:
+                return codec.unpack_updates(payload, self._nodes)
+            if payload[0] == codec.FRAME_JSON_COMPRESSED:
+                payload = zlib.decompress(payload[1:])
+            else:
+                payload = payload[1:]
+        message = json.loads(payload.decode('utf-8'))
+        if isinstance(message, list) and message and message[0] == "intern":
+            self._nodes = message[1]["nodes"]
+            return []
+        if isinstance(message, list) and len(message) == 3:
+            return [message]
+        return []  # gateway data or options
+
+    def _received(self, update, now):
+        self.updates += 1
+        sensor = self._sensors.get(update[0])
+        if sensor is None or update[1] != "output-values":
+            return
+        try:
+            produced = sensor.produced.get(int(float(update[2][3])))
+        except (IndexError, ValueError):
+            return
+        if produced is not None:
+            self.sensor_latency.append(now - produced)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    result = {"n": len(samples), "max": samples[-1]}
+    for p in (50, 90, 99):
+        result["p{}".format(p)] = samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+    return result
+
+
+def _rss():
+    """Current and peak resident memory in KiB"""
+    with open("/proc/self/statm") as f:
+        current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    return current, max(current, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def run(args):
+    """Runs one benchmark and returns the results as a dict"""
+    work_dir = tempfile.mkdtemp(prefix="gateway-bench-")
+    backend = SimulatedBackend(range(args.adapters), args.connect_time)
+    faults = {"latency": args.latency, "failure_rate": args.failure_rate,
+              "corrupt_rate": args.corrupt_rate}
+    peripherals, sensors, actuators = [], {}, {}
+    for i in range(args.sensors + args.actuators):
+        node_id, addr, key = str(i + 1), "02:00:00:00:{:02x}:{:02x}".format(i >> 8, i & 0xff), secrets.token_hex(8)
+        if i < args.sensors:
+            device = sensors[node_id] = SimulatedS1(
+                addr, key.encode(), args.sleep, args.awake_timeout, args.sleep / 10, **faults)
+            peripherals.append({"addr": addr, "id": node_id, "type": "s1", "key": key})
+        else:
+            device = actuators[node_id] = SimulatedA1(addr, key.encode(), **faults)
+            peripherals.append({"addr": addr, "id": node_id, "type": "a1", "key": key})
+        backend.add_device(device)
+    with open(os.path.join(work_dir, "peripherals.json"), "w") as f:
+        json.dump(peripherals, f)
+    with open(os.path.join(work_dir, "rules.json"), "w") as f:
+        json.dump([], f)
+
+    class BenchNode(Node):
+        _PERIPHERALS_FILE = os.path.join(work_dir, "peripherals.json")
+        _registry = PeripheralRegistry(_PERIPHERALS_FILE)
+        _RULES_FILE = os.path.join(work_dir, "rules.json")
+        _HANDLE_CACHE_FILE = os.path.join(work_dir, "gatt_handles.json")
+        _TELEMETRY_DB = os.path.join(work_dir, "telemetry.db")
+        _CONTROL_SOCKET = os.path.join(work_dir, "control.sock")
+        _BLE_BACKEND = backend
+        _BLE_ADAPTERS = list(range(args.adapters))
+        _BLE_MAX_CONNECTIONS = args.max_connections
+        _SERVER_PORT = _free_port()
+        _USER_PORT = _free_port()
+        _METRICS_PORT = _free_port()
+
+    node = BenchNode()
+    # The gateway expects the default sleep time until it has written this one
+    for node_id in sensors:
+        node._command_input("{};0;{:g}".format(node_id, args.sleep))
+    listener = setup_logging(os.path.join(work_dir, "gateway.log"))
+    gateway = threading.Thread(target=node._main_headless)
+    gateway.start()
+
+    stop_event = threading.Event()
+    users = [BenchUser(node._USER_PORT, node._session_keys.issue(), args.binary, sensors,
+                       actuators, args.command_rate, stop_event) for _ in range(args.users)]
+    for user in users:
+        user.start()
+    start = time.time()
+    time.sleep(args.duration)
+    stop_event.set()
+    for user in users:
+        user.join()
+    elapsed = time.time() - start
+    memory = _rss()
+    metrics = METRICS.summary()
+    node._command_quit()
+    gateway.join()
+    listener.stop()
+
+    # Commands are coalesced by the gateway when a newer value for the same
+    # input arrives first, so only the applied ones have a latency
+    commands = [c for user in users for c in user.commands]
+    command_latency = [actuators[node_id].applied[value] - sent for node_id, value, sent in commands
+                       if value in actuators[node_id].applied]
+    readings = sum(len(s.produced) for s in sensors.values())
+    updates = sum(user.updates for user in users)
+    return {
+        "duration": elapsed,
+        "sensor_to_user": _percentiles([t for user in users for t in user.sensor_latency]),
+        "user_to_actuator": _percentiles(command_latency),
+        "readings_per_second": readings / elapsed,
+        "updates_per_second": updates / elapsed,
+        "received_bytes_per_second": sum(user.received_bytes for user in users) / elapsed,
+        "commands_sent": len(commands),
+        "commands_applied": len(command_latency),
+        "sensor_wakes": sum(s.wakes for s in sensors.values()),
+        "rss_kib": memory[0],
+        "max_rss_kib": memory[1],
+        "user_errors": [user.error for user in users if user.error],
+        "metrics": metrics if args.metrics else [],
+        "work_dir": work_dir,
+    }
+
+
+def _report(results):
+    def latency(name, p):
+        if p is None:
+            return "{:<18} no samples".format(name)
+        return "{:<18} n={:<6} p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms max={:.1f}ms".format(
+            name, p["n"], p["p50"] * 1000, p["p90"] * 1000, p["p99"] * 1000, p["max"] * 1000)
+    print("Duration           {:.1f}s".format(results["duration"]))
+    print(latency("Sensor -> user", results["sensor_to_user"]))
+    print(latency("User -> actuator", results["user_to_actuator"]))
+    print("Readings           {:.1f}/s ({} sensor wakes)".format(
+        results["readings_per_second"], results["sensor_wakes"]))
+    print("Updates to users   {:.1f}/s, {:.0f} bytes/s".format(
+        results["updates_per_second"], results["received_bytes_per_second"]))
+    print("Commands           {} sent, {} applied".format(
+        results["commands_sent"], results["commands_applied"]))
+    print("Memory             {} KiB ({} KiB peak)".format(
+        results["rss_kib"], results["max_rss_kib"]))
+    for error in results["user_errors"]:
+        print("User error         " + error)
+    for line in results["metrics"]:
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gateway benchmark with simulated nodes and users")
+    parser.add_argument("--sensors", type=int, default=10, help="number of s1 nodes")
+    parser.add_argument("--actuators", type=int, default=2, help="number of a1 nodes")
+    parser.add_argument("--users", type=int, default=2, help="number of TCP users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--sleep", type=float, default=10, help="deep sleep time of the s1 nodes")
+    parser.add_argument("--awake-timeout", type=float, default=10,
+                        help="seconds an s1 node advertises before sleeping again")
+    parser.add_argument("--command-rate", type=float, default=1,
+                        help="set-value commands per second and per user")
+    parser.add_argument("--binary", action="store_true", help="users negotiate the binary encoding")
+    parser.add_argument("--adapters", type=int, default=1, help="simulated BLE adapters")
+    parser.add_argument("--max-connections", type=int, default=3)
+    parser.add_argument("--connect-time", type=float, default=0.05,
+                        help="seconds taken by a simulated connection")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every simulated BLE operation")
+    parser.add_argument("--failure-rate", type=float, default=0,
+                        help="probability of a simulated BLE operation failing")
+    parser.add_argument("--corrupt-rate", type=float, default=0,
+                        help="probability of a node value failing to decrypt")
+    parser.add_argument("--metrics", action="store_true", help="also print the gateway metrics")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _report(results)
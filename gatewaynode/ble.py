@@ -1,233 +1,539 @@
 import threading
 import time
-import os
-from bluepy import btle
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from adapters import AdapterManager
+from blebackend import BluepyBackend
+from connpool import ConnectionPool
+from gattcache import HandleCache
+from metrics import METRICS
+from outbox import Outbox
+from scheduler import WakeScheduler
+from securechannel import SecureChannel
+
+_SESSION_TIME = METRICS.histogram(
+    "ble_session_seconds", "Duration of the sessions with nodes")
+_ADVERTISEMENT_DELAY = METRICS.histogram(
+    "ble_advertisement_delay_seconds", "Time from the first advertisement of a sleeping node to its session")
+_COMMAND_LATENCY = METRICS.histogram(
+    "command_latency_seconds", "Time from a set-value from the user to the value being applied")
+_DECRYPT_FAILURES = METRICS.counter(
+    "ble_decrypt_failures_total", "Values read from nodes that could not be decrypted")
+_READ_BACK_FAILURES = METRICS.counter(
+    "ble_read_back_failures_total", "Values written to nodes that could not be read back")
+_CONNECT_FAILURES = METRICS.counter(
+    "ble_connect_failures_total", "Failed connections to nodes")
 
 
 class BleThread(threading.Thread):
-    """Thread used to handle all communication with BLE local nodes"""
+    """Thread used to handle all communication with BLE local nodes. The nodes
+    come from the peripheral registry and are handled according to the
+    driver of their type.
+    """
 
-    def __init__(self, exit_event, thread_output, PERIPHERALS, data_to_peripherals, data_from_peripherals):
+    # Maximum seconds to connect to a node (capped by the session timeout)
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, exit_event, thread_output, registry, data_to_peripherals, data_from_peripherals,
+                 max_connections=3, session_timeout=20, handle_cache_file="gatt_handles.json",
+                 pool_size=4, pool_idle_timeout=300, keepalive_interval=30,
+                 priority_to_peripherals=None, latency_target=0.5,
+                 backend=None, ifaces=(0,), scan_iface=None):
         threading.Thread.__init__(self)
         self._exit_event = exit_event
         self._thread_output = thread_output
-        self._PERIPHERALS = PERIPHERALS
+        self._registry = registry
         self._data_to_peripherals = data_to_peripherals
         self._data_from_peripherals = data_from_peripherals
+        # Data from the user, handled ahead of the routine sessions. Items are
+        # [id, index, value, time received]
+        self._priority_to_peripherals = priority_to_peripherals
+        self._latency_target = latency_target
+
+        # BLE stack used (bluepy unless another backend is given) and the
+        # adapters it runs on. The background passive scanners keep a presence
+        # index of nearby devices
+        self._backend = BluepyBackend() if backend is None else backend
+        self._adapters = AdapterManager(exit_event, thread_output, registry, self._backend,
+                                        ifaces, scan_iface, max_connections)
+        self._iface_of = {}  # addr -> adapter of the open connection
+        self._peripherals = {}  # addr -> open connection
+        self._peripherals_lock = threading.Lock()
+        # Latest value to be sent for each (node id, input index)
+        self._outbox = Outbox()
+        # Expected wake times of the nodes that sleep between sessions. The
+        # scanner only runs when one of them may be advertising
+        self._scheduler = WakeScheduler()
 
-        self._scanner = btle.Scanner().withDelegate(btle.DefaultDelegate())
-        self._data_to_be_sent = []
+        # Sessions with nodes run in parallel on a bounded pool of workers.
+        # max_connections caps the number of simultaneous connections on each
+        # adapter and session_timeout is the deadline for each session
+        self._session_timeout = session_timeout
+        self._busy = set()  # addresses of nodes with a running session
+        self._busy_lock = threading.Lock()
+        self._session_ended = {}  # addr -> time the last session ended
+
+        # Characteristic handles discovered in earlier connections
+        self._handle_cache = HandleCache(handle_cache_file)
+        # Secure channel of each node, kept across sessions so the nonces
+        # of the values written keep counting up
+        self._channels = {}  # addr -> SecureChannel
+        self._channels_lock = threading.Lock()
+
+        # Connections held open to always-on nodes
+        self._pool = ConnectionPool(
+            self._connect, pool_size, pool_idle_timeout, keepalive_interval, self._disconnect)
+
+        self.iterations = 0  # loops of run, to tell that the thread is not stuck
 
     def run(self):
         self._thread_output.put("Starting...")
+        self._adapters.start()
+        self._thread_output.put("Scanning...")
+        data_lane = threading.Thread(target=self._data_lane)
+        data_lane.start()
+        if self._priority_to_peripherals is not None:
+            priority_lane = threading.Thread(target=self._priority_lane)
+            priority_lane.start()
+        executor = ThreadPoolExecutor(max_workers=self._adapters.capacity)
+        sessions = {}  # future -> [peripheral, start time, timeout reported]
         while(True):
             if(self._exit_event.is_set()):
                 break
-            # Check if there is any new data to be sent to local nodes
-            # and store it in an instance attribute
-            while self._data_to_peripherals.qsize() != 0:
-                data = self._data_to_peripherals.get()
+            self.iterations += 1
+
+            # Wait for an advertisement from a known node (or for new data to
+            # be sent, see _data_lane) and get the addresses currently in the
+            # presence index
+            self._adapters.advertisement.wait(1)
+            self._adapters.advertisement.clear()
+            if(self._adapters.failed()):
+                break
+            present = self._adapters.present()
+
+            # Start one session per known node that has advertised since its
+            # last session ended. Nodes that still have a session running
+            # (e.g. a hung connect) are skipped
+            # Nodes with a pooled connection do not advertise and are always ready
+            # Sleeping nodes are served earliest deadline first : the one that
+            # woke first goes back to sleep first
+            ready = []
+            for addr in set(present) | set(self._pool.addresses()):
+                p = self._registry.by_addr(addr)
+                if p is None:
+                    continue
+                # A pooled node is usually not advertising, and its connection
+                # can be dropped by a session meanwhile
+                seen = present.get(addr)
+                if not self._pool.is_connected(addr):
+                    if seen is None or seen[0] <= self._session_ended.get(addr, 0):
+                        continue
+                if p["driver"].always_on:
+                    # Always-on nodes are only connected to when there is data for them
+                    if not self._outbox.has_pending(p["id"]):
+                        continue
+                    ready.append((0, p, self._always_on_session))
+                elif seen is not None:
+                    ready.append((seen[2], p, self._sensor_session))
+            for woke, p, session in sorted(ready, key=lambda r: r[0]):
+                if not self._claim(p["addr"]):
+                    continue
+                if not p["driver"].always_on:
+                    self._scheduler.woke(p["addr"], woke)
+                    _ADVERTISEMENT_DELAY.observe(time.time() - woke)
+                future = executor.submit(self._run_session, session, p)
+                sessions[future] = [p, time.time(), False]
+            self._gate_scanner()
+
+            # Keep pooled connections alive and close the idle ones, claiming
+            # each node so no session uses the connection meanwhile
+            for addr in self._pool.maintain(self._keepalive, self._claim, self._release):
+                p = self._registry.by_addr(addr)
                 self._thread_output.put(
-                    "Data to be sent : {}".format(str(data)))
-                self._data_to_be_sent.append(data)
+                    "Closed connection to node {}".format(p["id"] if p else addr))
+
+            # Sessions run in the background so that advertisements from other
+            # nodes are handled right away. The connection of a session past its
+            # deadline is closed, so that the session fails and frees its worker
+            for future in [f for f in sessions if f.done()]:
+                del sessions[future]
+            for info in sessions.values():
+                if not info[2] and time.time() - info[1] > self._session_timeout:
+                    self._thread_output.put(
+                        "Session with node {} timed out".format(info[0]["id"]))
+                    info[2] = True
+                    self._abort_session(info[0])
 
-            # Scan for nearbly BLE Servers and get their addresses
-            self._thread_output.put("Scanning...")
+        executor.shutdown(wait=False)
+        data_lane.join()
+        if self._priority_to_peripherals is not None:
+            priority_lane.join()
+        self._pool.close_all()
+        self._adapters.join()
+        self._thread_output.put("Exiting")
+
+    def _run_session(self, session, p):
+        """Runs one session with a node. Errors are contained so that they do not
+        affect the sessions with other nodes.
+        """
+        try:
+            with _SESSION_TIME.time():
+                session(p)
+        except Exception as e:
+            self._thread_output.put(
+                "Session with node {} failed : {}".format(p["id"], type(e).__name__))
+        finally:
+            ended = self._session_ended[p["addr"]] = time.time()
+            if not p["driver"].always_on:
+                self._scheduler.session_ended(p["addr"], ended)
+                self._adapters.session_ended(p["addr"], ended)
+            self._release(p["addr"])
+            # Data that came in during the session is sent right away
+            if p["driver"].always_on and self._outbox.has_pending(p["id"]):
+                self._adapters.advertisement.set()
+
+    def _gate_scanner(self):
+        """Runs the scanner only while a sleeping node may be advertising or an
+        always-on node with pending data has to be found
+        """
+        sleeping, waiting = [], False
+        for p in self._registry:
+            if not p["driver"].always_on:
+                sleeping.append(p["addr"])
+            elif self._outbox.has_pending(p["id"]) and not self._pool.is_connected(p["addr"]):
+                waiting = True
+        if waiting or self._scheduler.scan_needed(sleeping):
+            if not self._adapters.enabled.is_set():
+                self._thread_output.put("Scanning resumed")
+                self._adapters.enabled.set()
+        elif self._adapters.enabled.is_set():
+            self._adapters.enabled.clear()
+            next_wake = self._scheduler.next_wake(sleeping)
+            self._thread_output.put("Scanning paused" if next_wake is None else
+                                    "Scanning paused, next wake expected in {:.0f}s".format(next_wake - time.time()))
+
+    def registry_changed(self):
+        """Called after the registry was reloaded. The thread reads the registry
+        directly, so there is nothing to do.
+        """
+
+    def set_sleep_times(self, gateway_data):
+        """Gives the scheduler the sleep time configured on each sleeping node"""
+        for p in self._registry:
+            index = p["driver"].sleep_input
+            node = gateway_data["nodes"].get(p["id"])
+            if index is None or node is None:
+                continue
             try:
-                devices = self._scanner.scan(1)
-            except btle.BTLEManagementError:
-                self._thread_output.put(
-                    "Insufficient permissions to scan for BLE devices.")
-                return
-            devices_addr = [d.addr for d in devices]
-
-            # Check if known peripherals are present in the address list
-            for p in self._PERIPHERALS:
-                if p["addr"] in devices_addr:
-                    # Perform different actions based on the type of local node
-                    if p["type"] == "s1":
-                        # Sensor node 1 - gives sensor readings and enters deep sleep after connection ends
-                        # The deep sleep time can be set using a characteristic
-
-                        self._thread_output.put(
-                            "Connecting to sensor {}".format(p["id"]))
+                self._scheduler.set_sleep_time(
+                    p["addr"], float(node["input-values"][index]))
+            except (ValueError, IndexError):
+                pass
+
+    def _claim(self, addr):
+        """Marks a node as having a running session. Returns False if it already has one"""
+        with self._busy_lock:
+            if addr in self._busy:
+                return False
+            self._busy.add(addr)
+            return True
+
+    def _release(self, addr):
+        with self._busy_lock:
+            self._busy.discard(addr)
+
+    def _data_lane(self):
+        """Stores new data to be sent to local nodes (e.g. from the rules) in
+        the outbox as soon as it arrives, replacing older values, and wakes
+        the main loop so that always-on nodes get it without waiting for an
+        advertisement
+        """
+        while not self._exit_event.is_set():
+            try:
+                data = self._data_to_peripherals.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._thread_output.put(
+                "Data to be sent : {}".format(str(data)))
+            self._outbox.put(data[0], data[1], data[2])
+            self._adapters.advertisement.set()
+
+    def _priority_lane(self):
+        """Stores data from the user in the outbox as soon as it arrives and
+        wakes the main loop, which starts a session with the node ahead of the
+        others. The session runs on the pool of workers with the same deadline
+        as the others, so a node that hangs does not hold back the rest.
+        Data for sleeping nodes is sent when they next wake up.
+        """
+        while not self._exit_event.is_set():
+            try:
+                data = self._priority_to_peripherals.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._thread_output.put(
+                "Priority data to be sent : {}".format(str(data[:3])))
+            self._outbox.put(data[0], data[1], data[2], True, data[3])
+            self._adapters.advertisement.set()
+
+    def _sensor_session(self, p):
+        # Reads the outputs of the node, sends it the pending data and
+        # disconnects (the node may then enter deep sleep)
+        driver = p["driver"]
+        try:
+            peripheral = self._connect(p)
+        except:
+            self._thread_output.put("Failed to connect")
+            return
+        try:
+            channel = self._channel(p)
+
+            # Try to read data from the node (max 5 tries)
+            for _ in range(5 if driver.outputs else 0):
+                data = ""
+                valid = 0
+                try:
+                    handles = self._get_handles(
+                        peripheral, p, [o[0] for o in driver.outputs])
+                    self._thread_output.put("Reading data...")
+                    for uuid, name in driver.outputs:
+                        raw = self._read(peripheral, p, handles[uuid])
                         try:
-                            peripheral = btle.Peripheral(p["addr"])
-                            peripheral.setMTU(100)
-                            svc = peripheral.getServiceByUUID(
-                                "86df3990-4bdf-442e-8eb7-04bbd173e4a7")
-                            temp_char = svc.getCharacteristics(
-                                "1c70ab2e-c645-4853-b46a-fd4cd0b7f538")[0]
-                            light_char = svc.getCharacteristics(
-                                "2a47596d-8402-4359-952a-a956c84b0f41")[0]
-                            sleep_char = svc.getCharacteristics(
-                                "cac889a0-4436-489b-ba6c-0e4f9b2d47ca")[0]
-                            aesgcm = AESGCM(p["key"])
-
-                            # Try to read data from the node (max 5 tries)
-                            for _ in range(5):
-                                data = ""
-                                temp_valid, light_valid = False, False
-                                try:
-                                    self._thread_output.put("Reading data...")
-
-                                    temperature = temp_char.read()
-                                    try:
-                                        message = aesgcm.decrypt(
-                                            temperature[:12], temperature[12:], None).split(b'\x00')[0].decode()
-                                        self._thread_output.put(
-                                            "Valid temperature data received")
-                                        data = data + message
-                                        temp_valid = True
-                                    except:
-                                        self._thread_output.put(
-                                            "Invalid temperature data received")
-
-                                    light = light_char.read()
-                                    try:
-                                        message = aesgcm.decrypt(light[:12], light[12:], None).split(b'\x00')[
-                                            0].decode()
-                                        self._thread_output.put(
-                                            "Valid light data received")
-                                        data = data + message
-                                        light_valid = True
-                                    except:
-                                        self._thread_output.put(
-                                            "Invalid light data received")
-                                    if(light_valid and temp_valid):
-                                        self._data_from_peripherals.put(
-                                            {"id": p["id"], "field": "output-values", "time": time.time(), "data": data})
-                                    break
-                                except:
-                                    self._thread_output.put(
-                                        "Failed to read data")
-
-                            # If there is any data to be sent to this node, encrypt it and send it
-                            for d in self._data_to_be_sent:
-                                if(d[0] == p["id"]):
-                                    if(d[1] == 0):
-                                        try:
-                                            self._thread_output.put(
-                                                "Setting deep sleep time of node {} to {}".format(d[0], d[2]))
-                                            nonce = os.urandom(12)
-                                            data = d[2] + ";"
-                                            data = data.ljust(
-                                                16, ';').encode('utf-8')
-                                            ct = aesgcm.encrypt(
-                                                nonce, data, None)
-                                            sleep_char.write(nonce+ct)
-                                            self._data_to_be_sent.remove(d)
-
-                                        except:
-                                            self._thread_output.put(
-                                                "Error sending data")
-
-                                        # Reading the value again to get the actual value stored in the node
-                                        time.sleep(0.1)
-                                        try:
-                                            sleepCharRead = sleep_char.read()
-                                            message = aesgcm.decrypt(sleepCharRead[:12], sleepCharRead[12:], None).split(b'\x00')[
-                                                0].decode()
-                                            self._thread_output.put("Valid sleep time data read")
-                                            sleepVal = message.split(';')[0]
-                                            self._data_from_peripherals.put(
-                                                {"id": p["id"], "field": "input-values", "time": time.time(), 
-                                                "index": 0, "data": sleepVal})
-                                        except:
-                                            self._thread_output.put("Invalid sleep time data read")
-                                    else:
-                                        self._thread_output.put(
-                                            "Invalid index - not sending data")
+                            data = data + driver.decode(channel, raw)
                             self._thread_output.put(
-                                "Disconnecting from sensor {}".format(p["id"]))
-                            peripheral.disconnect()
-
+                                "Valid {} data received".format(name))
+                            valid += 1
                         except:
-                            self._thread_output.put("Failed to connect")
-                    
-                    if p["type"] == "a1":
-                        # Actuator node 1 - has one input char, stays awake
-                        connect = False
-                        for d in self._data_to_be_sent:
-                            if(d[0] == p["id"]):
-                                connect = True
-                                break
-                        if connect:
+                            _DECRYPT_FAILURES.inc()
                             self._thread_output.put(
-                                "Connecting to sensor {}".format(p["id"]))
-                            try:
-                                peripheral = btle.Peripheral(p["addr"])
-                                peripheral.setMTU(100)
-                                svc = peripheral.getServiceByUUID(
-                                    "86df3990-4bdf-442e-8eb7-04bbd173e4a7")
-                                led_char = svc.getCharacteristics(
-                                    "8a7a1f1d-3cc0-4fe7-ab8a-d75fbcfb1a7b")[0]
-                                aesgcm = AESGCM(p["key"])
-
-                                # Send all data that is queued up for this node
-                                for d in self._data_to_be_sent:
-                                    if(d[0] == p["id"]):
-                                        if(d[1] == 0):
-                                            try:
-                                                self._thread_output.put(
-                                                    "Setting led value time of node {} to {}".format(d[0], d[2]))
-                                                nonce = os.urandom(12)
-                                                data = d[2] + ";"
-                                                data = data.ljust(
-                                                    16, ';').encode('utf-8')
-                                                ct = aesgcm.encrypt(
-                                                    nonce, data, None)
-                                                led_char.write(nonce+ct)
-                                                self._data_to_be_sent.remove(d)
-                                                
-                                            except:
-                                                self._thread_output.put(
-                                                    "Error sending data")
-
-                                            # Reading the value again to get the actual value stored in the node
-                                            time.sleep(0.1)
-                                            try:
-                                                ledCharRead = led_char.read()
-                                                message = aesgcm.decrypt(ledCharRead[:12], ledCharRead[12:], None).split(b'\x00')[
-                                                    0].decode()
-                                                self._thread_output.put(
-                                                    "Valid led value data read")
-                                                ledVal = message.split(';')[0]
-                                                self._data_from_peripherals.put(
-                                                    {"id": p["id"], "field": "input-values", "time": time.time(), 
-                                                    "index": 0, "data": ledVal})
-                                            except:
-                                                self._thread_output.put("Invalid led data read")
-                                        else:
-                                            self._thread_output.put(
-                                                "Invalid index - not sending data")
-                                self._thread_output.put(
-                                    "Disconnecting from sensor {}".format(p["id"]))
-                                peripheral.disconnect()
-
-                            except:
-                                self._thread_output.put("Failed to connect")
-                    
+                                "Invalid {} data received".format(name))
+                    if(valid == len(driver.outputs)):
+                        self._data_from_peripherals.put(
+                            {"id": p["id"], "field": "output-values", "time": time.time(), "data": data})
+                    break
+                except:
+                    self._thread_output.put(
+                        "Failed to read data")
 
-        self._thread_output.put("Exiting")
+            # If there is any data to be sent to this node, encrypt it and send it
+            self._send_pending(peripheral, p, channel)
+        except:
+            self._thread_output.put("Failed to connect")
+        finally:
+            self._thread_output.put(
+                "Disconnecting from node {}".format(p["id"]))
+            self._disconnect(p["addr"], peripheral)
+
+    def _always_on_session(self, p):
+        # Sends the pending data to a node that stays awake
+        # The connection is held in the pool and reused by later sessions
+        for attempt in range(2):
+            try:
+                peripheral = self._pool.acquire(p)
+            except:
+                self._thread_output.put("Failed to connect")
+                return
+            try:
+                self._send_pending(peripheral, p, self._channel(p))
+                return
+            except self._backend.DisconnectError:
+                # Link lost - reconnect once, the data is pending again in the outbox
+                self._pool.discard(p["addr"])
+                self._thread_output.put(
+                    "Connection to node {} lost".format(p["id"]))
+            except:
+                self._pool.discard(p["addr"])
+                self._thread_output.put("Failed to connect")
+                return
+
+    def _send_pending(self, peripheral, p, channel):
+        """Sends the latest pending value of each input of a node"""
+        inputs = p["driver"].inputs
+        taken = self._outbox.take(p["id"])
+        done = 0
+        try:
+            for d in taken:
+                done += 1
+                if(0 <= d["index"] < len(inputs)):
+                    self._write_and_read_back(
+                        peripheral, p, channel, inputs[d["index"]][0], d, inputs[d["index"]][1])
+                else:
+                    self._thread_output.put(
+                        "Invalid index - not sending data")
+                    self._outbox.remove(d)
+        finally:
+            # Commands not tried because the session failed are pending again
+            for d in taken[done:]:
+                self._failed(d, True)
+
+    def _channel(self, p):
+        with self._channels_lock:
+            channel = self._channels.get(p["addr"])
+            if channel is None or channel.key != p["key"]:
+                channel = self._channels[p["addr"]] = SecureChannel(p["key"])
+            return channel
+
+    def _connect(self, p):
+        """Connects to a node through the adapter picked for it and returns
+        the peripheral
+        """
+        iface = self._adapters.assign(p["addr"])
+        if iface is None:
+            raise self._backend.Error("No adapter available")
+        self._thread_output.put(
+            "Connecting to node {} on hci{}".format(p["id"], iface))
+        try:
+            with METRICS.histogram("ble_connect_seconds", "Time to connect to a node",
+                                   {"node": p["id"]}).time():
+                peripheral = self._backend.connect(
+                    p["addr"], iface, min(self.CONNECT_TIMEOUT, self._session_timeout))
+        except:
+            _CONNECT_FAILURES.inc()
+            self._adapters.release(p["addr"], iface)
+            self._adapters.connect_failed(iface, p["addr"])
+            raise
+        self._adapters.connected(iface, p["addr"])
+        with self._peripherals_lock:
+            self._iface_of[p["addr"]] = iface
+            self._peripherals[p["addr"]] = peripheral
+        try:
+            peripheral.setMTU(100)
+        except:
+            self._disconnect(p["addr"], peripheral)
+            raise
+        return peripheral
+
+    def _abort_session(self, p):
+        """Closes the connection used by a session that is stuck"""
+        if p["driver"].always_on:
+            self._pool.discard(p["addr"])
+            return
+        peripheral = self._peripherals.get(p["addr"])
+        if peripheral is not None:
+            try:
+                self._disconnect(p["addr"], peripheral)
+            except:
+                pass
+
+    def _disconnect(self, addr, peripheral):
+        try:
+            peripheral.disconnect()
+        finally:
+            # The session and the main loop (on a timeout) may both close it
+            with self._peripherals_lock:
+                owned = self._peripherals.get(addr) is peripheral
+                if owned:
+                    del self._peripherals[addr]
+                    iface = self._iface_of.pop(addr, None)
+            if owned:
+                self._adapters.release(addr, iface)
+
+    def _keepalive(self, addr, peripheral):
+        """Reads the first cached characteristic of a pooled node to keep the link up"""
+        p = self._registry.by_addr(addr)
+        uuid = p["driver"].keepalive_uuid()
+        handles = self._get_handles(peripheral, p, [uuid])
+        self._read(peripheral, p, list(handles.values())[0])
+
+    def _get_handles(self, peripheral, p, uuids):
+        """Returns a dict of uuid -> value handle for characteristics of a node.
+        Handles come from the cache when possible, otherwise they are discovered
+        and cached for the next connections.
+        """
+        handles = self._handle_cache.get(p["addr"], uuids)
+        if handles is None:
+            with METRICS.histogram("ble_discovery_seconds", "Time to discover the characteristics of a node",
+                                   {"node": p["id"]}).time():
+                svc = peripheral.getServiceByUUID(p["driver"].service)
+                handles = {}
+                for uuid in uuids:
+                    handles[uuid] = svc.getCharacteristics(uuid)[0].getHandle()
+            self._handle_cache.put(p["addr"], handles)
+        return handles
+
+    def _read(self, peripheral, p, handle):
+        """Reads a characteristic by handle. If the handle is rejected by the node,
+        the cached handles of the node are dropped so they are discovered again
+        """
+        try:
+            return peripheral.readCharacteristic(handle)
+        except self._backend.GattError:
+            self._handle_cache.invalidate(p["addr"])
+            raise
+
+    def _write(self, peripheral, p, handle, value):
+        try:
+            peripheral.writeCharacteristic(handle, value)
+        except self._backend.GattError:
+            self._handle_cache.invalidate(p["addr"])
+            raise
+
+    def _write_and_read_back(self, peripheral, p, channel, uuid, d, name):
+        """Encrypts and writes a value to an input characteristic, then reads the
+        characteristic again to get the actual value stored in the node
+        """
+        try:
+            handle = self._get_handles(peripheral, p, [uuid])[uuid]
+        except Exception as e:
+            self._thread_output.put("Error sending data")
+            # After a lost link the value is sent again on the new connection
+            lost = isinstance(e, self._backend.DisconnectError)
+            self._failed(d, lost)
+            if lost:
+                raise
+            return
+        written = False
+        try:
+            self._thread_output.put(
+                "Setting {} of node {} to {}".format(name, d["id"], d["data"]))
+            self._write(peripheral, p, handle,
+                        p["driver"].encode(channel, d["data"]))
+            written = True
+        except Exception as e:
+            self._thread_output.put("Error sending data")
+            # After a lost link the value is sent again on the new connection
+            lost = isinstance(e, self._backend.DisconnectError)
+            self._failed(d, lost)
+            if lost:
+                raise
+
+        # Reading the value again to get the actual value stored in the node
+        time.sleep(0.1)
+        try:
+            message = p["driver"].decode(
+                channel, self._read(peripheral, p, handle))
+            self._thread_output.put("Valid {} data read".format(name))
+            value = message.split(';')[0]
+            if written:
+                self._outbox.acknowledge(d, value)
+                if d["index"] == p["driver"].sleep_input:
+                    try:
+                        self._scheduler.set_sleep_time(p["addr"], float(value))
+                    except ValueError:
+                        pass
+                if d["priority"]:
+                    latency = time.time() - d["time"]
+                    _COMMAND_LATENCY.observe(latency)
+                    self._thread_output.put("Priority data for node {} applied in {:.3f}s{}".format(
+                        d["id"], latency, " (above target)" if latency > self._latency_target else ""))
+            self._data_from_peripherals.put(
+                {"id": p["id"], "field": "input-values", "time": time.time(),
+                 "index": d["index"], "data": value})
+        except:
+            _READ_BACK_FAILURES.inc()
+            self._thread_output.put("Invalid {} data read".format(name))
+            if written:
+                # Without the read back there is no way to tell if the write was
+                # applied, so the value is sent again in the next session
+                self._failed(d)
+
+    def _failed(self, d, retry_now=False):
+        if self._outbox.failed(d, retry_now):
+            self._thread_output.put("Giving up sending {} to node {} after repeated failures".format(
+                d["data"], d["id"]))
 
     def update_nodes_dict(self, gateway_data):
-        """Updates the gateway data with fields for the connected nodes.
+        """Updates the gateway data with fields for the known nodes.
         Assumes no other thread is using the data. Returns a string.
         """
-        _ret = "Generating dictionary from PERIPHERALS...\n"
-        for p in self._PERIPHERALS:
-            if p["type"] == "s1":
-                _ret += "Adding sensor node with Temp, Light sensor and deep sleep timer\n"
-                gateway_data["nodes"][p["id"]] = {"output-tags": ["Temperature (°C)", "Relative Humidity (%)", "Heat Index (°C)", "Light (0-4095)"],
-                                                  "output-values": ["Loading", "Loading", "Loading", "Loading"],
-                                                  "input-tags": ["Sleep time (seconds)"], "input-values": ["10"]}
-            elif p["type"] == "a1":
-                _ret += "Adding actuator node with one LED sensor\n"
-                gateway_data["nodes"][p["id"]] = {"output-tags": [],
-                                                  "output-values": [],
-                                                  "input-tags": ["LED value"], "input-values": ["0"]}
-            else:
-                _ret += "Invlaid peripheral type\n"
-        return _ret
+        return self._registry.update_nodes_dict(gateway_data)
@@ -0,0 +1,234 @@
+import random
+import threading
+import time
+
+
+class BluepyBackend:
+    """BLE through bluepy. Adapters are given by their HCI number (0 for hci0).
+    bluepy is only imported when this backend is created.
+    """
+
+    def __init__(self):
+        from bluepy import btle
+        self._btle = btle
+        self.Error = btle.BTLEException
+        self.DisconnectError = btle.BTLEDisconnectError
+        self.GattError = btle.BTLEGattError
+        self.ManagementError = btle.BTLEManagementError
+
+        class ScanDelegate(btle.DefaultDelegate):
+            """Passes every advertisement received by a scanner to a function"""
+
+            def __init__(self, seen):
+                btle.DefaultDelegate.__init__(self)
+                self._seen = seen
+
+            def handleDiscovery(self, dev, isNewDev, isNewData):
+                self._seen(dev.addr, dev.rssi)
+        self._ScanDelegate = ScanDelegate
+
+    def connect(self, addr, iface=0, timeout=None):
+        """Connects to a node and returns the peripheral. Raises an error if it
+        takes more than timeout seconds.
+        """
+        return self._btle.Peripheral(addr, iface=iface, timeout=timeout)
+
+    def scanner(self, iface, seen):
+        """Returns a scanner on an adapter calling seen(addr, rssi) for every
+        advertisement
+        """
+        return self._btle.Scanner(iface).withDelegate(self._ScanDelegate(seen))
+
+
+class SimulatedError(Exception):
+    pass
+
+
+class SimulatedDisconnectError(SimulatedError):
+    pass
+
+
+class SimulatedGattError(SimulatedError):
+    pass
+
+
+class SimulatedManagementError(SimulatedError):
+    pass
+
+
+class SimulatedDevice:
+    """Node seen by the simulated backend, with its characteristics by uuid.
+    read and write can be overridden to give a node its behaviour.
+    latency is added to the connection and to every operation, and each of
+    them fails with a disconnect with probability failure_rate.
+    """
+
+    def __init__(self, addr, service, characteristics, rssi=-60, latency=0, failure_rate=0):
+        self.addr = addr
+        self.service = service
+        self.values = dict(characteristics)  # uuid -> bytes
+        self.rssi = rssi  # int, or dict of adapter -> int
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.advertising = True
+        self.connections = 0
+
+    def fault(self):
+        """Waits for the latency and raises the injected failures"""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise SimulatedDisconnectError("Injected failure")
+
+    def rssi_on(self, iface):
+        return self.rssi.get(iface, -100) if isinstance(self.rssi, dict) else self.rssi
+
+    def read(self, uuid):
+        return self.values[uuid]
+
+    def write(self, uuid, value):
+        self.values[uuid] = value
+
+    def connected(self):
+        self.connections += 1
+
+    def disconnected(self):
+        self.connections -= 1
+
+
+class _SimulatedCharacteristic:
+    def __init__(self, handle):
+        self._handle = handle
+
+    def getHandle(self):
+        return self._handle
+
+
+class _SimulatedService:
+    def __init__(self, handles):
+        self._handles = handles
+
+    def getCharacteristics(self, uuid):
+        return [_SimulatedCharacteristic(self._handles[uuid])]
+
+
+class SimulatedPeripheral:
+    """Connection to a simulated device, with the bluepy Peripheral methods
+    used by the gateway
+    """
+
+    def __init__(self, backend, device, iface):
+        self._backend = backend
+        self._device = device
+        self.iface = iface
+        self._uuids = sorted(device.values)  # handle - 1 -> uuid
+        self._connected = True
+        device.connected()
+
+    def _check(self):
+        if not self._connected or self._backend.is_down(self.iface):
+            raise SimulatedDisconnectError("Device disconnected")
+        self._device.fault()
+
+    def setMTU(self, mtu):
+        self._check()
+
+    def getServiceByUUID(self, uuid):
+        self._check()
+        if uuid != self._device.service:
+            raise SimulatedGattError("Service not found")
+        return _SimulatedService({u: i + 1 for i, u in enumerate(self._uuids)})
+
+    def readCharacteristic(self, handle):
+        self._check()
+        if not 0 < handle <= len(self._uuids):
+            raise SimulatedGattError("Invalid handle")
+        return self._device.read(self._uuids[handle - 1])
+
+    def writeCharacteristic(self, handle, value):
+        self._check()
+        if not 0 < handle <= len(self._uuids):
+            raise SimulatedGattError("Invalid handle")
+        self._device.write(self._uuids[handle - 1], value)
+
+    def disconnect(self):
+        if self._connected:
+            self._connected = False
+            self._device.disconnected()
+
+
+class _SimulatedScanner:
+    def __init__(self, backend, iface, seen):
+        self._backend = backend
+        self._iface = iface
+        self._seen = seen
+
+    def clear(self):
+        pass
+
+    def start(self, passive=False):
+        if self._backend.is_down(self._iface):
+            raise SimulatedManagementError("Adapter down")
+
+    def process(self, timeout):
+        time.sleep(timeout)
+        if self._backend.is_down(self._iface):
+            raise SimulatedManagementError("Adapter down")
+        for device in self._backend.devices():
+            if device.advertising:
+                self._seen(device.addr, device.rssi_on(self._iface))
+
+    def stop(self):
+        pass
+
+
+class SimulatedBackend:
+    """Backend with simulated adapters and devices, used to test the gateway
+    without radios. Adapters can be taken down to test failover.
+    """
+
+    Error = SimulatedError
+    DisconnectError = SimulatedDisconnectError
+    GattError = SimulatedGattError
+    ManagementError = SimulatedManagementError
+
+    def __init__(self, ifaces=(0,), connect_time=0.05):
+        self._lock = threading.Lock()
+        self._ifaces = set(ifaces)
+        self._down = set()
+        self._devices = {}
+        self._connect_time = connect_time
+
+    def add_device(self, device):
+        with self._lock:
+            self._devices[device.addr] = device
+
+    def devices(self):
+        with self._lock:
+            return list(self._devices.values())
+
+    def set_down(self, iface, down=True):
+        with self._lock:
+            if down:
+                self._down.add(iface)
+            else:
+                self._down.discard(iface)
+
+    def is_down(self, iface):
+        return iface in self._down or iface not in self._ifaces
+
+    def connect(self, addr, iface=0, timeout=None):
+        with self._lock:
+            device = self._devices.get(addr)
+        delay = self._connect_time + (device.latency if device is not None else 0)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise SimulatedDisconnectError("Timed out connecting to peripheral")
+        time.sleep(self._connect_time)
+        if self.is_down(iface) or device is None or not device.advertising:
+            raise SimulatedDisconnectError("Failed to connect to peripheral")
+        device.fault()
+        return SimulatedPeripheral(self, device, iface)
+
+    def scanner(self, iface, seen):
+        return _SimulatedScanner(self, iface, seen)
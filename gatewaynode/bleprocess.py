@@ -0,0 +1,218 @@
+import json
+import multiprocessing
+import queue
+import threading
+import time
+
+# Records on the pipe between the gateway and the BLE process : one type byte
+# followed by compact JSON
+_INGEST = b"I"  # worker -> gateway : [id, field, time, data, index]
+_OUTPUT = b"O"  # worker -> gateway : text for the BLE output
+_HEARTBEAT = b"H"  # worker -> gateway, while the BLE thread is making progress
+_DATA = b"D"  # gateway -> worker : [id, index, value]
+_PRIORITY = b"P"  # gateway -> worker : [id, index, value, time received]
+_SLEEP = b"S"  # gateway -> worker : gateway data with the input values
+_RELOAD = b"R"  # gateway -> worker : reload the peripherals file
+_EXIT = b"X"  # gateway -> worker
+
+
+def _encode(tag, body=None):
+    return tag + json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+
+def _decode(record):
+    return record[:1], json.loads(record[1:].decode('utf-8'))
+
+
+def _worker(conn, registry_path, options, backend_factory):
+    """Runs a BleThread in the BLE process and passes its records through the pipe"""
+    from ble import BleThread
+    from registry import PeripheralRegistry
+
+    exit_event = threading.Event()
+    thread_output = queue.Queue()
+    data_to_peripherals = queue.Queue()
+    data_from_peripherals = queue.Queue()
+    priority_to_peripherals = queue.Queue()
+    registry = PeripheralRegistry(registry_path)
+    try:
+        registry.load()
+    except Exception as e:
+        thread_output.put("Error loading peripherals : " + e.__class__.__name__)
+    ble_thread = BleThread(exit_event, thread_output, registry, data_to_peripherals,
+                           data_from_peripherals, priority_to_peripherals=priority_to_peripherals,
+                           backend=backend_factory() if backend_factory else None, **options)
+    ble_thread.start()
+    iterations, heartbeat_time = -1, 0
+    try:
+        while ble_thread.is_alive():
+            while conn.poll(0.05):
+                tag, body = _decode(conn.recv_bytes())
+                if tag == _DATA:
+                    data_to_peripherals.put(body)
+                elif tag == _PRIORITY:
+                    priority_to_peripherals.put(body)
+                elif tag == _SLEEP:
+                    ble_thread.set_sleep_times(body)
+                elif tag == _RELOAD:
+                    try:
+                        registry.load()
+                    except Exception as e:
+                        thread_output.put("Error loading peripherals : " + e.__class__.__name__)
+                elif tag == _EXIT:
+                    return
+            records = []
+            while True:
+                try:
+                    d = data_from_peripherals.get_nowait()
+                except queue.Empty:
+                    break
+                records.append(_encode(_INGEST, [d["id"], d["field"], d["time"],
+                                                 d["data"], d.get("index")]))
+            while True:
+                try:
+                    records.append(_encode(_OUTPUT, thread_output.get_nowait()))
+                except queue.Empty:
+                    break
+            # Only sent while the BLE thread loop is running, so that a hang in
+            # it gets the process restarted
+            if time.time() - heartbeat_time > 1 and ble_thread.iterations != iterations:
+                iterations, heartbeat_time = ble_thread.iterations, time.time()
+                records.append(_HEARTBEAT)
+            for record in records:
+                conn.send_bytes(record)
+    except (EOFError, OSError):
+        pass  # the gateway is gone
+    finally:
+        exit_event.set()
+        ble_thread.join()
+
+
+class BleProcess(threading.Thread):
+    """Runs the BLE thread in a separate process, so that bluepy and the
+    AES-GCM work for the nodes run on another core and a hung bluepy-helper
+    cannot stall the gateway. This thread supervises the process : it passes
+    data between the gateway queues and the pipe, and restarts the process if
+    it exits or stops sending heartbeats. Takes the same arguments as
+    BleThread. The process reads the peripherals file itself, so nodes are
+    added through the file and registry_changed().
+    Data queued in the process when it crashes is lost.
+    """
+
+    HEARTBEAT_TIMEOUT = 15
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, exit_event, thread_output, registry, data_to_peripherals, data_from_peripherals,
+                 max_connections=3, session_timeout=20, handle_cache_file="gatt_handles.json",
+                 pool_size=4, pool_idle_timeout=300, keepalive_interval=30,
+                 priority_to_peripherals=None, latency_target=0.5,
+                 backend_factory=None, ifaces=(0,), scan_iface=None):
+        threading.Thread.__init__(self)
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._registry = registry
+        self._data_to_peripherals = data_to_peripherals
+        self._data_from_peripherals = data_from_peripherals
+        self._priority_to_peripherals = priority_to_peripherals
+        self._options = {"max_connections": max_connections, "session_timeout": session_timeout,
+                         "handle_cache_file": handle_cache_file, "pool_size": pool_size,
+                         "pool_idle_timeout": pool_idle_timeout, "keepalive_interval": keepalive_interval,
+                         "latency_target": latency_target, "ifaces": list(ifaces), "scan_iface": scan_iface}
+        # Must be picklable, e.g. a module level function
+        self._backend_factory = backend_factory
+        self._sleep_times = None  # sent again to every new process
+        self._control = queue.Queue()  # records from other threads to the process
+
+    def update_nodes_dict(self, gateway_data):
+        return self._registry.update_nodes_dict(gateway_data)
+
+    def set_sleep_times(self, gateway_data):
+        self._sleep_times = {"nodes": {i: {"input-values": n["input-values"]}
+                                       for i, n in gateway_data["nodes"].items()}}
+        self._control.put(_encode(_SLEEP, self._sleep_times))
+
+    def registry_changed(self):
+        self._control.put(_encode(_RELOAD))
+
+    def run(self):
+        context = multiprocessing.get_context("spawn")
+        delay = 1
+        while not self._exit_event.is_set():
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, daemon=True,
+                                      args=(child_conn, self._registry.path, self._options,
+                                            self._backend_factory))
+            process.start()
+            child_conn.close()
+            self._thread_output.put("BLE process started (pid {})".format(process.pid))
+            started = time.time()
+            # Everything queued for the old process is replaced by this
+            while True:
+                try:
+                    self._control.get_nowait()
+                except queue.Empty:
+                    break
+            if self._sleep_times is not None:
+                conn.send_bytes(_encode(_SLEEP, self._sleep_times))
+
+            reason = self._pump(conn, process)
+            if reason is None:
+                conn.send_bytes(_encode(_EXIT))
+                process.join(10)
+            if process.is_alive():
+                process.terminate()
+                process.join(5)
+            conn.close()
+            if reason is None:
+                break
+            # Back off if the process keeps failing soon after starting
+            if time.time() - started > 60:
+                delay = 1
+            self._thread_output.put("BLE process {}, restarting in {}s".format(reason, delay))
+            self._exit_event.wait(delay)
+            delay = min(delay * 2, self.MAX_RESTART_DELAY)
+        self._thread_output.put("Exiting")
+
+    def _pump(self, conn, process):
+        """Passes data until the gateway exits (returns None) or the process has
+        to be restarted (returns the reason)
+        """
+        heartbeat = time.time()
+        while not self._exit_event.is_set():
+            try:
+                while conn.poll(0.05):
+                    record = conn.recv_bytes()
+                    if record == _HEARTBEAT:
+                        heartbeat = time.time()
+                        continue
+                    tag, body = _decode(record)
+                    if tag == _INGEST:
+                        d = {"id": body[0], "field": body[1], "time": body[2], "data": body[3]}
+                        if body[4] is not None:
+                            d["index"] = body[4]
+                        self._data_from_peripherals.put(d)
+                    elif tag == _OUTPUT:
+                        self._thread_output.put(body)
+                records = []
+                for q, tag in ((self._data_to_peripherals, _DATA),
+                               (self._priority_to_peripherals, _PRIORITY)):
+                    while q is not None:
+                        try:
+                            records.append(_encode(tag, q.get_nowait()))
+                        except queue.Empty:
+                            break
+                while True:
+                    try:
+                        records.append(self._control.get_nowait())
+                    except queue.Empty:
+                        break
+                for record in records:
+                    conn.send_bytes(record)
+            except (EOFError, OSError):
+                process.join(1)
+                return "exited with code {}".format(process.exitcode)
+            if not process.is_alive():
+                return "exited with code {}".format(process.exitcode)
+            if time.time() - heartbeat > self.HEARTBEAT_TIMEOUT:
+                return "not responding"
+        return None
@@ -0,0 +1,76 @@
+import struct
+import zlib
+
+# Sessions that negotiate the binary encoding get frames that start with a type
+# byte. JSON sessions get the JSON text with no type byte, as before.
+FRAME_JSON = 0x00
+FRAME_JSON_COMPRESSED = 0x01
+FRAME_UPDATES = 0x02
+
+VALUE_FLOAT = 0x00
+VALUE_STRING = 0x01
+
+FIELDS = ["output-values", "input-values"]
+
+_COUNT = struct.Struct("!H")
+_UPDATE = struct.Struct("!HBB")  # node index, field index, number of values
+_FLOAT = struct.Struct("!Bf")
+
+
+def intern_table(data):
+    """Returns the node ids and fields in the order used for their indexes in
+    binary updates. Sent to the session after the gateway data.
+    """
+    return {"nodes": list(data["nodes"]), "fields": FIELDS}
+
+
+def json_frame(encoded, compress=False):
+    """Frame for a JSON message (given as UTF-8 bytes)"""
+    if compress:
+        return bytes([FRAME_JSON_COMPRESSED]) + zlib.compress(encoded)
+    return bytes([FRAME_JSON]) + encoded
+
+
+def can_pack(update, node_index):
+    """True if the update is a node update that can go in a binary frame"""
+    return (isinstance(update, list) and len(update) == 3 and update[0] in node_index
+            and update[1] in FIELDS and len(update[2]) < 256)
+
+
+def pack_updates(updates, node_index):
+    """Packs several [id, field, values] updates in one frame. Values that are
+    numbers within the range of 32 bit floats are sent as such, anything else
+    as a short string.
+    """
+    parts = [bytes([FRAME_UPDATES]), _COUNT.pack(len(updates))]
+    for node_id, field, values in updates:
+        parts.append(_UPDATE.pack(
+            node_index[node_id], FIELDS.index(field), len(values)))
+        for value in values:
+            try:
+                parts.append(_FLOAT.pack(VALUE_FLOAT, float(value)))
+            except (TypeError, ValueError, OverflowError):
+                text = str(value).encode('utf-8')[:255]
+                parts.append(bytes([VALUE_STRING, len(text)]) + text)
+    return b"".join(parts)
+
+
+def unpack_updates(frame, nodes):
+    """Inverse of pack_updates, given the node ids of the intern table"""
+    (count,) = _COUNT.unpack_from(frame, 1)
+    offset = 1 + _COUNT.size
+    updates = []
+    for _ in range(count):
+        node, field, n = _UPDATE.unpack_from(frame, offset)
+        offset += _UPDATE.size
+        values = []
+        for _ in range(n):
+            if frame[offset] == VALUE_FLOAT:
+                values.append(_FLOAT.unpack_from(frame, offset)[1])
+                offset += _FLOAT.size
+            else:
+                length = frame[offset + 1]
+                values.append(frame[offset + 2:offset + 2 + length].decode('utf-8'))
+                offset += 2 + length
+        updates.append([nodes[node], FIELDS[field], values])
+    return updates
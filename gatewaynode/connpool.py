@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConnectionPool:
+    """Pool of connections held open to nodes that stay awake.
+    Connections are reused between sessions, kept alive while idle and
+    disconnected after idle_timeout seconds without being used. When the pool
+    is full the least recently used connection is closed.
+    """
+
+    def __init__(self, connect, max_size=4, idle_timeout=300, keepalive_interval=30,
+                 disconnect=None):
+        self._connect = connect  # function(p) -> connected peripheral
+        self._close = disconnect  # function(addr, peripheral), or None
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._keepalive_interval = keepalive_interval
+        self._lock = threading.Lock()
+        # addr -> [peripheral, last used, last keepalive], least recently used first
+        self._connections = OrderedDict()
+
+    def is_connected(self, addr):
+        with self._lock:
+            return addr in self._connections
+
+    def addresses(self):
+        with self._lock:
+            return list(self._connections)
+
+    def acquire(self, p):
+        """Returns a held connection to the node, connecting if there is none"""
+        with self._lock:
+            c = self._connections.get(p["addr"])
+            if c is not None:
+                c[1] = time.time()
+                self._connections.move_to_end(p["addr"])
+                return c[0]
+        peripheral = self._connect(p)
+        now = time.time()
+        evicted = []
+        with self._lock:
+            self._connections[p["addr"]] = [peripheral, now, now]
+            while len(self._connections) > self._max_size:
+                addr, c = self._connections.popitem(last=False)
+                evicted.append((addr, c[0]))
+        for addr, peripheral in evicted:
+            self._disconnect(addr, peripheral)
+        return peripheral
+
+    def discard(self, addr):
+        """Closes and removes a connection, e.g. after the link was lost"""
+        with self._lock:
+            c = self._connections.pop(addr, None)
+        if c is not None:
+            self._disconnect(addr, c[0])
+
+    def maintain(self, keepalive, claim=None, release=None):
+        """Closes idle connections and calls keepalive(addr, peripheral) on the
+        connections due for one. Connections whose keepalive fails are dropped.
+        Each connection is only touched after claim(addr) returned True (it is
+        left alone if the node is in use) and release(addr) is called after.
+        Returns the addresses of the connections that were closed.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [addr for addr, c in self._connections.items()
+                          if now - c[1] > self._idle_timeout or now - c[2] > self._keepalive_interval]
+        closed = []
+        for addr in candidates:
+            if claim is not None and not claim(addr):
+                continue
+            try:
+                # Checked again now that nobody else uses the connection
+                with self._lock:
+                    c = self._connections.get(addr)
+                    now = time.time()
+                    if c is None:
+                        continue
+                    if now - c[1] > self._idle_timeout:
+                        peripheral = None
+                    elif now - c[2] > self._keepalive_interval:
+                        c[2] = now
+                        peripheral = c[0]
+                    else:
+                        continue
+                if peripheral is not None:
+                    try:
+                        keepalive(addr, peripheral)
+                        continue
+                    except:
+                        pass
+                self.discard(addr)
+                closed.append(addr)
+            finally:
+                if release is not None:
+                    release(addr)
+        return closed
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.items())
+            self._connections.clear()
+        for addr, c in connections:
+            self._disconnect(addr, c[0])
+
+    def _disconnect(self, addr, peripheral):
+        try:
+            if self._close is not None:
+                self._close(addr, peripheral)
+            else:
+                peripheral.disconnect()
+        except:
+            pass
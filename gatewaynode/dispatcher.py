@@ -0,0 +1,92 @@
+import os
+import queue
+import selectors
+import threading
+
+from metrics import InstrumentedQueue
+
+
+class WakeQueue(InstrumentedQueue):
+    """Queue that wakes its dispatcher whenever an item is put in it"""
+
+    def __init__(self, dispatcher, name, maxsize=0):
+        InstrumentedQueue.__init__(self, name, maxsize)
+        self._dispatcher = dispatcher
+
+    def _put(self, item):
+        InstrumentedQueue._put(self, item)
+        self._dispatcher.notify()
+
+
+class Dispatcher:
+    """Single event source for the main thread. Blocks until an item is put in
+    one of its queues or a registered file (e.g. stdin) is readable, and wakes
+    immediately when that happens.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        # Only one wake up byte is written until the dispatcher wakes
+        self._notified = False
+        self._notified_lock = threading.Lock()
+
+    def queue(self, name, maxsize=0):
+        """Returns a new queue that wakes this dispatcher. The name is used
+        for the metrics of the queue.
+        """
+        return WakeQueue(self, name, maxsize)
+
+    def register(self, fileobj, data=None):
+        """Wakes the dispatcher when fileobj is readable"""
+        self._selector.register(fileobj, selectors.EVENT_READ, data)
+
+    def notify(self):
+        with self._notified_lock:
+            if self._notified:
+                return
+            self._notified = True
+        self.wake()
+
+    def wake(self):
+        """Writes a wake up byte without taking the lock, so that it can be
+        called from a signal handler
+        """
+        try:
+            os.write(self._wake_w, b"\x00")
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout=None):
+        """Blocks until there is an event or the timeout expires. Returns the
+        data of the registered files that are readable.
+        """
+        ready = []
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj == self._wake_r:
+                # The pipe is emptied before clearing the flag, so an item put
+                # in between is either seen by the caller or notified again
+                try:
+                    while os.read(self._wake_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                with self._notified_lock:
+                    self._notified = False
+            else:
+                ready.append(key.data)
+        return ready
+
+    @staticmethod
+    def drain(q, limit):
+        """Returns up to limit items from a queue without blocking"""
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(q.get_nowait())
+            except queue.Empty:
+                break
+        return items
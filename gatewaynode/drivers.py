@@ -0,0 +1,75 @@
+SERVICE_UUID = "86df3990-4bdf-442e-8eb7-04bbd173e4a7"
+TEMP_UUID = "1c70ab2e-c645-4853-b46a-fd4cd0b7f538"
+LIGHT_UUID = "2a47596d-8402-4359-952a-a956c84b0f41"
+SLEEP_UUID = "cac889a0-4436-489b-ba6c-0e4f9b2d47ca"
+LED_UUID = "8a7a1f1d-3cc0-4fe7-ab8a-d75fbcfb1a7b"
+
+
+class NodeDriver:
+    """Describes a type of node : its characteristics, how values are encoded
+    on them, the tags shown to the user and how the gateway polls it.
+    Values on the characteristics are AES-GCM encrypted with the node's key,
+    12 byte nonce followed by the ciphertext (see securechannel).
+    """
+
+    type = None
+    service = SERVICE_UUID
+    # Characteristics read in each session, in order. Their decoded values
+    # are joined to give the output values separated by ';'
+    outputs = []  # [(uuid, name)]
+    output_tags = []
+    # Characteristic and default value of each input, by index
+    inputs = []  # [(uuid, name, default)]
+    input_tags = []
+    # Always-on nodes are held connected in the pool and only get a session
+    # when there is data for them. Other nodes get a session every time they
+    # advertise, then disconnect (e.g. to deep sleep)
+    always_on = False
+    # Index of the input with the deep sleep time in seconds, for nodes that
+    # sleep between sessions
+    sleep_input = None
+
+    def node_data(self):
+        """Returns the entry of a node of this type in the gateway data"""
+        return {"output-tags": list(self.output_tags),
+                "output-values": ["Loading"] * len(self.output_tags),
+                "input-tags": list(self.input_tags),
+                "input-values": [i[2] for i in self.inputs]}
+
+    def keepalive_uuid(self):
+        """Characteristic read to keep a pooled connection up"""
+        return (self.outputs or self.inputs)[0][0]
+
+    def decode(self, channel, raw):
+        """Decrypts a value read from a characteristic"""
+        return channel.open(raw).split(b'\x00')[0].decode()
+
+    def encode(self, channel, value):
+        """Encrypts a value to be written to an input characteristic"""
+        return channel.seal((value + ";").ljust(16, ';').encode('utf-8'))
+
+
+class S1Driver(NodeDriver):
+    """Sensor node 1 - gives sensor readings and enters deep sleep after the
+    connection ends. The deep sleep time can be set using a characteristic.
+    """
+
+    type = "s1"
+    outputs = [(TEMP_UUID, "temperature"), (LIGHT_UUID, "light")]
+    output_tags = ["Temperature (°C)", "Relative Humidity (%)",
+                   "Heat Index (°C)", "Light (0-4095)"]
+    inputs = [(SLEEP_UUID, "deep sleep time", "10")]
+    input_tags = ["Sleep time (seconds)"]
+    sleep_input = 0
+
+
+class A1Driver(NodeDriver):
+    """Actuator node 1 - has one input characteristic, stays awake"""
+
+    type = "a1"
+    inputs = [(LED_UUID, "led value", "0")]
+    input_tags = ["LED value"]
+    always_on = True
+
+
+DRIVERS = {d.type: d() for d in (S1Driver, A1Driver)}
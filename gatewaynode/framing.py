@@ -0,0 +1,45 @@
+import struct
+
+# Each frame is a 4 byte big endian length followed by that many bytes
+_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+
+
+def encode_frame(payload):
+    """Returns the payload with its length prefix"""
+    return _HEADER.pack(len(payload)) + payload
+
+
+def frame_header(length):
+    """Length prefix of a frame, for payloads written after it"""
+    return _HEADER.pack(length)
+
+
+class FrameDecoder:
+    """Incremental decoder for length prefixed frames. Data can be fed as it is
+    received, with partial frames or several frames in one chunk.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self._max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """Adds received data and returns the list of frames completed by it.
+        Raises ValueError if a frame is larger than the maximum size.
+        """
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(self._buffer, offset)
+            if length > self._max_frame_size:
+                raise ValueError("Frame too large")
+            end = offset + _HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            frames.append(bytes(self._buffer[offset + _HEADER.size:end]))
+            offset = end
+        if offset:
+            del self._buffer[:offset]
+        return frames
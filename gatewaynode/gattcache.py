@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+
+class HandleCache:
+    """Per-address cache of the value handles of discovered characteristics.
+    The cache is saved to a JSON file so that it persists across restarts.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._handles = {}  # addr -> {uuid: handle}
+        try:
+            with open(path) as f:
+                self._handles = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, addr, uuids):
+        """Returns a dict of uuid -> handle if all the uuids are cached for the
+        address, otherwise None
+        """
+        with self._lock:
+            handles = self._handles.get(addr)
+            if handles is None or any(u not in handles for u in uuids):
+                return None
+            return dict(handles)
+
+    def put(self, addr, handles):
+        with self._lock:
+            self._handles.setdefault(addr, {}).update(handles)
+            self._save()
+
+    def invalidate(self, addr):
+        """Drops the handles of an address, forcing discovery on the next connection"""
+        with self._lock:
+            if self._handles.pop(addr, None) is not None:
+                self._save()
+
+    def _save(self):
+        try:
+            if os.path.dirname(self._path):
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._handles, f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            # The cache still works in memory if it cannot be saved
+            pass
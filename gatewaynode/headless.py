@@ -0,0 +1,160 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import socket
+import threading
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname,
+                 "source": record.name, "message": record.getMessage()}
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records with the same source and message every
+    interval seconds. The number of records dropped is added to the next one
+    that is let through.
+    """
+
+    def __init__(self, burst=20, interval=10):
+        logging.Filter.__init__(self)
+        self._burst = burst
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._counts = {}  # (source, message) -> [window start, count, suppressed]
+
+    def filter(self, record):
+        now = time.time()
+        key = (record.name, record.msg)
+        with self._lock:
+            c = self._counts.get(key)
+            if c is None or now - c[0] > self._interval:
+                if len(self._counts) > 1000:
+                    self._counts.clear()
+                suppressed = 0 if c is None else c[2]
+                self._counts[key] = [now, 1, 0]
+                record.suppressed = suppressed
+                return True
+            if c[1] < self._burst:
+                c[1] += 1
+                record.suppressed = 0
+                return True
+            c[2] += 1
+            return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records when the queue is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=1000000, backup_count=5):
+    """Sets up leveled, rate limited logging to a rotating file. Records are
+    written by a background listener thread so that logging does not block
+    the thread that logs. Returns the listener, which must be stopped on exit.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(10000)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    return listener
+
+
+class LogOutput:
+    """Replaces a thread output queue in headless mode. Text put in it is logged
+    right away instead of being kept until the curses window shows it.
+    """
+
+    _WARNING_WORDS = ("Failed", "Error", "Invalid", "timed out", "lost", "Insufficient")
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def put(self, text):
+        text = text.rstrip("\n")
+        if any(w in text for w in self._WARNING_WORDS):
+            self._logger.warning(text)
+        else:
+            self._logger.info(text)
+
+
+class ControlThread(threading.Thread):
+    """Thread that serves the keyboard commands of the curses front-end on a
+    local unix socket. Each connection sends one command line (e.g. "k" or
+    "i 2;0;100") and gets the output of the command back.
+    """
+
+    def __init__(self, exit_event, thread_output, path, commands):
+        threading.Thread.__init__(self)
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._path = path
+        self._commands = commands  # command -> function(argument) returning a string
+
+    def run(self):
+        try:
+            if os.path.dirname(self._path):
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            if os.path.exists(self._path):
+                os.remove(self._path)
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(self._path)
+            os.chmod(self._path, 0o600)
+            s.listen(1)
+            s.settimeout(1)
+        except Exception as e:
+            self._thread_output.put("Error binding control socket.")
+            self._thread_output.put(e.__class__.__name__)
+            return
+
+        while not self._exit_event.is_set():
+            try:
+                conn, _ = s.accept()
+            except:
+                continue
+            try:
+                conn.settimeout(5)
+                line = conn.recv(1024).decode().strip()
+                command, _, argument = line.partition(" ")
+                if command in self._commands:
+                    self._thread_output.put("Control command : " + command)
+                    reply = self._commands[command](argument)
+                else:
+                    reply = "Unknown command"
+                conn.sendall((reply + "\n").encode())
+            except Exception as e:
+                self._thread_output.put(
+                    "Error handling control command : " + e.__class__.__name__)
+            finally:
+                conn.close()
+        s.close()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
@@ -0,0 +1,145 @@
+import math
+import threading
+from array import array
+
+
+class RingBuffer:
+    """Fixed size ring buffer of (time, value) samples stored in two arrays of
+    doubles. Samples must be appended in time order.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._times = array('d', bytes(8 * size))
+        self._values = array('d', bytes(8 * size))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, value):
+        i = (self._start + self._count) % self._size
+        self._times[i] = t
+        self._values[i] = value
+        if self._count < self._size:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % self._size
+
+    def first_time(self):
+        return self._times[self._start] if self._count else None
+
+    def range(self, start, end):
+        """Returns the samples with start <= time <= end as a list of (time, value)"""
+        # Binary search for the first sample at or after start
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[(self._start + mid) % self._size] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        samples = []
+        for n in range(lo, self._count):
+            i = (self._start + n) % self._size
+            if self._times[i] > end:
+                break
+            samples.append((self._times[i], self._values[i]))
+        return samples
+
+
+class SeriesHistory:
+    """History of one numeric field: raw samples plus averages per minute and
+    per hour, each kept in its own ring buffer
+    """
+
+    TIERS = (("raw", 0), ("minute", 60), ("hour", 3600))
+
+    def __init__(self, retention):
+        self._tiers = [(name, period, RingBuffer(retention[name]))
+                       for name, period in self.TIERS]
+        # Sum, count and bucket start of the average being built for each tier
+        self._buckets = [[0.0, 0, None] for _ in self.TIERS]
+
+    def add(self, t, value):
+        for (name, period, ring), bucket in zip(self._tiers, self._buckets):
+            if period == 0:
+                ring.append(t, value)
+                continue
+            bucket_start = t - t % period
+            if bucket[2] is not None and bucket_start != bucket[2]:
+                ring.append(bucket[2], bucket[0] / bucket[1])
+                bucket[0], bucket[1] = 0.0, 0
+            bucket[0] += value
+            bucket[1] += 1
+            bucket[2] = bucket_start
+
+    def query(self, start, end, max_points):
+        """Returns at most max_points samples between start and end, averaged
+        over equal time slots. Each part of the range comes from the finest
+        tier that still has samples for it.
+        """
+        samples = []
+        covered_from = end
+        for name, period, ring in self._tiers:
+            first = ring.first_time()
+            if first is None:
+                continue
+            # Averages are timed at the start of their period, so the ones that
+            # overlap the samples of a finer tier are left out
+            part = ring.range(start, covered_from - period if samples else end)
+            samples = part + samples
+            if part:
+                covered_from = part[0][0]
+            if first <= start:
+                break
+        return downsample(samples, start, end, max_points)
+
+
+def downsample(samples, start, end, max_points):
+    """Averages samples over max_points equal time slots between start and end"""
+    if len(samples) <= max_points or max_points <= 0:
+        return samples
+    width = (end - start) / max_points
+    slots = {}
+    for t, value in samples:
+        slot = min(int((t - start) / width), max_points - 1)
+        s = slots.setdefault(slot, [0.0, 0.0, 0])
+        s[0] += t
+        s[1] += value
+        s[2] += 1
+    return [(s[0] / s[2], s[1] / s[2]) for _, s in sorted(slots.items())]
+
+
+class History:
+    """Time series of the numeric output values of every node, by (node id, index)"""
+
+    def __init__(self, retention):
+        self._retention = retention  # tier name -> number of samples kept
+        self._series = {}  # (node id, index) -> SeriesHistory
+        self._lock = threading.Lock()
+
+    def add_values(self, node_id, t, values):
+        """Adds a sample for each output value that is a finite number"""
+        with self._lock:
+            for index, value in enumerate(values):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                # Sensors can report "nan", which would spoil the averages
+                if not math.isfinite(value):
+                    continue
+                series = self._series.get((node_id, index))
+                if series is None:
+                    series = SeriesHistory(self._retention)
+                    self._series[(node_id, index)] = series
+                series.add(t, value)
+
+    def query(self, node_id, index, start, end, max_points):
+        with self._lock:
+            series = self._series.get((node_id, index))
+            if series is None:
+                return []
+            return series.query(start, end, max_points)
@@ -0,0 +1,219 @@
+import bisect
+import http.server
+import queue
+import threading
+import time
+
+# Bucket upper bounds in seconds, from 100us to 30s
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + "}"
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum"""
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent in its block"""
+        return _Timer(self)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, None if empty"""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        rank, seen = p / 100 * count, 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class Metrics:
+    """Named counters, histograms and gauges of the gateway. Metrics are
+    created on first use, so each module asks for the ones it updates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # name with labels -> (kind, help, metric)
+
+    def _get(self, kind, name, help, labels, factory):
+        key = _name(name, labels)
+        with self._lock:
+            m = self._metrics.get(key)
+            if m is None:
+                m = self._metrics[key] = (kind, name, help, factory())
+        return m[3]
+
+    def counter(self, name, help="", labels=None):
+        return self._get("counter", name, help, labels, Counter)
+
+    def histogram(self, name, help="", labels=None, buckets=TIME_BUCKETS):
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, function, help="", labels=None):
+        """Registers a gauge whose value is function() when read"""
+        with self._lock:
+            self._metrics[_name(name, labels)] = ("gauge", name, help, function)
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines, described = [], set()
+        for key, (kind, name, help, m) in metrics:
+            if name not in described:
+                described.add(name)
+                if help:
+                    lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, kind))
+            labels = key[len(name):]
+            if kind == "counter":
+                lines.append("{} {}".format(key, m.value))
+            elif kind == "gauge":
+                try:
+                    lines.append("{} {}".format(key, m()))
+                except Exception:
+                    pass
+            else:
+                inner = labels[1:-1] + "," if labels else ""
+                cumulative = 0
+                for bound, n in zip(m.buckets + ("+Inf",), m.counts):
+                    cumulative += n
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, inner, bound, cumulative))
+                lines.append("{}_sum{} {}".format(name, labels, m.sum))
+                lines.append("{}_count{} {}".format(name, labels, m.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Returns one short line per metric, for the curses panel"""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for key, (kind, name, help, m) in metrics:
+            if kind == "counter":
+                lines.append("{} {}".format(key, m.value))
+            elif kind == "gauge":
+                try:
+                    lines.append("{} {}".format(key, m()))
+                except Exception:
+                    pass
+            elif m.count:
+                lines.append("{} n={} p50={} p95={}".format(
+                    key, m.count, _ms(m.percentile(50)), _ms(m.percentile(95))))
+        return lines
+
+
+def _ms(seconds):
+    return ">{}s".format(TIME_BUCKETS[-1]) if seconds == float("inf") else \
+        "{:g}ms".format(seconds * 1000)
+
+
+# Metrics of the gateway process
+METRICS = Metrics()
+
+
+class InstrumentedQueue(queue.Queue):
+    """Queue that records its depth and how long items wait in it"""
+
+    def __init__(self, name, maxsize=0, metrics=METRICS):
+        queue.Queue.__init__(self, maxsize)
+        self._wait = metrics.histogram(
+            "queue_wait_seconds", "Time items spend in a queue", {"queue": name})
+        metrics.gauge("queue_depth", self.qsize, "Items in a queue", {"queue": name})
+
+    def _put(self, item):
+        queue.Queue._put(self, (time.perf_counter(), item))
+
+    def _get(self):
+        t, item = queue.Queue._get(self)
+        self._wait.observe(time.perf_counter() - t)
+        return item
+
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics in the Prometheus text format on
+    http://host:port/metrics, on localhost only by default
+    """
+
+    def __init__(self, exit_event, thread_output, port, host="127.0.0.1", metrics=METRICS):
+        threading.Thread.__init__(self)
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._port = port
+        self._host = host
+        self._metrics = metrics
+
+    def run(self):
+        metrics = self._metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = http.server.HTTPServer((self._host, self._port), Handler)
+        except OSError as e:
+            self._thread_output.put("Error binding metrics port : " + e.__class__.__name__)
+            return
+        server.timeout = 0.5
+        self._thread_output.put("Metrics on http://{}:{}/metrics".format(self._host, self._port))
+        while not self._exit_event.is_set():
+            server.handle_request()
+        server.server_close()
@@ -1,42 +1,133 @@
 import curses
 from curses import wrapper
 from curses.textpad import Textbox
+import argparse
+import logging
+import signal
 import threading
-import queue
 import json
 import time
+import os
+import sys
 
 from ble import BleThread
+from bleprocess import BleProcess
+from dispatcher import Dispatcher
+from history import History
+from metrics import METRICS, InstrumentedQueue, MetricsServer
+from registry import PeripheralRegistry
+from rules import RulesEngine, load_rules
+from telemetry import TelemetryLog, restore_state
+from upstream import UpstreamThread
+from headless import ControlThread, LogOutput, setup_logging
 from servertcp import ServerThread
+from sessionkeys import SessionKeys
+from state import StateStore
 from usertcp import UserThread
 
 
 class Node:
-    _PERIPHERALS = [
-        {"addr": "78:21:84:87:c5:e6", "id": "1",
-            "type": "s1", "key": b"abcdefghijklmnop"},
-        {"addr": "78:21:84:89:44:e6", "id": "2",
-            "type": "a1", "key": b"ponmlkjihgfedcba"},
-    ]
+    # Known nodes, see registry.PeripheralRegistry. The file can be edited
+    # while the gateway runs and reloaded with the "r" command
+    _PERIPHERALS_FILE = os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "peripherals.json")
+    _registry = PeripheralRegistry(_PERIPHERALS_FILE)
+    # Maximum simultaneous BLE connections and deadline (seconds) for each
+    # session with a node
+    _BLE_MAX_CONNECTIONS = 3
+    _BLE_SESSION_TIMEOUT = 20
+    # Connections held to always-on nodes : maximum number, seconds before an
+    # idle connection is closed and seconds between keepalive reads
+    _BLE_POOL_SIZE = 4
+    _BLE_POOL_IDLE_TIMEOUT = 300
+    _BLE_KEEPALIVE_INTERVAL = 30
+    # HCI adapters used (0 for hci0). If a scan adapter is given it only scans
+    # and the others only connect, otherwise all of them do both
+    _BLE_ADAPTERS = [0]
+    _BLE_SCAN_ADAPTER = None
+    # Run BLE in a separate process supervised by the gateway
+    _BLE_PROCESS = False
+    # BLE backend, None for the radios through bluepy (with _BLE_PROCESS, a
+    # function returning the backend). See bench.py for the simulated one
+    _BLE_BACKEND = None
+    # Target time (seconds) from receiving a set-value from the user to the
+    # value being applied on an always-on node
+    _PRIORITY_LATENCY_TARGET = 0.5
+
+    # Files kept by the gateway across restarts
+    _DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    _HANDLE_CACHE_FILE = os.path.join(_DATA_DIR, "gatt_handles.json")
+    _TELEMETRY_DB = os.path.join(_DATA_DIR, "telemetry.db")
+    # Log file and control socket used in headless mode
+    _LOG_FILE = os.path.join(_DATA_DIR, "gateway.log")
+    _CONTROL_SOCKET = os.path.join(_DATA_DIR, "control.sock")
+    # Automation rules, see rules.Rule
+    _RULES_FILE = os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "rules.json")
+    _rules = RulesEngine()
+
     _exit_event = threading.Event()
 
+    # Initial gateway data, kept in a versioned state store once the nodes are added
     _gateway_data = {"type": "gateway", "options": {
         "Automatic Light Control": True}, "nodes": {}}
-    _gateway_data_lock = threading.Lock()
+    _state = None
+
+    # History of numeric output values. Number of samples kept per field for
+    # the raw values and the averages per minute and per hour
+    _HISTORY_RETENTION = {"raw": 2000, "minute": 1440, "hour": 24*90}
+    _history = History(_HISTORY_RETENTION)
+    # Seconds of history loaded from the telemetry log on startup
+    _HISTORY_RESTORE_TIME = 86400
 
-    _user_connected = threading.Event()
+    _user_connected = threading.Event()  # set while at least one user is connected
 
-    _data_to_peripherals = queue.Queue()
-    _data_from_peripherals = queue.Queue()
-    _data_to_user = queue.Queue()
-    _data_from_user = queue.Queue()
+    # Queues read by the main thread wake the dispatcher when data is put in them
+    _dispatcher = Dispatcher()
+    # Maximum number of items taken from each queue before the others are checked
+    _BATCH_SIZE = 100
 
-    _ble_thread_output = queue.Queue()
-    _server_thread_output = queue.Queue()
-    _user_thread_output = queue.Queue()
+    _data_to_peripherals = InstrumentedQueue("data_to_peripherals")
+    _priority_to_peripherals = InstrumentedQueue("priority_to_peripherals")
+    _data_from_peripherals = _dispatcher.queue("data_from_peripherals")
+    _data_to_user = InstrumentedQueue("data_to_user")
+    _data_from_user = _dispatcher.queue("data_from_user")
 
+    _main_thread_output = _dispatcher.queue("main_output")
+    _ble_thread_output = _dispatcher.queue("ble_output")
+    _server_thread_output = _dispatcher.queue("server_output")
+    _user_thread_output = _dispatcher.queue("user_output")
+
+    # Local HTTP endpoint with the metrics (see metrics.py), "m" shows them
+    _METRICS_PORT = 9100
+    _dispatch_time = {source: METRICS.histogram(
+        "main_dispatch_seconds", "Time handling a batch of data in the main thread", {"source": source})
+        for source in ("peripherals", "user")}
+
+    # TCP ports of the server (key exchange) and of the users
+    _SERVER_PORT = 50000
+    _USER_PORT = 50001
     _server_key = [b"1234567890123456"]
-    _user_key = [None]
+    # Requests from the server remembered to refuse replays, 0 to accept
+    # them (the server may not use unique nonces)
+    _SERVER_REPLAY_WINDOW = 0
+    # Telemetry pushed to the server (see upstream.py), disabled if the host
+    # is None. Readings are spooled while the server cannot be reached
+    _UPSTREAM_HOST = None
+    _UPSTREAM_PORT = 50002
+    _UPSTREAM_INTERVAL = 60
+    _UPSTREAM_SPOOL_DIR = os.path.join(_DATA_DIR, "upstream")
+    _UPSTREAM_SPOOL_BYTES = 10 << 20
+    _upstream = None
+    # Server connections handled at once and seconds to receive a request
+    _SERVER_WORKERS = 4
+    _SERVER_READ_TIMEOUT = 5
+    # Maximum updates pending for a user and what to do when a user falls
+    # behind : "drop-oldest" or "resync" (send a full snapshot)
+    _USER_HIGH_WATER = 100
+    _USER_SLOW_POLICY = "resync"
+    # Keys issued to users, one per user session
+    _session_keys = SessionKeys()
 
     def _main(self, stdscr):
         """Creates threads, handles communication between them,
@@ -60,160 +151,341 @@ class Node:
             window_lines, window_cols, window_lines, 0, " Server TCP Output ")
         user_window, user_window_text = self._generate_windows(
             window_lines, window_cols, window_lines, window_cols+1, " User TCP Output ")
+        # Metrics panel, shown over the server window with "m"
+        metrics_window = curses.newwin(
+            window_lines, window_cols, window_lines, 0)
+        show_metrics = False
+        metrics_time = 0
 
         # Starting worker threads
-        ble_thread = BleThread(self._exit_event, self._ble_thread_output,
-                               self._PERIPHERALS, self._data_to_peripherals, self._data_from_peripherals)
-        ble_thread.update_nodes_dict(self._gateway_data)
-        ble_thread.start()
-        server_thread = ServerThread(
-            self._exit_event, self._server_thread_output, 50000, self._server_key, self._user_key, self._user_connected)
-        server_thread.start()
-        userThread = UserThread(self._exit_event, self._user_thread_output, 50001, self._user_key,
-                                self._user_connected, self._gateway_data, self._gateway_data_lock, self._data_to_user, self._data_from_user)
-        userThread.start()
+        threads = self._start_threads()
 
-        # Main loop
+        # Main loop - blocks until there is keyboard input or an item in one of
+        # the queues read by this thread, then handles all pending events
+        self._dispatcher.register(sys.stdin)
+        output = main_window_text.addstr
+        more = False
         while True:
+            self._dispatcher.wait(0 if more else 1)
+
             # Checking for keyboard inputs
-            try:
-                key = main_window.getkey()
-                if(key == "q"):
-                    main_window_text.addstr("Exiting...\n", curses.A_BOLD)
-                    main_window_text.refresh()
+            exiting = False
+            while True:
+                try:
+                    key = main_window.getkey()
+                except:
                     break
-                if(key == "i"):
-                    box = Textbox(main_window_input_box)
-                    box.edit()
-                    data = box.gather().strip().replace("\n", "").split(";")
-                    data[1] = int(data[1])
-                    self._data_to_peripherals.put(data)
-                    main_window_input_box.clear()
-                    main_window_input_box.refresh()
-                    main_window_text.addstr(
-                        "Data to be sent : {}\n".format(str(data)))
-                    main_window_text.refresh()
-                if(key == 'k'):
-                    key_string = "User AES Key :"
-                    if self._user_key[0] != None:
-                        for byte in self._user_key[0]:
-                            key_string += " %02x" % byte
-                        key_string += "\nUser AES Key :"
-                        for byte in self._user_key[0]:
-                            key_string += " %03d" % byte
-                    main_window_text.addstr(key_string+"\n")
-                    main_window_text.refresh()
-                if(key == 's'):
-                    self._gateway_data_lock.acquire()
-                    gateway_data_str = json.dumps(self._gateway_data)
-                    self._gateway_data_lock.release()
-                    main_window_text.addstr(gateway_data_str+"\n")
-                    main_window_text.refresh()
-
-            except:
-                # Check for data from BLE thread
-                if(self._data_from_peripherals.qsize() != 0):
-                    new_data = self._data_from_peripherals.get()
-
-                    # Updating data stored
-                    try:
-                        self._gateway_data_lock.acquire()
-                        new_data_values = new_data["data"].split(';')
-                        if(new_data["field"] == "output-values"):
-                            for i in range(len(self._gateway_data["nodes"][new_data["id"]
-                                                                           ]["output-values"])):
-                                self._gateway_data["nodes"][new_data["id"]
-                                                            ]["output-values"][i] = new_data_values[i]
-
-                            # Automatic Light Control from input
-                            # TODO improve this later
-                            if(self._gateway_data["options"]["Automatic Light Control"]):
-                                if(new_data["id"] == "1"):
-                                    main_window_text.addstr(
-                                        "Automatic light control, data from node 1\n")
-                                    light_level = int(new_data_values[3])
-                                    # led_value = 254-int(light_level * 0.0622)
-                                    led_value = 4095 - int(light_level)
-                                    main_window_text.addstr(
-                                        "Light level : %d, Led value : %d\n" % (light_level, led_value))
-                                    self._data_to_peripherals.put(
-                                        ["2", 0, str(led_value)])
-
-                        if(new_data["field"] == "input-values"):
-                            self._gateway_data["nodes"][new_data["id"]
-                                                        ]["input-values"][new_data["index"]] = new_data["data"]
-                    except Exception as e:
-                        main_window_text.addstr(
-                            "Error updating new data : %s\n" % (type(e).__name__))
-                    finally:
-                        self._gateway_data_lock.release()
-                    # Update user with new data if connected
-                    if(self._user_connected.is_set()):
-                        self._data_to_user.put(json.dumps(
-                            [new_data["id"], new_data["field"],
-                             self._gateway_data["nodes"][new_data["id"]
-                                                         ][new_data["field"]]
-                             ], separators=(',', ':')))
-
-                    main_window_text.addstr("{} : {} : {} : {}\n".format(new_data["id"],
-                                            str(int(new_data["time"])),
-                                            new_data["field"], new_data["data"]))
-                    main_window_text.refresh()
-
-                # Check for data from User thread
-                if(self._data_from_user.qsize() != 0):
-                    new_data = self._data_from_user.get()
+                try:
+                    if(key == "q"):
+                        main_window_text.addstr("Exiting...\n", curses.A_BOLD)
+                        main_window_text.refresh()
+                        exiting = True
+                        break
+                    if(key == "i"):
+                        box = Textbox(main_window_input_box)
+                        box.edit()
+                        data = box.gather()
+                        main_window_input_box.clear()
+                        main_window_input_box.refresh()
+                        main_window_text.addstr(self._command_input(data)+"\n")
+                    if(key == 'k'):
+                        main_window_text.addstr(self._command_key()+"\n")
+                    if(key == 's'):
+                        main_window_text.addstr(self._command_state()+"\n")
+                    if(key == 'r'):
+                        main_window_text.addstr(self._command_reload()+"\n")
+                    if(key == 'm'):
+                        show_metrics = not show_metrics
+                        metrics_time = 0
+                        if not show_metrics:
+                            server_window.touchwin()
+                            server_window.refresh()
+                            server_window_text.touchwin()
+                            server_window_text.refresh()
+                except Exception as e:
                     main_window_text.addstr(
-                        str(int(new_data[0]))+" : "+str(new_data[1])+"\n")
-                    message = json.loads(str(new_data[1]))
-                    try:
-                        if(message[0] == "set-value"):
-                            main_window_text.addstr(
-                                "Data to be sent : "+json.dumps(message[1:])+"\n")
-                            self._data_to_peripherals.put(message[1:])
-                        if(message[0] == "set-option"):
-                            try:
-                                self._gateway_data_lock.acquire()
-                                self._gateway_data["options"][message[1]
-                                                              ] = message[2]
-                                main_window_text.addstr(
-                                    "Option set : "+message[1]+" = "+str(message[2])+". Updating user...\n")
-                                self._data_to_user.put(
-                                    "[\"options\","+json.dumps(self._gateway_data["options"])+"]")
-                            except Exception as e:
-                                main_window_text.addstr(e.__class__.__name__)
-                            finally:
-                                self._gateway_data_lock.release()
-                    except Exception as e:
-                        main_window_text.addstr(
-                            "Error: "+e.__class__.__name__+"\n")
-                    main_window_text.refresh()
-
-                # Check for output for the three windows
-                while(self._ble_thread_output.qsize() != 0):
-                    text = self._ble_thread_output.get()
-                    ble_window_text.addstr(text+"\n")
-                    ble_window_text.refresh()
-                    ble_window.refresh()
-
-                while(self._server_thread_output.qsize() != 0):
-                    text = self._server_thread_output.get()
-                    server_window_text.addstr(text+"\n")
-                    server_window_text.refresh()
-                    server_window.refresh()
-
-                while(self._user_thread_output.qsize() != 0):
-                    text = self._user_thread_output.get()
-                    user_window_text.addstr(text+"\n")
-                    user_window_text.refresh()
-                    user_window.refresh()
-
-                time.sleep(0.1)
+                        "Error: "+e.__class__.__name__+"\n")
+                main_window_text.refresh()
+            if exiting:
+                break
+
+            # Data from the BLE and User threads, handled in batches
+            handled, more = self._dispatch(output)
+            if handled:
+                main_window_text.refresh()
+
+            if show_metrics and time.time() - metrics_time >= 1:
+                metrics_time = time.time()
+                metrics_window.erase()
+                metrics_window.border()
+                metrics_window.addstr(0, 2, " Metrics ")
+                for i, line in enumerate(METRICS.summary()[:window_lines-2]):
+                    metrics_window.addnstr(i+1, 1, line, window_cols-2)
+                metrics_window.refresh()
+
+            # Check for output for the three windows
+            for thread_output, window, window_text in ((self._main_thread_output, main_window, main_window_text),
+                                                       (self._ble_thread_output,
+                                                        ble_window, ble_window_text),
+                                                       (self._server_thread_output,
+                                                        server_window, server_window_text),
+                                                       (self._user_thread_output, user_window, user_window_text)):
+                texts = self._dispatcher.drain(thread_output, self._BATCH_SIZE)
+                if texts:
+                    for text in texts:
+                        window_text.addstr(text+"\n")
+                    if not (show_metrics and window is server_window):
+                        window_text.refresh()
+                        window.refresh()
+                    more = more or len(texts) == self._BATCH_SIZE
 
         self._exit_event.set()
-        ble_thread.join()
-        server_thread.join()
-        userThread.join()
+        for thread in threads:
+            thread.join()
+
+    def _start_threads(self):
+        """Creates and starts the worker threads. Returns the threads."""
+        try:
+            self._registry.load()
+        except Exception as e:
+            self._main_thread_output.put(
+                "Error loading peripherals : " + e.__class__.__name__)
+        ble_class = BleProcess if self._BLE_PROCESS else BleThread
+        ble_thread = self._ble_thread = ble_class(
+            self._exit_event, self._ble_thread_output,
+            self._registry, self._data_to_peripherals, self._data_from_peripherals,
+            self._BLE_MAX_CONNECTIONS, self._BLE_SESSION_TIMEOUT, self._HANDLE_CACHE_FILE,
+            self._BLE_POOL_SIZE, self._BLE_POOL_IDLE_TIMEOUT, self._BLE_KEEPALIVE_INTERVAL,
+            self._priority_to_peripherals, self._PRIORITY_LATENCY_TARGET,
+            self._BLE_BACKEND, self._BLE_ADAPTERS, self._BLE_SCAN_ADAPTER)
+        self._main_thread_output.put(
+            ble_thread.update_nodes_dict(self._gateway_data).rstrip())
+        # Last known values and recent history from before the restart
+        restored = restore_state(self._TELEMETRY_DB, self._gateway_data, self._history,
+                                 time.time() - self._HISTORY_RESTORE_TIME)
+        self._main_thread_output.put(
+            "Restored {} fields from the telemetry log".format(restored))
+        self._state = StateStore(self._gateway_data)
+        ble_thread.set_sleep_times(self._gateway_data)
+        try:
+            self._rules = load_rules(self._RULES_FILE)
+            self._main_thread_output.put(
+                "Loaded {} rules".format(len(self._rules)))
+        except Exception as e:
+            self._main_thread_output.put(
+                "Error loading rules : " + e.__class__.__name__)
+        ble_thread.start()
+        telemetry_log = self._telemetry_log = TelemetryLog(
+            self._exit_event, self._main_thread_output, self._TELEMETRY_DB)
+        telemetry_log.start()
+        server_thread = ServerThread(
+            self._exit_event, self._server_thread_output, self._SERVER_PORT, self._server_key, self._session_keys,
+            self._SERVER_REPLAY_WINDOW, self._SERVER_WORKERS, self._SERVER_READ_TIMEOUT, self._server_status)
+        server_thread.start()
+        userThread = UserThread(self._exit_event, self._user_thread_output, self._USER_PORT, self._session_keys,
+                                self._user_connected, self._state, self._data_to_user, self._data_from_user,
+                                self._USER_HIGH_WATER, self._USER_SLOW_POLICY)
+        userThread.start()
+        metrics_server = MetricsServer(
+            self._exit_event, self._main_thread_output, self._METRICS_PORT)
+        metrics_server.start()
+        threads = [ble_thread, server_thread, userThread, telemetry_log, metrics_server]
+        if self._UPSTREAM_HOST is not None:
+            upstream = self._upstream = UpstreamThread(
+                self._exit_event, self._main_thread_output, self._UPSTREAM_HOST, self._UPSTREAM_PORT,
+                self._server_key, self._UPSTREAM_SPOOL_DIR, self._UPSTREAM_INTERVAL,
+                max_spool_bytes=self._UPSTREAM_SPOOL_BYTES)
+            upstream.start()
+            threads.append(upstream)
+        return threads
+
+    def _command_input(self, text):
+        """Queues data to be sent to a node, given as "id;index;value" """
+        data = text.strip().replace("\n", "").split(";")
+        data[1] = int(data[1])
+        self._priority_to_peripherals.put(data + [time.time()])
+        return "Data to be sent : {}".format(str(data))
+
+    def _command_key(self, text=""):
+        """Returns the last user key issued and the number of users connected"""
+        key = self._session_keys.latest
+        key_string = "User AES Key :"
+        if key != None:
+            for byte in key:
+                key_string += " %02x" % byte
+            key_string += "\nUser AES Key :"
+            for byte in key:
+                key_string += " %03d" % byte
+        return key_string + "\nUsers connected : %d" % self._session_keys.in_use()
+
+    def _command_state(self, text=""):
+        """Returns the gateway data as JSON"""
+        return self._state.encoded()[1]
+
+    def _command_reload(self, text=""):
+        """Reloads the peripherals file, adding and removing nodes without a restart"""
+        added, removed = self._registry.load()
+        self._ble_thread.registry_changed()
+        for p in removed:
+            if self._registry.by_id(p["id"]) is None:
+                self._state.remove_node(p["id"])
+        for p in added:
+            self._state.add_node(p["id"], p["driver"].node_data())
+        if (added or removed) and self._user_connected.is_set():
+            # Users get the new structure as a full snapshot
+            self._data_to_user.put((None, self._state.encoded()[1]))
+        return "Peripherals reloaded : {} added, {} removed, {} nodes".format(
+            len(added), len(removed), len(self._registry))
+
+    def _command_metrics(self, text=""):
+        """Returns a summary of the metrics"""
+        return "\n".join(METRICS.summary())
+
+    def _server_status(self):
+        """Status of the gateway sent to the server"""
+        return {"nodes": len(self._registry), "version": self._state.version}
+
+    def _command_quit(self, text=""):
+        self._exit_event.set()
+        self._dispatcher.notify()
+        return "Exiting..."
+
+    def _signal_quit(self, signum, frame):
+        # The handler runs on the main thread, possibly while it holds the
+        # dispatcher lock, so it must not take it
+        self._exit_event.set()
+        self._dispatcher.wake()
+
+    def _main_headless(self):
+        """Runs the gateway without curses. Output from every thread is logged,
+        and the keyboard commands are served on the control socket.
+        """
+        self._ble_thread_output = LogOutput(logging.getLogger("ble"))
+        self._server_thread_output = LogOutput(logging.getLogger("server"))
+        self._user_thread_output = LogOutput(logging.getLogger("user"))
+        main_output = self._main_thread_output = LogOutput(
+            logging.getLogger("main"))
+
+        threads = self._start_threads()
+        control_thread = ControlThread(self._exit_event, LogOutput(logging.getLogger("control")),
+                                       self._CONTROL_SOCKET, {"i": self._command_input, "k": self._command_key,
+                                                              "s": self._command_state, "r": self._command_reload,
+                                                              "m": self._command_metrics, "q": self._command_quit})
+        control_thread.start()
+        threads.append(control_thread)
+
+        more = False
+        while not self._exit_event.is_set():
+            self._dispatcher.wait(0 if more else 1)
+            more = self._dispatch(main_output.put)[1]
+
+        main_output.put("Exiting...")
+        self._exit_event.set()
+        for thread in threads:
+            thread.join()
+
+    def _dispatch(self, output):
+        """Handles a batch of data from the BLE and User threads. Returns the
+        number of items handled and True if more may be waiting.
+        """
+        peripheral_batch = self._dispatcher.drain(
+            self._data_from_peripherals, self._BATCH_SIZE)
+        if peripheral_batch:
+            with self._dispatch_time["peripherals"].time():
+                for new_data in peripheral_batch:
+                    self._handle_peripheral_data(new_data, output)
+        user_batch = self._dispatcher.drain(
+            self._data_from_user, self._BATCH_SIZE)
+        if user_batch:
+            with self._dispatch_time["user"].time():
+                for new_data in user_batch:
+                    self._handle_user_data(new_data, output)
+        return len(peripheral_batch) + len(user_batch), len(peripheral_batch) == self._BATCH_SIZE or len(
+            user_batch) == self._BATCH_SIZE
+
+    def _record(self, t, node_id, field, values):
+        """Logs new values and queues them for the server"""
+        self._telemetry_log.record(t, node_id, field, values)
+        if self._upstream is not None:
+            self._upstream.record(t, node_id, field, values)
+
+    def _handle_peripheral_data(self, new_data, output):
+        """Stores new data from the BLE thread and sends it to the user"""
+        # Updating data stored
+        try:
+            new_data_values = new_data["data"].split(';')
+            if(new_data["field"] == "output-values"):
+                version, values = self._state.set_output_values(
+                    new_data["id"], new_data_values)
+                self._history.add_values(
+                    new_data["id"], new_data["time"], values)
+                self._record(new_data["time"], new_data["id"], "output-values", values)
+
+                # Rules triggered by the new values
+                for rule, target, index, value in self._rules.evaluate(
+                        new_data["id"], "output-values", values,
+                        self._state.snapshot()[1]["options"], new_data["time"]):
+                    output("{} : node {} input {} = {}\n".format(
+                        rule.name, target, index, value))
+                    self._data_to_peripherals.put([target, index, value])
+
+            if(new_data["field"] == "input-values"):
+                version, values = self._state.set_input_value(
+                    new_data["id"], new_data["index"], new_data["data"])
+                self._record(new_data["time"], new_data["id"], "input-values", values)
+
+            # Update user with new data if connected, with the version it
+            # gives so the user can sync from there after a reconnect
+            if(self._user_connected.is_set()):
+                self._data_to_user.put(
+                    (None, [new_data["id"], new_data["field"], values]))
+                self._data_to_user.put((None, ["version", version]))
+        except Exception as e:
+            output("Error updating new data : %s\n" % (type(e).__name__))
+
+        output("{} : {} : {} : {}\n".format(new_data["id"],
+                                             str(int(new_data["time"])),
+                                             new_data["field"], new_data["data"]))
+
+    def _handle_user_data(self, new_data, output):
+        """Handles a message from the user. Replies only go to the session the
+        message came from.
+        """
+        output(str(int(new_data[0]))+" : "+str(new_data[1])+"\n")
+        session = new_data[2]
+        try:
+            message = json.loads(str(new_data[1]))
+            if(message[0] == "set-value"):
+                output("Data to be sent : "+json.dumps(message[1:])+"\n")
+                self._priority_to_peripherals.put(
+                    message[1:] + [new_data[0]])
+            if(message[0] == "set-option"):
+                version, options = self._state.set_option(message[1], message[2])
+                self._telemetry_log.record_option(message[1], message[2])
+                output("Option set : "+message[1]+" = " +
+                       str(message[2])+". Updating user...\n")
+                self._data_to_user.put((None, ["options", options]))
+                self._data_to_user.put((None, ["version", version]))
+            if(message[0] == "get-history"):
+                # ["get-history", id, index, start time, end time, max points]
+                samples = self._history.query(message[1], int(message[2]), float(message[3]),
+                                              float(message[4]), int(message[5]))
+                self._data_to_user.put((session, ["history", message[1], int(message[2]),
+                                                  [[round(t, 1), round(v, 2)] for t, v in samples]]))
+                output("Sent {} history samples\n".format(len(samples)))
+            if(message[0] == "sync"):
+                # Resync after a reconnect : the changes since the version the
+                # user has, or the full data if that version is too old
+                delta = self._state.delta_since(int(message[1]))
+                if delta is None:
+                    self._data_to_user.put((session, self._state.encoded()[1]))
+                else:
+                    for update in delta[1]:
+                        self._data_to_user.put((session, update))
+                    self._data_to_user.put((session, ["version", delta[0]]))
+                output("Sync from version {}\n".format(message[1]))
+        except Exception as e:
+            output("Error: "+e.__class__.__name__+"\n")
 
     def _generate_windows(self, lines, cols, y, x, title):
         "Function to generate curses windows for output from different threads"
@@ -228,7 +500,32 @@ class Node:
     def run(self):
         wrapper(self._main)
 
+    def run_headless(self, log_file=None):
+        listener = setup_logging(log_file or self._LOG_FILE)
+        signal.signal(signal.SIGTERM, self._signal_quit)
+        try:
+            self._main_headless()
+        except KeyboardInterrupt:
+            self._exit_event.set()
+        finally:
+            listener.stop()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--headless", action="store_true",
+                        help="run without curses, logging to a file")
+    parser.add_argument("--log-file", help="log file used in headless mode")
+    parser.add_argument("--ble-process", action="store_true",
+                        help="run BLE in a separate process")
+    parser.add_argument("--upstream", metavar="HOST",
+                        help="push telemetry to the server at this host")
+    args = parser.parse_args()
+
     node = Node()
-    node.run()
+    node._BLE_PROCESS = args.ble_process
+    node._UPSTREAM_HOST = args.upstream
+    if args.headless:
+        node.run_headless(args.log_file)
+    else:
+        node.run()
@@ -0,0 +1,112 @@
+import threading
+import time
+
+PENDING = "pending"
+IN_FLIGHT = "in-flight"
+ACKNOWLEDGED = "acknowledged"
+
+
+class Outbox:
+    """Store for data to be sent to local nodes, indexed by node id and input
+    index. Only the latest value for each (node id, index) is kept, so a
+    backlog of updates to the same input costs a single write.
+    Each command goes from pending to in flight when a session takes it, and
+    to acknowledged when the value is read back from the node. A failed write
+    makes it pending again, unless a newer value has replaced it meanwhile.
+    Failed commands are retried after retry_delay seconds, doubled after each
+    failure up to max_retry_delay, and dropped after max_attempts failures.
+    """
+
+    def __init__(self, max_attempts=5, retry_delay=1, max_retry_delay=60):
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        self._commands = {}  # node id -> {index: command}
+        self._seq = 0
+        self.coalesced = 0  # number of values replaced before being sent
+
+    def put(self, node_id, index, value, priority=False, received=None):
+        """Stores a value to be sent, replacing any value not yet acknowledged.
+        Priority commands come from the user and their latency is measured
+        from the time they were received.
+        """
+        with self._lock:
+            self._seq += 1
+            commands = self._commands.setdefault(node_id, {})
+            c = commands.get(index)
+            if c is not None and c["state"] != ACKNOWLEDGED:
+                self.coalesced += 1
+            commands[index] = {"id": node_id, "index": index, "data": value,
+                               "state": PENDING, "seq": self._seq, "priority": priority,
+                               "time": time.time() if received is None else received,
+                               "attempts": 0, "next_attempt": 0}
+
+    def has_pending(self, node_id):
+        """True if the node has a command that is due to be sent"""
+        now = time.time()
+        with self._lock:
+            for c in self._commands.get(node_id, {}).values():
+                if c["state"] == PENDING and c["next_attempt"] <= now:
+                    return True
+        return False
+
+    def take(self, node_id):
+        """Returns copies of the commands of a node that are due and marks them
+        in flight
+        """
+        taken = []
+        now = time.time()
+        with self._lock:
+            for c in self._commands.get(node_id, {}).values():
+                if c["state"] == PENDING and c["next_attempt"] <= now:
+                    c["state"] = IN_FLIGHT
+                    taken.append(dict(c))
+        return taken
+
+    def failed(self, c, retry_now=False):
+        """Makes a command pending again so it is sent in a later session, after
+        a delay, or right away with retry_now (e.g. after the link was lost).
+        Returns True if it failed too many times and was dropped.
+        """
+        with self._lock:
+            commands = self._commands.get(c["id"], {})
+            current = commands.get(c["index"])
+            # Ignore commands that were replaced by a newer value
+            if current is None or current["seq"] != c["seq"] or current["state"] != IN_FLIGHT:
+                return False
+            current["attempts"] += 1
+            if current["attempts"] >= self._max_attempts:
+                del commands[c["index"]]
+                return True
+            current["state"] = PENDING
+            current["next_attempt"] = 0 if retry_now else time.time() + min(
+                self._max_retry_delay, self._retry_delay * 2 ** (current["attempts"] - 1))
+            return False
+
+    def acknowledge(self, c, value):
+        """Marks a command as acknowledged with the value read back from the node"""
+        self._set_state(c, ACKNOWLEDGED, value)
+
+    def remove(self, c):
+        """Drops a command that cannot be sent"""
+        with self._lock:
+            commands = self._commands.get(c["id"], {})
+            current = commands.get(c["index"])
+            if current is not None and current["seq"] == c["seq"]:
+                del commands[c["index"]]
+
+    def state(self, node_id, index):
+        with self._lock:
+            c = self._commands.get(node_id, {}).get(index)
+            return None if c is None else c["state"]
+
+    def _set_state(self, c, state, value=None):
+        with self._lock:
+            current = self._commands.get(c["id"], {}).get(c["index"])
+            # Ignore commands that were replaced by a newer value
+            if current is None or current["seq"] != c["seq"]:
+                return
+            current["state"] = state
+            if value is not None:
+                current["ack"] = value
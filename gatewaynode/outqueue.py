@@ -0,0 +1,80 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+
+DROP_OLDEST = "drop-oldest"
+RESYNC = "resync"
+
+
+class CollapsingBuffer:
+    """Bounded outbound buffer of one user session, used from the event loop.
+    Items with the same key (node id, field) replace each other so only the
+    newest value is sent. When more than high_water items are pending the
+    slow consumer policy applies: DROP_OLDEST drops the oldest items, RESYNC
+    drops everything and sets needs_resync so that the session is sent a
+    full snapshot instead. Replies to the session, such as history, are not
+    part of a snapshot and are kept.
+    """
+
+    def __init__(self, high_water=100, policy=DROP_OLDEST):
+        self._high_water = high_water
+        self._policy = policy
+        self._items = OrderedDict()  # key -> item, oldest first
+        self._unique = itertools.count()
+        self._ready = asyncio.Event()
+        self.needs_resync = False
+        self.closed = False
+        self.collapsed = 0
+        self.dropped = 0
+
+    def put(self, key, item, reply=False):
+        """Adds an item. Items with a key of None never replace each other.
+        reply tells that the item answers a request of this session.
+        """
+        if reply:
+            key = ("reply", next(self._unique))
+        elif key is None:
+            key = ("unique", next(self._unique))
+        elif key in self._items:
+            # Keeps its place in the queue with the newest value
+            self.collapsed += 1
+        self._items[key] = item
+        if len(self._items) > self._high_water:
+            if self._policy == RESYNC:
+                replies = OrderedDict(
+                    (k, v) for k, v in self._items.items() if k[0] == "reply")
+                self.dropped += len(self._items) - len(replies)
+                self._items = replies
+                self.needs_resync = True
+            else:
+                while len(self._items) > self._high_water:
+                    self._items.popitem(last=False)
+                    self.dropped += 1
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def get_all(self):
+        """Waits until there is something to send and returns all the pending
+        items, or None once the buffer is closed
+        """
+        while not self._items and not self.needs_resync and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.closed:
+            return None
+        items = list(self._items.values())
+        self._items.clear()
+        return items
+
+
+def update_key(update):
+    """Key used to collapse an update, None if it must not be collapsed"""
+    if isinstance(update, list):
+        if len(update) == 3 and update[1] in ("output-values", "input-values"):
+            return (update[0], update[1])
+        if len(update) == 2 and update[0] in ("options", "version"):
+            return (update[0],)
+    return None
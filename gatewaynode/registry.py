@@ -0,0 +1,98 @@
+import json
+import threading
+
+from drivers import DRIVERS
+
+
+class PeripheralRegistry:
+    """Known nodes, loaded from a JSON file with a list of
+    {"addr": ..., "id": ..., "type": ..., "key": ...} and indexed by address
+    and by id. Each entry also gets the driver of its type. The indexes are
+    replaced as a whole on every change, so readers need no lock.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._by_addr = {}
+        self._by_id = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    def __contains__(self, addr):
+        return addr in self._by_addr
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def by_addr(self, addr):
+        return self._by_addr.get(addr)
+
+    def by_id(self, node_id):
+        return self._by_id.get(node_id)
+
+    def load(self):
+        """Reads the file again. Returns (added, removed) lists of entries."""
+        with open(self._path) as f:
+            configs = json.load(f)
+        peripherals = [self._entry(c) for c in configs]
+        with self._lock:
+            old = self._by_id
+            new = {p["id"]: p for p in peripherals}
+            # Entries that did not change are kept as they are
+            for node_id, p in new.items():
+                if node_id in old and self._same(old[node_id], p):
+                    new[node_id] = old[node_id]
+            added = [p for i, p in new.items() if old.get(i) is not p]
+            removed = [p for i, p in old.items() if new.get(i) is not p]
+            self._set(new)
+        return added, removed
+
+    def add(self, config):
+        """Adds or replaces a node at runtime. Returns the new entry."""
+        p = self._entry(config)
+        with self._lock:
+            new = dict(self._by_id)
+            new[p["id"]] = p
+            self._set(new)
+        return p
+
+    def remove(self, node_id):
+        with self._lock:
+            new = dict(self._by_id)
+            p = new.pop(node_id, None)
+            self._set(new)
+        return p
+
+    def update_nodes_dict(self, gateway_data):
+        """Adds the fields of every node to the gateway data. Returns a string."""
+        _ret = "Generating dictionary from the peripheral registry...\n"
+        for p in self:
+            _ret += "Adding {} node {}\n".format(p["type"], p["id"])
+            gateway_data["nodes"][p["id"]] = p["driver"].node_data()
+        return _ret
+
+    def _set(self, by_id):
+        self._by_id = by_id
+        self._by_addr = {p["addr"]: p for p in by_id.values()}
+
+    @staticmethod
+    def _entry(config):
+        driver = DRIVERS.get(config["type"])
+        if driver is None:
+            raise ValueError("Invalid peripheral type " + str(config["type"]))
+        key = config["key"]
+        key = key.encode('utf-8') if isinstance(key, str) else bytes(key)
+        if len(key) not in (16, 24, 32):
+            raise ValueError("Invalid key for node " + str(config["id"]))
+        return {"addr": config["addr"].lower(), "id": str(config["id"]),
+                "type": config["type"], "key": key, "driver": driver}
+
+    @staticmethod
+    def _same(a, b):
+        return all(a[k] == b[k] for k in ("addr", "type", "key"))
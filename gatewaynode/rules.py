@@ -0,0 +1,122 @@
+import json
+import math
+
+
+class Rule:
+    """Automation rule compiled from its config :
+    {"name": ..., "trigger": {"node": id, "field": "output-values", "index": i},
+     "conditions": [{"option": name, "equals": value}, {"above": x}, {"below": x}],
+     "transform": [{"scale": a}, {"offset": b}, {"clamp": [low, high]}, {"round": digits}],
+     "target": {"node": id, "index": i},
+     "hysteresis": h, "debounce": seconds, "min_interval": seconds}
+    The trigger value goes through the transforms in order and the result is
+    written to the target input. A new value is only written if it differs
+    from the last one written by more than the hysteresis, after it has held
+    for the debounce time, and at most once per min_interval seconds.
+    """
+
+    def __init__(self, config):
+        self.name = config["name"]
+        trigger = config["trigger"]
+        self.node = str(trigger["node"])
+        self.field = trigger.get("field", "output-values")
+        self.index = int(trigger["index"])
+        self.target = (str(config["target"]["node"]), int(config["target"]["index"]))
+        self.hysteresis = float(config.get("hysteresis", 0))
+        self.debounce = float(config.get("debounce", 0))
+        self.min_interval = float(config.get("min_interval", 0))
+        self._options = []  # (name, value)
+        self._checks = []  # functions of the trigger value
+        for condition in config.get("conditions", []):
+            if "option" in condition:
+                self._options.append((condition["option"], condition.get("equals", True)))
+            elif "above" in condition:
+                self._checks.append(lambda v, x=float(condition["above"]): v > x)
+            elif "below" in condition:
+                self._checks.append(lambda v, x=float(condition["below"]): v < x)
+            else:
+                raise ValueError("Unknown condition in rule " + self.name)
+        self._transforms = []
+        for transform in config.get("transform", []):
+            (op, arg), = transform.items()
+            if op == "scale":
+                self._transforms.append(lambda v, a=float(arg): v * a)
+            elif op == "offset":
+                self._transforms.append(lambda v, b=float(arg): v + b)
+            elif op == "clamp":
+                self._transforms.append(
+                    lambda v, lo=float(arg[0]), hi=float(arg[1]): min(max(v, lo), hi))
+            elif op == "round":
+                self._transforms.append(lambda v, d=int(arg): round(v, d))
+            else:
+                raise ValueError("Unknown transform in rule " + self.name)
+
+        self._written = None  # last value written
+        self._written_time = None
+        self._candidate = None  # value waiting for the debounce time
+        self._candidate_time = None
+
+    def evaluate(self, values, options, t):
+        """Returns the value to write to the target, or None"""
+        for name, expected in self._options:
+            if options.get(name) != expected:
+                return None
+        try:
+            value = float(values[self.index])
+        except (IndexError, ValueError):
+            return None
+        # Sensors can report "nan", which is not a value to act on
+        if not math.isfinite(value):
+            return None
+        for check in self._checks:
+            if not check(value):
+                return None
+        for transform in self._transforms:
+            value = transform(value)
+        if not math.isfinite(value):
+            return None
+
+        if self._written is not None and abs(value - self._written) <= self.hysteresis:
+            self._candidate = None
+            return None
+        if self.debounce:
+            if self._candidate is None or abs(value - self._candidate) > self.hysteresis:
+                self._candidate, self._candidate_time = value, t
+            if t - self._candidate_time < self.debounce:
+                return None
+        if self._written_time is not None and t - self._written_time < self.min_interval:
+            return None
+        self._written, self._written_time = value, t
+        self._candidate = None
+        return value
+
+
+class RulesEngine:
+    """Rules indexed by the (node id, field) that triggers them, so new data
+    only goes through the rules that use it
+    """
+
+    def __init__(self, rules=()):
+        self._index = {}
+        for rule in rules:
+            self._index.setdefault((rule.node, rule.field), []).append(rule)
+
+    def __len__(self):
+        return sum(len(rules) for rules in self._index.values())
+
+    def evaluate(self, node_id, field, values, options, t):
+        """Returns [(rule, target id, target index, value)] for the values to write"""
+        actions = []
+        for rule in self._index.get((node_id, field), ()):
+            value = rule.evaluate(values, options, t)
+            if value is not None:
+                if value == int(value):
+                    value = int(value)
+                actions.append((rule, rule.target[0], rule.target[1], str(value)))
+        return actions
+
+
+def load_rules(path):
+    """Reads the rules from a JSON file with a list of rule configs"""
+    with open(path) as f:
+        return RulesEngine([Rule(config) for config in json.load(f)])
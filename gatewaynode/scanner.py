@@ -0,0 +1,127 @@
+import threading
+import time
+
+from metrics import METRICS
+
+
+class ScannerThread(threading.Thread):
+    """Thread that scans for BLE devices in the background and keeps a presence
+    index by address with the time each device was last seen, its RSSI and
+    the time it started advertising.
+    Entries expire after ttl seconds without an advertisement. The
+    advertisement event is set for the addresses in watch (any container,
+    so nodes added to it later are watched too).
+    The scan runs on adapter iface of the backend (see blebackend). Scanners
+    on several adapters can share their advertisement and enabled events.
+    """
+
+    def __init__(self, exit_event, thread_output, watch, ttl=5, restart_interval=10,
+                 backend=None, iface=0, advertisement=None, enabled=None, on_seen=None):
+        threading.Thread.__init__(self)
+        if backend is None:
+            from blebackend import BluepyBackend
+            backend = BluepyBackend()
+        self._backend = backend
+        self.iface = iface
+        self._on_seen = on_seen  # function(iface, addr, rssi) or None
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._watch = watch
+        self._ttl = ttl
+        # Some controllers stop reporting repeated advertisements from the same
+        # device after a while, so the scan is restarted periodically
+        self._restart_interval = restart_interval
+
+        self._devices = {}  # addr -> [last seen, rssi, first seen]
+        self._devices_lock = threading.Lock()
+        self._ended = {}  # addr -> end of the last session with the device
+
+        # Set when a watched device advertises
+        self.advertisement = threading.Event() if advertisement is None else advertisement
+        # Set if the scanner cannot run (e.g. insufficient permissions)
+        self.failed = threading.Event()
+        # Scanning stops while this is cleared, to save the radio when no
+        # node is expected to advertise
+        if enabled is None:
+            enabled = threading.Event()
+            enabled.set()
+        self.enabled = enabled
+
+    def seen(self, addr, rssi):
+        """Called from the scan delegate for every advertisement"""
+        now = time.time()
+        with self._devices_lock:
+            d = self._devices.get(addr)
+            # A device advertising again after its session ended (e.g. after
+            # a short sleep) starts a new wake
+            if d is None or now - d[0] > self._ttl or d[2] <= self._ended.get(addr, 0):
+                self._devices[addr] = [now, rssi, now]
+            else:
+                d[0], d[1] = now, rssi
+        if self._on_seen is not None:
+            self._on_seen(self.iface, addr, rssi)
+        if addr in self._watch:
+            self.advertisement.set()
+
+    def session_ended(self, addr, t):
+        """Called when a session with a device ends"""
+        with self._devices_lock:
+            self._ended[addr] = t
+
+    def present(self):
+        """Returns a dict of addr -> (last seen, rssi, first seen) for the devices seen in the
+        last ttl seconds and drops the expired entries
+        """
+        now = time.time()
+        with self._devices_lock:
+            expired = [a for a, d in self._devices.items()
+                       if now - d[0] > self._ttl]
+            for a in expired:
+                del self._devices[a]
+            return {a: tuple(d) for a, d in self._devices.items()}
+
+    def last_seen(self, addr):
+        """Returns the time a device was last seen or None if it is not present"""
+        with self._devices_lock:
+            d = self._devices.get(addr)
+        if d is None or time.time() - d[0] > self._ttl:
+            return None
+        return d[0]
+
+    def run(self):
+        try:
+            scanner = self._backend.scanner(self.iface, self.seen)
+        except Exception as e:
+            self._thread_output.put(
+                "Cannot scan on hci{} : {}".format(self.iface, type(e).__name__))
+            self.failed.set()
+            self.advertisement.set()
+            return
+        scan_time = METRICS.histogram(
+            "ble_scan_seconds", "Duration of the scan windows", {"iface": self.iface})
+        while not self._exit_event.is_set():
+            if not self.enabled.wait(0.5):
+                continue
+            try:
+                scanner.clear()
+                with scan_time.time():
+                    scanner.start(passive=True)
+                    restart_time = time.time() + self._restart_interval
+                    while (time.time() < restart_time and self.enabled.is_set()
+                           and not self._exit_event.is_set()):
+                        scanner.process(0.2)
+                    scanner.stop()
+            except self._backend.ManagementError:
+                self._thread_output.put(
+                    "Insufficient permissions or adapter hci{} down, cannot scan.".format(self.iface))
+                self.failed.set()
+                self.advertisement.set()
+                break
+            except self._backend.Error as e:
+                self._thread_output.put(
+                    "Scanner error : {}. Restarting scan".format(type(e).__name__))
+                try:
+                    scanner.stop()
+                except:
+                    pass
+                time.sleep(1)
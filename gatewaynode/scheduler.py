@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class WakeScheduler:
+    """Predicts when sleeping nodes wake up. A node goes to deep sleep when its
+    session ends, so the next wake is expected sleep time seconds after the
+    end of the last session. The sleep time starts as the configured one and
+    is corrected from the observed wakes, with the average prediction error
+    giving the width of the window in which the node is expected.
+    Scanning is only needed around these windows.
+    """
+
+    def __init__(self, margin=2, alpha=0.3):
+        self._margin = margin  # minimum half width of a wake window (seconds)
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        # addr -> {"sleep": predicted sleep time, "error": mean prediction
+        # error, "ended": end of the last session, "woke": last wake}
+        self._nodes = {}
+
+    def set_sleep_time(self, addr, seconds):
+        """Sets the configured sleep time of a node, e.g. after it was changed"""
+        with self._lock:
+            node = self._nodes.setdefault(addr, {"ended": None, "woke": None})
+            node["sleep"] = float(seconds)
+            node["error"] = None  # no prediction made with it yet
+            node["outliers"] = 0
+
+    def remove(self, addr):
+        with self._lock:
+            self._nodes.pop(addr, None)
+
+    def woke(self, addr, t):
+        """Called when a session starts after an advertisement from the node"""
+        with self._lock:
+            node = self._nodes.setdefault(
+                addr, {"sleep": None, "error": None, "ended": None, "outliers": 0})
+            # A wake from before the last session ended is stale
+            if node["ended"] is not None and t <= node["ended"]:
+                return
+            node["woke"] = t
+            if node["ended"] is None:
+                return
+            gap = t - node["ended"]
+            if node["sleep"] is None:
+                node["sleep"] = gap
+                return
+            error = abs(gap - node["sleep"])
+            # Gaps of several sleep times are missed wakes, not a new period,
+            # unless they keep happening
+            if gap > 1.5 * node["sleep"] > 0 and node["outliers"] < 2:
+                node["outliers"] += 1
+                return
+            node["outliers"] = 0
+            node["sleep"] += self._alpha * (gap - node["sleep"])
+            node["error"] = error if node["error"] is None else \
+                node["error"] + self._alpha * (error - node["error"])
+
+    def session_ended(self, addr, t):
+        with self._lock:
+            if addr in self._nodes:
+                self._nodes[addr]["ended"] = t
+
+    def window(self, addr):
+        """Returns (start, end) of the expected next wake of a node, or None if
+        it cannot be predicted
+        """
+        with self._lock:
+            node = self._nodes.get(addr)
+            if node is None or node["sleep"] is None or node["ended"] is None:
+                return None
+            if node["woke"] is not None and node["woke"] > node["ended"]:
+                return None  # awake now
+            predicted = node["ended"] + node["sleep"]
+            half = max(self._margin, 3 * (node["error"] or self._margin))
+            return predicted - half, predicted + half
+
+    def scan_needed(self, addrs, now=None):
+        """True if one of the nodes may be advertising now : it is expected in
+        its wake window, it is overdue or its wake cannot be predicted
+        """
+        now = time.time() if now is None else now
+        for addr in addrs:
+            window = self.window(addr)
+            if window is None or now >= window[0]:
+                return True
+        return False
+
+    def next_wake(self, addrs):
+        """Start of the earliest wake window of the nodes, or None"""
+        starts = [w[0] for w in map(self.window, addrs) if w is not None]
+        return min(starts) if starts else None
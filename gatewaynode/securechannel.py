@@ -0,0 +1,118 @@
+import os
+import struct
+import threading
+from collections import OrderedDict, deque
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from framing import frame_header
+
+# Sealed messages are the 12 byte nonce followed by the AES-GCM ciphertext
+NONCE_SIZE = 12
+# Nonces sent are a random prefix chosen per channel and a message counter
+_PREFIX_SIZE = 8
+_COUNTER = struct.Struct("!I")
+_COUNTER_MAX = (1 << 32) - 1
+
+_CACHE_SIZE = 64
+_ciphers = OrderedDict()  # key -> AESGCM, least recently used first
+_ciphers_lock = threading.Lock()
+
+
+def cipher(key):
+    """Returns the AESGCM context of a key, created once and cached"""
+    with _ciphers_lock:
+        c = _ciphers.get(key)
+        if c is not None:
+            _ciphers.move_to_end(key)
+            return c
+    c = AESGCM(key)
+    with _ciphers_lock:
+        _ciphers[key] = c
+        while len(_ciphers) > _CACHE_SIZE:
+            _ciphers.popitem(last=False)
+    return c
+
+
+def forget(key):
+    """Drops the cached context of a key that will not be used again"""
+    with _ciphers_lock:
+        _ciphers.pop(key, None)
+
+
+class SecureChannel:
+    """Seals and opens messages with one key. Nonces are never repeated by a
+    channel : the counter is incremented for every message and the prefix is
+    drawn again when it wraps. With a replay window, the nonces of the last
+    replay_window messages opened are kept and a message reusing one of them
+    is refused, whatever the nonces chosen by the peer.
+    Channels can be used from several threads.
+    """
+
+    def __init__(self, key, replay_window=0):
+        self.key = key
+        self._aesgcm = cipher(key)
+        self._lock = threading.Lock()
+        self._prefix = os.urandom(_PREFIX_SIZE)
+        self._counter = 0
+        self._replay_window = replay_window
+        self._seen = set()
+        self._seen_order = deque()
+
+    def _nonce(self):
+        with self._lock:
+            if self._counter == _COUNTER_MAX:
+                self._prefix = os.urandom(_PREFIX_SIZE)
+                self._counter = 0
+            self._counter += 1
+            return self._prefix + _COUNTER.pack(self._counter)
+
+    def seal(self, data):
+        """Returns the sealed message (nonce and ciphertext) as a bytearray"""
+        out = bytearray()
+        self._seal_into(out, data, False)
+        return out
+
+    def seal_frame(self, data):
+        """Returns the sealed message with its length prefix"""
+        out = bytearray()
+        self._seal_into(out, data, True)
+        return out
+
+    def seal_frames(self, payloads):
+        """Seals several payloads into one buffer of length prefixed frames,
+        to be sent with one write
+        """
+        out = bytearray()
+        for data in payloads:
+            self._seal_into(out, data, True)
+        return out
+
+    def _seal_into(self, out, data, framed):
+        nonce = self._nonce()
+        ciphertext = self._aesgcm.encrypt(nonce, data, None)
+        if framed:
+            out += frame_header(NONCE_SIZE + len(ciphertext))
+        out += nonce
+        out += ciphertext
+
+    def open(self, message):
+        """Returns the plaintext of a sealed message. Raises InvalidTag if it
+        cannot be decrypted and ValueError if it was already received.
+        """
+        view = memoryview(message)
+        if len(view) < NONCE_SIZE:
+            raise ValueError("Message too short")
+        nonce = bytes(view[:NONCE_SIZE])
+        if self._replay_window and nonce in self._seen:
+            raise ValueError("Replayed message")
+        plaintext = self._aesgcm.decrypt(nonce, view[NONCE_SIZE:], None)
+        if self._replay_window:
+            # Only nonces of authentic messages are kept
+            with self._lock:
+                if nonce in self._seen:
+                    raise ValueError("Replayed message")
+                self._seen.add(nonce)
+                self._seen_order.append(nonce)
+                if len(self._seen_order) > self._replay_window:
+                    self._seen.discard(self._seen_order.popleft())
+        return plaintext
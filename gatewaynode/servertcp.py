@@ -1,35 +1,84 @@
-import threading
+import hashlib
+import json
 import socket
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
 
+from metrics import METRICS
+from securechannel import SecureChannel
+
+_REJECTED = METRICS.counter(
+    "server_rejected_total", "Server connections refused because every handler was busy")
+
 
 class ServerThread(threading.Thread):
-    """Thread used to handle all communication with the server"""
+    """Thread used to handle all communication with the server. Connections
+    are accepted as they come and handled on a bounded pool of workers, each
+    with a deadline to receive the request. A request is sealed with the
+    server key and starts with its name :
+    KEY followed by an RSA public key - a new user key encrypted with it
+    PING - "PONG", sealed with the server key
+    STATUS - the status of the gateway as JSON, sealed with the server key
+    """
 
-    def __init__(self, exit_event, thread_output, port, server_key, user_key, user_connected):
+    BACKLOG = 16
+    MAX_REQUEST_SIZE = 8192
+    # Parsed public keys kept, by SHA-256 fingerprint
+    KEY_CACHE_SIZE = 32
+
+    def __init__(self, exit_event, thread_output, port, server_key, session_keys, replay_window=0,
+                 max_workers=4, read_timeout=5, status=None):
         threading.Thread.__init__(self)
         self._port = port
         self._exit_event = exit_event
         self._thread_output = thread_output
         self._server_key = server_key
-        self._user_key = user_key
-        self._user_connected = user_connected
+        self._session_keys = session_keys
+        # One channel for all the connections, so that with a replay window
+        # a request seen on an earlier connection is refused
+        self._replay_window = replay_window
+        self._channel = None
+        self._channel_lock = threading.Lock()
+        # At most max_workers connections are handled at once and as many
+        # more wait for a worker, others are closed straight away
+        self._max_workers = max_workers
+        self._slots = threading.BoundedSemaphore(2 * max_workers)
+        self._read_timeout = read_timeout
+        self._status = status  # function returning a dict for STATUS
+        self._encryptors = OrderedDict()  # fingerprint -> PKCS1_v1_5 cipher
+        self._encryptors_lock = threading.Lock()
+        self._handlers = {"KEY": self._request_key, "PING": self._request_ping,
+                          "STATUS": self._request_status}
+
+    def add_handler(self, name, handler):
+        """Adds a request type. handler(body) gets the rest of the request and
+        returns the bytes to reply, or None to close without replying.
+        """
+        self._handlers[name] = handler
+
+    def _server_channel(self):
+        with self._channel_lock:
+            if self._channel is None or self._channel.key != self._server_key[0]:
+                self._channel = SecureChannel(self._server_key[0], self._replay_window)
+            return self._channel
 
     def run(self):
         self._thread_output.put("Starting...")
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.bind(('', self._port))
-            s.listen(1)
+            s.listen(self.BACKLOG)
             s.settimeout(1)
         except Exception as e:
             self._thread_output.put("Error binding socket.")
             self._thread_output.put(e.__class__.__name__)
             return
 
+        executor = ThreadPoolExecutor(max_workers=self._max_workers)
         while True:
             if(self._exit_event.is_set()):
                 break
@@ -39,45 +88,97 @@ class ServerThread(threading.Thread):
                 continue
 
             self._thread_output.put("Got a connection from %s" % str(addr))
-
-            data = conn.recv(1024)
-            if not data:
-                self._thread_output.put("Closing connection")
-                conn.close()
-                continue
-
-            aesgcm = AESGCM(self._server_key[0])
-            try:
-                self._thread_output.put(
-                    "Data Received. IV: "+data[:12].decode())
-                message = aesgcm.decrypt(data[:12], data[12:], None).decode()
-                self._thread_output.put("Decoded message : "+message)
-            except:
-                self._thread_output.put("Authentication failed")
-                self._thread_output.put("Closing connection")
+            if not self._slots.acquire(blocking=False):
+                _REJECTED.inc()
+                self._thread_output.put("Too many connections, closing")
                 conn.close()
                 continue
+            executor.submit(self._handle_connection, conn)
+        self._thread_output.put("Exiting...")
+        s.close()
+        executor.shutdown(wait=True)
 
-            if(message[:3] == "KEY"):
-                if(not self._user_connected.is_set()):
-                    key = secrets.token_bytes(16)
-
-                    self._user_key[0] = key
-                    self._thread_output.put("Generated new key")
-
-                    # nonce = bytes(message[:12], 'utf-8')
-                    # ct = aesgcm.encrypt(nonce, key, None)
-                    # conn.sendall(nonce+ct)
-                    pubKey = RSA.importKey(message[3:])
-                    encryptor = PKCS1_v1_5.new(pubKey)
-                    encrypted = encryptor.encrypt(key)
-                    conn.sendall(encrypted)
-                else:
-                    self._thread_output.put(
-                        "Another user is connected - not generating key")
+    def _handle_connection(self, conn):
+        try:
+            message = self._receive(conn)
+            if message is None:
+                return
+            # Longest names first, so a name can start with another one
+            for name in sorted(self._handlers, key=len, reverse=True):
+                if message.startswith(name):
+                    with METRICS.histogram("server_request_seconds", "Time handling a request from the server",
+                                           {"request": name}).time():
+                        reply = self._handlers[name](message[len(name):])
+                    if reply is not None:
+                        conn.sendall(reply)
+                    break
             else:
                 self._thread_output.put("Unknown request from server")
+        except Exception as e:
+            self._thread_output.put("Error handling request : " + e.__class__.__name__)
+        finally:
             self._thread_output.put("Closing connection")
             conn.close()
-        self._thread_output.put("Exiting...")
-        s.close()
\ No newline at end of file
+            self._slots.release()
+
+    def _receive(self, conn):
+        """Reads until the data received opens with the server key, the peer
+        stops sending or the deadline passes. Returns the request or None.
+        """
+        deadline = time.time() + self._read_timeout
+        channel = self._server_channel()
+        data = bytearray()
+        while len(data) < self.MAX_REQUEST_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._thread_output.put("Timed out waiting for the request")
+                return None
+            conn.settimeout(remaining)
+            try:
+                chunk = conn.recv(4096)
+            except socket.timeout:
+                self._thread_output.put("Timed out waiting for the request")
+                return None
+            if not chunk:
+                break
+            data += chunk
+            try:
+                message = channel.open(data).decode()
+            except:
+                continue  # incomplete, or not authentic
+            self._thread_output.put(
+                "Data Received. IV: " + bytes(data[:12]).hex())
+            self._thread_output.put("Decoded message : " + message)
+            return message
+        self._thread_output.put("Authentication failed")
+        return None
+
+    def _request_key(self, body):
+        # Every user gets their own key, other users can stay connected
+        key = self._session_keys.issue()
+        self._thread_output.put("Generated new key")
+        return self._encryptor(body).encrypt(key)
+
+    def _request_ping(self, body):
+        return self._server_channel().seal(b"PONG")
+
+    def _request_status(self, body):
+        status = {"users": self._session_keys.in_use()}
+        if self._status is not None:
+            status.update(self._status())
+        return self._server_channel().seal(json.dumps(status, separators=(',', ':')).encode('utf-8'))
+
+    def _encryptor(self, public_key):
+        """PKCS1 v1.5 cipher for a public key, parsed once per key"""
+        fingerprint = hashlib.sha256(public_key.strip().encode('utf-8')).digest()
+        with self._encryptors_lock:
+            encryptor = self._encryptors.get(fingerprint)
+            if encryptor is not None:
+                self._encryptors.move_to_end(fingerprint)
+                return encryptor
+        encryptor = PKCS1_v1_5.new(RSA.importKey(public_key))
+        with self._encryptors_lock:
+            self._encryptors[fingerprint] = encryptor
+            while len(self._encryptors) > self.KEY_CACHE_SIZE:
+                self._encryptors.popitem(last=False)
+        return encryptor
@@ -0,0 +1,59 @@
+import secrets
+import threading
+import time
+
+
+class SessionKeys:
+    """Keys issued to users through the server's KEY exchange. A key is unclaimed
+    until a user connects and proves it has it, then it belongs to that
+    session until the session ends. Unclaimed keys expire after ttl seconds
+    and at most max_unclaimed of them are kept.
+    """
+
+    def __init__(self, ttl=300, max_unclaimed=16):
+        self._ttl = ttl
+        self._max_unclaimed = max_unclaimed
+        self._lock = threading.Lock()
+        self._unclaimed = []  # [key, time issued], oldest first
+        self._in_use = set()
+        self.latest = None
+
+    def issue(self):
+        """Generates a new key and returns it"""
+        key = secrets.token_bytes(16)
+        with self._lock:
+            self._expire()
+            self._unclaimed.append([key, time.time()])
+            del self._unclaimed[:-self._max_unclaimed]
+            self.latest = key
+        return key
+
+    def claim(self, check):
+        """Returns the first unclaimed key for which check(key) returns True and
+        marks it in use, or None if there is no such key
+        """
+        with self._lock:
+            self._expire()
+            candidates = [k[0] for k in self._unclaimed]
+        for key in reversed(candidates):
+            if check(key):
+                with self._lock:
+                    for k in self._unclaimed:
+                        if k[0] == key:
+                            self._unclaimed.remove(k)
+                            self._in_use.add(key)
+                            return key
+        return None
+
+    def release(self, key):
+        """Called when the session using a key ends. The key cannot be used again."""
+        with self._lock:
+            self._in_use.discard(key)
+
+    def in_use(self):
+        with self._lock:
+            return len(self._in_use)
+
+    def _expire(self):
+        now = time.time()
+        self._unclaimed = [k for k in self._unclaimed if now - k[1] < self._ttl]
@@ -0,0 +1,111 @@
+import os
+import random
+import threading
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from blebackend import SimulatedDevice
+from drivers import LED_UUID, LIGHT_UUID, SERVICE_UUID, SLEEP_UUID, TEMP_UUID
+
+
+class _SimulatedNode(SimulatedDevice):
+    """Simulated ESP32 node. Values on the characteristics are sealed with the
+    node's key like the firmware does : 12 byte nonce, then the AES-GCM
+    ciphertext of the text padded with zeros. With probability corrupt_rate a
+    value read is corrupted, to test the decrypt failures.
+    """
+
+    def __init__(self, addr, key, characteristics, corrupt_rate=0, **kwargs):
+        SimulatedDevice.__init__(self, addr, SERVICE_UUID,
+                                 {uuid: b"" for uuid in characteristics}, **kwargs)
+        self._aesgcm = AESGCM(key)
+        self.corrupt_rate = corrupt_rate
+        self._lock = threading.Lock()
+
+    def seal(self, text):
+        nonce = os.urandom(12)
+        sealed = bytearray(nonce + self._aesgcm.encrypt(
+            nonce, text.encode('utf-8').ljust(20, b'\x00'), None))
+        if self.corrupt_rate and random.random() < self.corrupt_rate:
+            sealed[-1] ^= 0xff
+        return bytes(sealed)
+
+    def open(self, value):
+        """Returns the text of a value written by the gateway"""
+        return self._aesgcm.decrypt(value[:12], value[12:], None).decode('utf-8').split(';')[0]
+
+
+class SimulatedS1(_SimulatedNode):
+    """Sensor node that wakes up every sleep_time seconds, advertises until the
+    gateway has connected and disconnected (or for awake_timeout seconds) and
+    goes back to deep sleep. Each light reading is a new value, so the time
+    it was read can be found again from the value in produced.
+    """
+
+    def __init__(self, addr, key, sleep_time=10, awake_timeout=10, wake_jitter=0, **kwargs):
+        _SimulatedNode.__init__(self, addr, key, [TEMP_UUID, LIGHT_UUID, SLEEP_UUID], **kwargs)
+        self.sleep_time = sleep_time
+        self.awake_timeout = awake_timeout
+        self.wake_jitter = wake_jitter
+        self._wake_at = time.time() + random.uniform(0, sleep_time)
+        self.light = random.randrange(4096)
+        self.produced = {}  # light value -> time it was read
+        self.wakes = 0
+
+    @property
+    def advertising(self):
+        now = time.time()
+        with self._lock:
+            if self.connections or now < self._wake_at:
+                return False
+            if now - self._wake_at > self.awake_timeout:
+                self._sleep(now)
+                return False
+            return True
+
+    @advertising.setter
+    def advertising(self, value):
+        pass  # decided by the sleep cycle
+
+    def _sleep(self, now):
+        self.wakes += 1
+        self._wake_at = now + self.sleep_time + random.uniform(-1, 1) * self.wake_jitter
+
+    def disconnected(self):
+        _SimulatedNode.disconnected(self)
+        with self._lock:
+            self._sleep(time.time())
+
+    def read(self, uuid):
+        if uuid == TEMP_UUID:
+            t = 20 + random.random() * 10
+            h = 40 + random.random() * 20
+            return self.seal("{:.1f};{:.1f};{:.1f};".format(t, h, t + 1))
+        if uuid == LIGHT_UUID:
+            with self._lock:
+                self.light = (self.light + 1) % 4096
+                self.produced[self.light] = time.time()
+                return self.seal("{};".format(self.light))
+        return self.seal("{:g};".format(self.sleep_time))
+
+    def write(self, uuid, value):
+        if uuid == SLEEP_UUID:
+            self.sleep_time = float(self.open(value))
+
+
+class SimulatedA1(_SimulatedNode):
+    """Actuator node that stays awake, with one LED value. The time each value
+    was applied is kept in applied.
+    """
+
+    def __init__(self, addr, key, **kwargs):
+        _SimulatedNode.__init__(self, addr, key, [LED_UUID], **kwargs)
+        self.led = "0"
+        self.applied = {}  # value -> time it was written
+
+    def read(self, uuid):
+        return self.seal(self.led + ";")
+
+    def write(self, uuid, value):
+        self.led = self.open(value)
+        self.applied[self.led] = time.time()
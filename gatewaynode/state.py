@@ -0,0 +1,132 @@
+import collections
+import copy
+import json
+import threading
+
+
+class StateStore:
+    """Gateway data with a version that increases with every change.
+    Published snapshots are never modified: writers copy the parts of the tree
+    they change (copy-on-write) and publish a new snapshot, so readers take the
+    current snapshot without locking and never block writers. The JSON
+    encoding of the snapshot is cached and only rebuilt after a change.
+    """
+
+    def __init__(self, data, history=256):
+        self._write_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+        self._current = (0, copy.deepcopy(data))  # (version, data)
+        self._encoded = (-1, None)
+        # Keys changed by the last versions, used to build deltas
+        self._changes = collections.deque(maxlen=history)  # (version, node id or None, field)
+        # Last version that added or removed nodes, deltas cannot go past it
+        self._structure_version = 0
+
+    @property
+    def version(self):
+        return self._current[0]
+
+    def snapshot(self):
+        """Returns (version, data). The data must not be modified."""
+        return self._current
+
+    def encoded(self):
+        """Returns (version, compact JSON of the data) for the current version"""
+        version, data = self._current
+        encoded = self._encoded
+        if encoded[0] == version:
+            return encoded
+        with self._encode_lock:
+            if self._encoded[0] != version:
+                self._encoded = (version, json.dumps(
+                    dict(data, version=version), separators=(',', ':')))
+            return self._encoded
+
+    def set_output_values(self, node_id, values):
+        """Sets the output values of a node. Returns (new version, new values)."""
+        with self._write_lock:
+            node = self._current[1]["nodes"][node_id]
+            if len(values) < len(node["output-values"]):
+                raise IndexError("Not enough output values")
+            new_values = list(values[:len(node["output-values"])])
+            return self._publish_node(node_id, "output-values", new_values)
+
+    def set_input_value(self, node_id, index, value):
+        """Sets one input value of a node. Returns (new version, new input values)."""
+        with self._write_lock:
+            new_values = list(
+                self._current[1]["nodes"][node_id]["input-values"])
+            new_values[index] = value
+            return self._publish_node(node_id, "input-values", new_values)
+
+    def set_option(self, name, value):
+        """Sets a gateway option. Returns (new version, new options)."""
+        with self._write_lock:
+            version, data = self._current
+            options = dict(data["options"])
+            options[name] = value
+            new_data = dict(data)
+            new_data["options"] = options
+            return self._publish(new_data, None, "options"), options
+
+    def add_node(self, node_id, node):
+        """Adds or replaces a node. Returns the new version."""
+        with self._write_lock:
+            data = self._current[1]
+            nodes = dict(data["nodes"])
+            nodes[node_id] = copy.deepcopy(node)
+            return self._publish_structure(dict(data, nodes=nodes))
+
+    def remove_node(self, node_id):
+        """Removes a node. Returns the new version."""
+        with self._write_lock:
+            data = self._current[1]
+            nodes = dict(data["nodes"])
+            nodes.pop(node_id, None)
+            return self._publish_structure(dict(data, nodes=nodes))
+
+    def delta_since(self, version):
+        """Returns (current version, updates) with the updates needed to go from
+        the given version to the current one, in the same format as the updates
+        sent to the user. Returns None if the version is too old, in which case
+        the full snapshot must be used.
+        """
+        current_version, data = self._current
+        changes = list(self._changes)
+        if version > current_version or version < self._structure_version:
+            return None
+        if version < current_version and (not changes or changes[0][0] > version + 1):
+            return None
+        keys = []
+        for v, node_id, field in changes:
+            if version < v <= current_version and (node_id, field) not in keys:
+                keys.append((node_id, field))
+        updates = []
+        for node_id, field in keys:
+            if node_id is None:
+                updates.append([field, data[field]])
+            else:
+                updates.append([node_id, field, data["nodes"][node_id][field]])
+        return current_version, updates
+
+    def _publish_node(self, node_id, field, values):
+        data = self._current[1]
+        node = dict(data["nodes"][node_id])
+        node[field] = values
+        nodes = dict(data["nodes"])
+        nodes[node_id] = node
+        new_data = dict(data)
+        new_data["nodes"] = nodes
+        return self._publish(new_data, node_id, field), values
+
+    def _publish_structure(self, new_data):
+        version = self._current[0] + 1
+        self._structure_version = version
+        self._current = (version, new_data)
+        return version
+
+    def _publish(self, new_data, node_id, field):
+        version = self._current[0] + 1
+        self._changes.append((version, node_id, field))
+        self._current = (version, new_data)
+        return version
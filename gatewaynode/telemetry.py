@@ -0,0 +1,144 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS telemetry (time REAL, node TEXT, field TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS telemetry_time ON telemetry (time);
+CREATE TABLE IF NOT EXISTS latest (node TEXT, field TEXT, data TEXT, PRIMARY KEY (node, field));
+CREATE TABLE IF NOT EXISTS options (name TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _connect(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(_SCHEMA)
+    return db
+
+
+class TelemetryLog(threading.Thread):
+    """Thread that writes every reading, value read back after a command and
+    option change to a SQLite database. Records are queued by the other
+    threads and written in batches, one transaction per batch, so the SD card
+    sees one write every flush_interval seconds instead of one per sample.
+    """
+
+    def __init__(self, exit_event, thread_output, path, batch_size=200, flush_interval=10,
+                 retention_days=30):
+        threading.Thread.__init__(self)
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._path = path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._retention = retention_days * 86400
+        self._records = queue.Queue()
+
+    def record(self, t, node_id, field, values):
+        """Queues the new values of a field of a node"""
+        self._records.put(("data", t, node_id, field, values))
+
+    def record_option(self, name, value):
+        self._records.put(("option", name, value))
+
+    def run(self):
+        try:
+            db = _connect(self._path)
+        except Exception as e:
+            self._thread_output.put("Error opening telemetry database.")
+            self._thread_output.put(e.__class__.__name__)
+            return
+        self._thread_output.put("Telemetry log started")
+        last_prune = 0
+        while True:
+            # Collect records until the batch is full or it is time to flush
+            batch = []
+            deadline = time.time() + self._flush_interval
+            while len(batch) < self._batch_size and time.time() < deadline:
+                if self._exit_event.is_set():
+                    break
+                try:
+                    batch.append(self._records.get(
+                        timeout=min(1, max(0.01, deadline - time.time()))))
+                except queue.Empty:
+                    pass
+            exiting = self._exit_event.is_set()
+            if exiting:
+                while True:
+                    try:
+                        batch.append(self._records.get_nowait())
+                    except queue.Empty:
+                        break
+            if batch:
+                try:
+                    self._write(db, batch)
+                except sqlite3.Error as e:
+                    self._thread_output.put(
+                        "Error writing telemetry : " + e.__class__.__name__)
+            if time.time() - last_prune > 3600:
+                last_prune = time.time()
+                try:
+                    with db:
+                        db.execute("DELETE FROM telemetry WHERE time < ?",
+                                   (time.time() - self._retention,))
+                except sqlite3.Error:
+                    pass
+            if exiting:
+                break
+        db.close()
+
+    def _write(self, db, batch):
+        rows, latest, options = [], {}, {}
+        for r in batch:
+            if r[0] == "data":
+                data = json.dumps(r[4], separators=(',', ':'))
+                rows.append((r[1], r[2], r[3], data))
+                latest[(r[2], r[3])] = data
+            else:
+                options[r[1]] = json.dumps(r[2])
+        with db:
+            db.executemany("INSERT INTO telemetry VALUES (?, ?, ?, ?)", rows)
+            db.executemany("INSERT OR REPLACE INTO latest VALUES (?, ?, ?)",
+                           [(k[0], k[1], v) for k, v in latest.items()])
+            db.executemany("INSERT OR REPLACE INTO options VALUES (?, ?)",
+                           list(options.items()))
+
+
+def restore_state(path, gateway_data, history=None, history_since=None):
+    """Puts the last known values and options from the telemetry database in the
+    gateway data. Values are only restored for nodes that still exist with
+    the same number of values. If a history is given, the readings since
+    history_since are added to it. Returns the number of fields restored.
+    """
+    if not os.path.exists(path):
+        return 0
+    restored = 0
+    db = sqlite3.connect(path)
+    try:
+        for node_id, field, data in db.execute("SELECT node, field, data FROM latest"):
+            node = gateway_data["nodes"].get(node_id)
+            values = json.loads(data)
+            if node is not None and field in node and len(node[field]) == len(values):
+                node[field] = values
+                restored += 1
+        for name, value in db.execute("SELECT name, value FROM options"):
+            if name in gateway_data["options"]:
+                gateway_data["options"][name] = json.loads(value)
+                restored += 1
+        if history is not None and history_since is not None:
+            for t, node_id, data in db.execute(
+                    "SELECT time, node, data FROM telemetry WHERE field = 'output-values' AND time >= ? "
+                    "ORDER BY time", (history_since,)):
+                history.add_values(node_id, t, json.loads(data))
+    except sqlite3.Error:
+        pass
+    finally:
+        db.close()
+    return restored
@@ -0,0 +1,83 @@
+import queue
+import threading
+import time
+import unittest
+
+from adapters import AdapterManager
+from blebackend import SimulatedBackend, SimulatedDevice
+
+ADDR = "02:00:00:00:00:01"
+
+
+def _wait(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class AdapterManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.exit_event = threading.Event()
+        self.output = queue.Queue()
+        self.backend = SimulatedBackend(ifaces=(0, 1), connect_time=0)
+        self.backend.add_device(SimulatedDevice(ADDR, "service", {}))
+
+    def manager(self, **kwargs):
+        return AdapterManager(self.exit_event, self.output, {ADDR}, self.backend,
+                              ifaces=(0, 1), **kwargs)
+
+    def test_connections_spread_over_adapters(self):
+        adapters = self.manager(max_connections=1)
+        self.assertEqual(adapters.capacity, 2)
+        iface = adapters.assign("a")
+        self.assertEqual(adapters.assign("b"), 1 - iface)
+        self.assertIsNone(adapters.assign("c"))
+        adapters.release("a", iface)
+        self.assertEqual(adapters.assign("c"), iface)
+
+    def test_failed_node_tries_other_adapter_first(self):
+        adapters = self.manager()
+        iface = adapters.assign(ADDR)
+        adapters.release(ADDR, iface)
+        adapters.connect_failed(iface, ADDR)
+        self.assertEqual(adapters.assign(ADDR), 1 - iface)
+
+    def test_adapter_taken_out_after_failures(self):
+        adapters = self.manager(failures_to_drop=2, retry_after=0.2)
+        self.assertFalse(adapters.connect_failed(0, "a"))
+        # The same node failing again does not count twice
+        self.assertFalse(adapters.connect_failed(0, "a"))
+        self.assertTrue(adapters.connect_failed(0, "b"))
+        self.assertTrue(adapters.is_down(0))
+        self.assertEqual([adapters.assign(addr) for addr in "cd"], [1, 1])
+        time.sleep(0.3)
+        self.assertFalse(adapters.is_down(0))
+
+    def test_scan_moves_to_working_adapter(self):
+        adapters = self.manager(scan_iface=0, retry_after=60)
+        adapters.start()
+        try:
+            self.assertTrue(_wait(lambda: ADDR in adapters.present()))
+            self.backend.set_down(0)
+            self.assertTrue(_wait(lambda: adapters._scanners[0].failed.is_set()))
+            self.assertFalse(adapters.failed())
+            self.assertTrue(adapters.is_down(0))
+            self.assertEqual([s.iface for s in adapters._scanners], [1])
+            adapters.advertisement.clear()
+            self.assertTrue(adapters.advertisement.wait(5))
+            self.assertEqual(adapters.assign(ADDR), 1)
+
+            self.backend.set_down(1)
+            self.assertTrue(_wait(lambda: adapters._scanners[0].failed.is_set()))
+            self.assertTrue(adapters.failed())
+        finally:
+            self.exit_event.set()
+            adapters.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import json
+import unittest
+import zlib
+
+import codec
+
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = codec.intern_table({"nodes": {"1": {}, "2": {}}})
+        self.index = {node_id: i for i, node_id in enumerate(self.table["nodes"])}
+
+    def test_updates_round_trip(self):
+        updates = [["1", "output-values", ["20.5", "40", "21.5", "1000"]],
+                   ["2", "input-values", ["on", ""]],
+                   ["1", "input-values", []]]
+        frame = codec.pack_updates(updates, self.index)
+        self.assertEqual(frame[0], codec.FRAME_UPDATES)
+        self.assertEqual(codec.unpack_updates(frame, self.table["nodes"]),
+                         [["1", "output-values", [20.5, 40.0, 21.5, 1000.0]],
+                          ["2", "input-values", ["on", ""]],
+                          ["1", "input-values", []]])
+
+    def test_numbers_out_of_float_range_are_strings(self):
+        frame = codec.pack_updates([["1", "output-values", ["1e39", "nan", "x" * 300]]], self.index)
+        values = codec.unpack_updates(frame, self.table["nodes"])[0][2]
+        self.assertEqual(values[0], "1e39")
+        self.assertNotEqual(values[1], values[1])
+        self.assertEqual(values[2], "x" * 255)
+
+    def test_can_pack(self):
+        self.assertTrue(codec.can_pack(["1", "output-values", ["1"]], self.index))
+        self.assertFalse(codec.can_pack(["3", "output-values", ["1"]], self.index))
+        self.assertFalse(codec.can_pack(["1", "options", ["1"]], self.index))
+        self.assertFalse(codec.can_pack(["1", "output-values", ["1"] * 256], self.index))
+        self.assertFalse(codec.can_pack(["version", 1], self.index))
+
+    def test_json_frames(self):
+        encoded = json.dumps({"nodes": {}}).encode('utf-8')
+        self.assertEqual(codec.json_frame(encoded), b"\x00" + encoded)
+        frame = codec.json_frame(encoded, compress=True)
+        self.assertEqual(frame[0], codec.FRAME_JSON_COMPRESSED)
+        self.assertEqual(zlib.decompress(frame[1:]), encoded)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from framing import FrameDecoder, encode_frame, frame_header
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_frame_fed_one_byte_at_a_time(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b"hello")
+        frames = []
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+            if i < len(data) - 1:
+                self.assertEqual(frames, [])
+        self.assertEqual(frames, [b"hello"])
+
+    def test_several_frames_in_one_chunk(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b"a") + encode_frame(b"") + encode_frame(b"bc")
+        self.assertEqual(decoder.feed(data + encode_frame(b"def")[:5]), [b"a", b"", b"bc"])
+        self.assertEqual(decoder.feed(b"ef"), [b"def"])
+
+    def test_header_split_across_chunks(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b"xyz")
+        self.assertEqual(decoder.feed(data[:2]), [])
+        self.assertEqual(decoder.feed(data[2:]), [b"xyz"])
+
+    def test_frame_header_matches_encode_frame(self):
+        self.assertEqual(frame_header(3) + b"abc", encode_frame(b"abc"))
+
+    def test_frame_too_large(self):
+        decoder = FrameDecoder(max_frame_size=4)
+        with self.assertRaises(ValueError):
+            decoder.feed(encode_frame(b"12345"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import unittest
+
+from history import History, RingBuffer, downsample
+
+RETENTION = {"raw": 100, "minute": 100, "hour": 100}
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_oldest_samples_are_overwritten(self):
+        ring = RingBuffer(3)
+        for t in range(5):
+            ring.append(t, t * 10)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.first_time(), 2)
+        self.assertEqual(ring.range(0, 10), [(2, 20), (3, 30), (4, 40)])
+        self.assertEqual(ring.range(2.5, 3), [(3, 30)])
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_minute_averages(self):
+        history = History(RETENTION)
+        for t in range(0, 180, 10):
+            history.add_values("1", t, [str(t), "x"])
+        self.assertEqual(history.query("1", 1, 0, 200, 100), [])
+        raw = history.query("1", 0, 0, 200, 100)
+        self.assertEqual(raw[0], (0, 0))
+        self.assertEqual(len(raw), 18)
+        series = history._series[("1", 0)]
+        # The last minute is still being averaged
+        self.assertEqual(series._tiers[1][2].range(0, 200), [(0, 25), (60, 85)])
+
+    def test_older_range_comes_from_coarser_tier(self):
+        history = History({"raw": 6, "minute": 100, "hour": 100})
+        for t in range(0, 240, 10):
+            history.add_values("1", t, [t])
+        # Raw samples only go back to 180, earlier minutes are averages
+        samples = history.query("1", 0, 0, 240, 100)
+        self.assertEqual(samples, [(0, 25), (60, 85), (120, 145),
+                                   (180, 180), (190, 190), (200, 200), (210, 210),
+                                   (220, 220), (230, 230)])
+
+    def test_values_that_are_not_finite_are_skipped(self):
+        history = History(RETENTION)
+        for t, value in enumerate(["1", "nan", "inf", "-inf", "3"]):
+            history.add_values("1", t, [value])
+        history.add_values("1", 61, ["5"])
+        samples = history.query("1", 0, 0, 100, 100)
+        self.assertEqual(samples, [(0, 1), (4, 3), (61, 5)])
+        self.assertEqual(history._series[("1", 0)]._tiers[1][2].range(0, 100), [(0, 2)])
+        json.loads(json.dumps(samples, allow_nan=False))
+
+    def test_downsample(self):
+        samples = [(t, t) for t in range(10)]
+        self.assertEqual(downsample(samples, 0, 10, 20), samples)
+        self.assertEqual(downsample(samples, 0, 10, 2), [(2, 2), (7, 7)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+from outbox import ACKNOWLEDGED, IN_FLIGHT, PENDING, Outbox
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_newer_value_replaces_pending_one(self):
+        outbox = Outbox()
+        outbox.put("2", 0, "1")
+        outbox.put("2", 0, "2")
+        outbox.put("2", 1, "3")
+        self.assertEqual(outbox.coalesced, 1)
+        taken = outbox.take("2")
+        self.assertEqual(sorted((c["index"], c["data"]) for c in taken), [(0, "2"), (1, "3")])
+        self.assertEqual(outbox.state("2", 0), IN_FLIGHT)
+        self.assertFalse(outbox.has_pending("2"))
+
+    def test_acknowledged_value_is_not_coalesced(self):
+        outbox = Outbox()
+        outbox.put("2", 0, "1")
+        c, = outbox.take("2")
+        outbox.acknowledge(c, "1")
+        self.assertEqual(outbox.state("2", 0), ACKNOWLEDGED)
+        outbox.put("2", 0, "2")
+        self.assertEqual(outbox.coalesced, 0)
+        self.assertEqual(outbox.state("2", 0), PENDING)
+
+    def test_failed_command_replaced_meanwhile_is_ignored(self):
+        outbox = Outbox()
+        outbox.put("2", 0, "1")
+        c, = outbox.take("2")
+        outbox.put("2", 0, "2")
+        self.assertFalse(outbox.failed(c))
+        c, = outbox.take("2")
+        self.assertEqual(c["data"], "2")
+        self.assertEqual(c["attempts"], 0)
+
+    def test_failed_command_is_retried_with_backoff(self):
+        outbox = Outbox(max_attempts=5, retry_delay=1, max_retry_delay=3)
+        t = 100
+        with mock.patch("outbox.time.time", return_value=t):
+            outbox.put("2", 0, "1")
+        # Due again 1, 2 then 3 seconds after each failure
+        for delay in (1, 2, 3, 3):
+            with mock.patch("outbox.time.time", return_value=t):
+                c, = outbox.take("2")
+                self.assertFalse(outbox.failed(c))
+            with mock.patch("outbox.time.time", return_value=t + delay - 0.5):
+                self.assertFalse(outbox.has_pending("2"))
+                self.assertEqual(outbox.take("2"), [])
+            t += delay
+            with mock.patch("outbox.time.time", return_value=t):
+                self.assertTrue(outbox.has_pending("2"))
+
+    def test_retry_now_skips_the_delay(self):
+        outbox = Outbox(retry_delay=60)
+        outbox.put("2", 0, "1")
+        c, = outbox.take("2")
+        self.assertFalse(outbox.failed(c, retry_now=True))
+        c, = outbox.take("2")
+        self.assertEqual(c["attempts"], 1)
+
+    def test_command_is_dropped_after_max_attempts(self):
+        outbox = Outbox(max_attempts=3, retry_delay=0)
+        outbox.put("2", 0, "1")
+        results = []
+        for _ in range(3):
+            c, = outbox.take("2")
+            results.append(outbox.failed(c))
+        self.assertEqual(results, [False, False, True])
+        self.assertIsNone(outbox.state("2", 0))
+        self.assertFalse(outbox.has_pending("2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+
+from outqueue import DROP_OLDEST, RESYNC, CollapsingBuffer, update_key
+
+
+class CollapsingBufferTest(unittest.TestCase):
+
+    def test_same_key_keeps_place_with_newest_value(self):
+        async def run():
+            buffer = CollapsingBuffer(high_water=10)
+            buffer.put(("1", "output-values"), "a")
+            buffer.put(("2", "output-values"), "b")
+            buffer.put(("1", "output-values"), "c")
+            buffer.put(None, "d")
+            buffer.put(None, "e")
+            return buffer, await buffer.get_all()
+        buffer, items = asyncio.run(run())
+        self.assertEqual(items, ["c", "b", "d", "e"])
+        self.assertEqual(buffer.collapsed, 1)
+
+    def test_drop_oldest(self):
+        async def run():
+            buffer = CollapsingBuffer(high_water=3, policy=DROP_OLDEST)
+            for i in range(5):
+                buffer.put(("node", i), i)
+            return buffer, await buffer.get_all()
+        buffer, items = asyncio.run(run())
+        self.assertEqual(items, [2, 3, 4])
+        self.assertEqual(buffer.dropped, 2)
+        self.assertFalse(buffer.needs_resync)
+
+    def test_resync_keeps_replies_to_the_session(self):
+        async def run():
+            buffer = CollapsingBuffer(high_water=3, policy=RESYNC)
+            buffer.put(None, "history", reply=True)
+            for i in range(3):
+                buffer.put(("node", i), i)
+            return buffer, await buffer.get_all()
+        buffer, items = asyncio.run(run())
+        self.assertTrue(buffer.needs_resync)
+        self.assertEqual(items, ["history"])
+        self.assertEqual(buffer.dropped, 3)
+
+    def test_get_all_waits_for_items_and_returns_none_once_closed(self):
+        async def run():
+            buffer = CollapsingBuffer()
+            getter = asyncio.ensure_future(buffer.get_all())
+            await asyncio.sleep(0)
+            self.assertFalse(getter.done())
+            buffer.put(None, "a")
+            items = await getter
+            buffer.close()
+            return items, await buffer.get_all()
+        self.assertEqual(asyncio.run(run()), (["a"], None))
+
+
+class UpdateKeyTest(unittest.TestCase):
+
+    def test_keys(self):
+        self.assertEqual(update_key(["1", "output-values", ["2"]]), ("1", "output-values"))
+        self.assertEqual(update_key(["options", {}]), ("options",))
+        self.assertEqual(update_key(["version", 3]), ("version",))
+        self.assertIsNone(update_key(["history", "1", 0, []]))
+        self.assertIsNone(update_key('{"nodes":{}}'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from rules import Rule, RulesEngine
+
+OPTION = "Automatic Light Control"
+
+
+def _rule(**config):
+    rule = {"name": "light", "trigger": {"node": "1", "index": 3},
+            "conditions": [{"option": OPTION, "equals": True}],
+            "transform": [{"scale": -1}, {"offset": 4095}, {"clamp": [0, 4095]}, {"round": 0}],
+            "target": {"node": "2", "index": 0}}
+    rule.update(config)
+    return Rule(rule)
+
+
+class RuleTest(unittest.TestCase):
+
+    def test_transforms_and_conditions(self):
+        engine = RulesEngine([_rule()])
+        options = {OPTION: True}
+        actions = engine.evaluate("1", "output-values", ["20", "50", "21", "95"], options, 0)
+        self.assertEqual([a[1:] for a in actions], [("2", 0, "4000")])
+        self.assertEqual(engine.evaluate("1", "output-values", ["0", "0", "0", "5000"], {}, 1), [])
+        self.assertEqual(engine.evaluate("1", "input-values", ["0"], options, 2), [])
+
+    def test_hysteresis(self):
+        rule = _rule(transform=[], hysteresis=10)
+        self.assertEqual(rule.evaluate(["0", "0", "0", "100"], {OPTION: True}, 0), 100)
+        self.assertIsNone(rule.evaluate(["0", "0", "0", "105"], {OPTION: True}, 1))
+        self.assertEqual(rule.evaluate(["0", "0", "0", "111"], {OPTION: True}, 2), 111)
+
+    def test_debounce_and_min_interval(self):
+        rule = _rule(transform=[], conditions=[], debounce=2, min_interval=5)
+        self.assertIsNone(rule.evaluate(["0", "0", "0", "100"], {}, 0))
+        self.assertEqual(rule.evaluate(["0", "0", "0", "100"], {}, 2), 100)
+        self.assertIsNone(rule.evaluate(["0", "0", "0", "200"], {}, 3))
+        self.assertIsNone(rule.evaluate(["0", "0", "0", "200"], {}, 6))
+        self.assertEqual(rule.evaluate(["0", "0", "0", "200"], {}, 7), 200)
+
+    def test_values_that_are_not_finite(self):
+        rule = _rule(conditions=[{"below": 10}])
+        for value in ("nan", "inf", "-inf", "x"):
+            self.assertIsNone(rule.evaluate(["0", "0", "0", value], {}, 0))
+        rule = _rule(conditions=[], transform=[{"scale": 1e308}])
+        self.assertIsNone(rule.evaluate(["0", "0", "0", "10"], {}, 0))
+
+    def test_unknown_transform(self):
+        with self.assertRaises(ValueError):
+            _rule(transform=[{"log": 2}])
+
+
+if __name__ == "__main__":
+    unittest.main()
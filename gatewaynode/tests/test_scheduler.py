@@ -0,0 +1,58 @@
+import unittest
+
+from scheduler import WakeScheduler
+
+ADDR = "02:00:00:00:00:01"
+
+
+class WakeSchedulerTest(unittest.TestCase):
+
+    def test_window_after_session(self):
+        scheduler = WakeScheduler(margin=2)
+        scheduler.set_sleep_time(ADDR, 10)
+        self.assertIsNone(scheduler.window(ADDR))
+        scheduler.woke(ADDR, 100)
+        self.assertIsNone(scheduler.window(ADDR))
+        scheduler.session_ended(ADDR, 101)
+        # No prediction error known yet, the window is three margins wide
+        self.assertEqual(scheduler.window(ADDR), (105, 117))
+        self.assertFalse(scheduler.scan_needed([ADDR], now=104))
+        self.assertTrue(scheduler.scan_needed([ADDR], now=105))
+        self.assertTrue(scheduler.scan_needed([ADDR], now=200))
+        self.assertEqual(scheduler.next_wake([ADDR]), 105)
+
+    def test_sleep_time_learned_from_wakes(self):
+        scheduler = WakeScheduler(margin=1, alpha=0.5)
+        scheduler.set_sleep_time(ADDR, 10)
+        scheduler.session_ended(ADDR, 0)
+        t = 0
+        for _ in range(10):
+            t += 12
+            scheduler.woke(ADDR, t)
+            scheduler.session_ended(ADDR, t)
+        start, end = scheduler.window(ADDR)
+        self.assertAlmostEqual((start + end) / 2 - t, 12, places=1)
+
+    def test_missed_wakes_are_outliers(self):
+        scheduler = WakeScheduler(margin=1)
+        scheduler.set_sleep_time(ADDR, 10)
+        scheduler.session_ended(ADDR, 0)
+        scheduler.woke(ADDR, 30)
+        scheduler.session_ended(ADDR, 30)
+        self.assertEqual(scheduler.window(ADDR), (37, 43))
+
+    def test_stale_wake_is_ignored(self):
+        scheduler = WakeScheduler(margin=1)
+        scheduler.set_sleep_time(ADDR, 10)
+        scheduler.session_ended(ADDR, 50)
+        scheduler.woke(ADDR, 49)
+        self.assertEqual(scheduler.window(ADDR), (57, 63))
+
+    def test_unknown_node_needs_scan(self):
+        scheduler = WakeScheduler()
+        self.assertTrue(scheduler.scan_needed([ADDR]))
+        self.assertIsNone(scheduler.next_wake([ADDR]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from framing import FrameDecoder
+
+try:
+    import securechannel
+    from securechannel import NONCE_SIZE, SecureChannel
+except ImportError:  # cryptography is not installed
+    securechannel = None
+
+KEY = b"0123456789abcdef"
+
+
+@unittest.skipIf(securechannel is None, "cryptography is not installed")
+class SecureChannelTest(unittest.TestCase):
+
+    def test_seal_and_open(self):
+        channel = SecureChannel(KEY)
+        sealed = channel.seal(b"hello")
+        self.assertIsInstance(sealed, bytearray)
+        self.assertEqual(SecureChannel(KEY).open(sealed), b"hello")
+        self.assertEqual(SecureChannel(KEY).open(memoryview(bytes(sealed))), b"hello")
+        with self.assertRaises(Exception):
+            SecureChannel(b"fedcba9876543210").open(sealed)
+        sealed[-1] ^= 1
+        with self.assertRaises(Exception):
+            SecureChannel(KEY).open(sealed)
+        with self.assertRaises(ValueError):
+            SecureChannel(KEY).open(b"short")
+
+    def test_nonces_are_prefix_and_counter(self):
+        channel = SecureChannel(KEY)
+        nonces = [bytes(channel.seal(b"x")[:NONCE_SIZE]) for _ in range(3)]
+        self.assertEqual(len({n[:8] for n in nonces}), 1)
+        self.assertEqual([int.from_bytes(n[8:], "big") for n in nonces], [1, 2, 3])
+        # The prefix is drawn again when the counter wraps
+        channel._counter = (1 << 32) - 1
+        nonce = bytes(channel.seal(b"x")[:NONCE_SIZE])
+        self.assertNotEqual(nonce[:8], nonces[0][:8])
+        self.assertEqual(int.from_bytes(nonce[8:], "big"), 1)
+        self.assertNotEqual(SecureChannel(KEY).seal(b"x")[:8], nonces[0][:8])
+
+    def test_replay_window(self):
+        sender = SecureChannel(KEY)
+        messages = [sender.seal(str(i).encode()) for i in range(3)]
+        receiver = SecureChannel(KEY, replay_window=2)
+        for message in messages:
+            receiver.open(message)
+        with self.assertRaises(ValueError):
+            receiver.open(messages[2])
+        with self.assertRaises(ValueError):
+            receiver.open(messages[1])
+        # Only the nonces of the last replay_window messages are kept
+        self.assertEqual(receiver.open(messages[0]), b"0")
+        # Without a window, the same message opens again
+        channel = SecureChannel(KEY)
+        self.assertEqual(channel.open(messages[0]), channel.open(messages[0]))
+
+    def test_inauthentic_message_does_not_fill_window(self):
+        message = SecureChannel(KEY).seal(b"x")
+        forged = bytearray(message)
+        forged[-1] ^= 1
+        receiver = SecureChannel(KEY, replay_window=4)
+        with self.assertRaises(Exception):
+            receiver.open(forged)
+        self.assertEqual(receiver.open(message), b"x")
+
+    def test_sealed_frames(self):
+        channel = SecureChannel(KEY)
+        data = channel.seal_frames([b"a", b"bc"]) + channel.seal_frame(b"def")
+        frames = FrameDecoder().feed(data)
+        self.assertEqual([SecureChannel(KEY).open(f) for f in frames], [b"a", b"bc", b"def"])
+
+    def test_cipher_cache(self):
+        c = securechannel.cipher(KEY)
+        self.assertIs(securechannel.cipher(KEY), c)
+        securechannel.forget(KEY)
+        self.assertIsNot(securechannel.cipher(KEY), c)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import json
+import queue
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    import servertcp
+    from securechannel import SecureChannel
+    from servertcp import ServerThread
+except ImportError:  # cryptography or pycryptodome is not installed
+    servertcp = None
+
+from sessionkeys import SessionKeys
+
+KEY = b"0123456789abcdef"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@unittest.skipIf(servertcp is None, "cryptography or pycryptodome is not installed")
+class ReceiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerThread(threading.Event(), queue.Queue(), 0, [KEY], SessionKeys(),
+                                   replay_window=16, read_timeout=0.5)
+        self.conn, self.peer = socket.socketpair()
+
+    def tearDown(self):
+        self.conn.close()
+        self.peer.close()
+
+    def test_request_in_several_chunks(self):
+        request = SecureChannel(KEY).seal(b"PING")
+        self.peer.sendall(request[:5])
+        threading.Timer(0.1, self.peer.sendall, [request[5:]]).start()
+        self.assertEqual(self.server._receive(self.conn), "PING")
+
+    def test_deadline(self):
+        self.peer.sendall(b"partial")
+        start = time.time()
+        self.assertIsNone(self.server._receive(self.conn))
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_wrong_key(self):
+        self.peer.sendall(SecureChannel(b"fedcba9876543210").seal(b"PING"))
+        self.peer.shutdown(socket.SHUT_WR)
+        self.assertIsNone(self.server._receive(self.conn))
+
+    def test_replayed_request(self):
+        request = SecureChannel(KEY).seal(b"STATUS")
+        self.peer.sendall(request)
+        self.assertEqual(self.server._receive(self.conn), "STATUS")
+        self.peer.sendall(request)
+        self.peer.shutdown(socket.SHUT_WR)
+        self.assertIsNone(self.server._receive(self.conn))
+
+
+@unittest.skipIf(servertcp is None, "cryptography or pycryptodome is not installed")
+class ServerThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = _free_port()
+        self.exit_event = threading.Event()
+        self.keys = SessionKeys()
+        self.server = ServerThread(self.exit_event, queue.Queue(), self.port, [KEY], self.keys,
+                                   status=lambda: {"nodes": 2})
+        self.server.start()
+
+    def tearDown(self):
+        self.exit_event.set()
+        self.server.join(10)
+
+    def request(self, message):
+        deadline = time.time() + 5
+        while True:
+            try:
+                conn = socket.create_connection(("127.0.0.1", self.port))
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        with conn:
+            conn.sendall(SecureChannel(KEY).seal(message))
+            reply = b""
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return reply
+                reply += data
+
+    def test_ping_and_status(self):
+        self.assertEqual(SecureChannel(KEY).open(self.request(b"PING")), b"PONG")
+        status = json.loads(SecureChannel(KEY).open(self.request(b"STATUS")))
+        self.assertEqual(status, {"users": 0, "nodes": 2})
+
+    def test_added_handler(self):
+        self.server.add_handler("PINGX", lambda body: b"longest name first " + body.encode())
+        self.assertEqual(self.request(b"PINGX1"), b"longest name first 1")
+
+    def test_key_exchange_parses_each_public_key_once(self):
+        with mock.patch.object(servertcp.RSA, "importKey", side_effect=lambda k: k) as import_key, \
+                mock.patch.object(servertcp.PKCS1_v1_5, "new") as new:
+            new.return_value.encrypt.side_effect = lambda key: b"RSA" + key
+            first = self.request(b"KEY-----PUBLIC KEY 1-----")
+            second = self.request(b"KEY-----PUBLIC KEY 1-----\n")
+            self.request(b"KEY-----PUBLIC KEY 2-----")
+        self.assertEqual(import_key.call_count, 2)
+        self.assertTrue(first.startswith(b"RSA"))
+        self.assertEqual(len(first), 3 + 16)
+        self.assertNotEqual(first, second)
+
+    def test_key_cache_is_bounded(self):
+        with mock.patch.object(servertcp.RSA, "importKey", side_effect=lambda k: k) as import_key, \
+                mock.patch.object(servertcp.PKCS1_v1_5, "new"):
+            for i in range(ServerThread.KEY_CACHE_SIZE + 1):
+                self.server._encryptor("key {}".format(i))
+            self.server._encryptor("key {}".format(ServerThread.KEY_CACHE_SIZE))
+            self.assertEqual(import_key.call_count, ServerThread.KEY_CACHE_SIZE + 1)
+            self.server._encryptor("key 0")
+            self.assertEqual(import_key.call_count, ServerThread.KEY_CACHE_SIZE + 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+
+from blebackend import SimulatedBackend
+from registry import PeripheralRegistry
+
+try:
+    from ble import BleThread
+    from simulator import SimulatedA1, SimulatedS1
+except ImportError:  # cryptography is not installed
+    BleThread = None
+
+SENSOR = "02:00:00:00:00:01"
+ACTUATOR = "02:00:00:00:00:02"
+SENSOR_KEY = b"abcdefghijklmnop"
+ACTUATOR_KEY = b"ponmlkjihgfedcba"
+
+
+@unittest.skipIf(BleThread is None, "cryptography is not installed")
+class SimulatedGatewayTest(unittest.TestCase):
+    """Runs the BLE thread against simulated nodes on two adapters and takes
+    one adapter down while it runs
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.backend = SimulatedBackend(ifaces=(0, 1), connect_time=0.01)
+        self.sensor = SimulatedS1(SENSOR, SENSOR_KEY, sleep_time=0.5, awake_timeout=2)
+        self.actuator = SimulatedA1(ACTUATOR, ACTUATOR_KEY)
+        self.backend.add_device(self.sensor)
+        self.backend.add_device(self.actuator)
+        registry = PeripheralRegistry(os.path.join(self.work_dir.name, "peripherals.json"))
+        registry.add({"addr": SENSOR, "id": "1", "type": "s1", "key": SENSOR_KEY.decode()})
+        registry.add({"addr": ACTUATOR, "id": "2", "type": "a1", "key": ACTUATOR_KEY.decode()})
+        self.exit_event = threading.Event()
+        self.output = queue.Queue()
+        self.to_peripherals = queue.Queue()
+        self.from_peripherals = queue.Queue()
+        self.thread = BleThread(
+            self.exit_event, self.output, registry, self.to_peripherals, self.from_peripherals,
+            handle_cache_file=os.path.join(self.work_dir.name, "gatt_handles.json"),
+            backend=self.backend, ifaces=(0, 1))
+        self.thread.start()
+
+    def tearDown(self):
+        self.exit_event.set()
+        self.thread.join(30)
+        self.work_dir.cleanup()
+
+    def reading(self, timeout=10):
+        """Next sensor reading sent by the thread"""
+        deadline = time.time() + timeout
+        while True:
+            item = self.from_peripherals.get(timeout=max(0, deadline - time.time()))
+            if item["id"] == "1" and item["field"] == "output-values":
+                return item
+
+    def test_readings_and_commands_survive_adapter_down(self):
+        first = self.reading()
+        self.assertEqual(len(first["data"].split(";")), 5)
+
+        self.backend.set_down(0)
+        self.to_peripherals.put(["2", 0, "42"])
+        deadline = time.time() + 10
+        while "42" not in self.actuator.applied and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertIn("42", self.actuator.applied)
+        self.assertTrue(self.thread._adapters.is_down(0))
+
+        # Sessions keep going on the adapter left
+        wakes = self.sensor.wakes
+        self.reading()
+        self.reading()
+        self.assertGreater(self.sensor.wakes, wakes)
+        self.assertFalse(self.backend.is_down(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
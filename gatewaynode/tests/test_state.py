@@ -0,0 +1,56 @@
+import unittest
+
+from state import StateStore
+
+
+def _data():
+    return {"nodes": {"1": {"output-values": ["0", "0"], "input-values": ["10"]},
+                      "2": {"output-values": [], "input-values": ["0"]}},
+            "options": {"Automatic Light Control": False}}
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def test_setters_return_the_new_version(self):
+        state = StateStore(_data())
+        self.assertEqual(state.set_output_values("1", ["1", "2", "3"]), (1, ["1", "2"]))
+        self.assertEqual(state.set_input_value("2", 0, "5"), (2, ["5"]))
+        version, options = state.set_option("Automatic Light Control", True)
+        self.assertEqual(version, 3)
+        self.assertEqual(options, {"Automatic Light Control": True})
+        self.assertEqual(state.version, 3)
+
+    def test_snapshots_are_not_modified(self):
+        state = StateStore(_data())
+        version, data = state.snapshot()
+        state.set_output_values("1", ["1", "2"])
+        self.assertEqual(data["nodes"]["1"]["output-values"], ["0", "0"])
+        self.assertEqual(state.snapshot()[1]["nodes"]["1"]["output-values"], ["1", "2"])
+
+    def test_delta_since(self):
+        state = StateStore(_data())
+        state.set_output_values("1", ["1", "1"])
+        state.set_input_value("2", 0, "5")
+        state.set_output_values("1", ["2", "2"])
+        state.set_option("Automatic Light Control", True)
+        self.assertEqual(state.delta_since(4), (4, []))
+        self.assertEqual(state.delta_since(2), (4, [["1", "output-values", ["2", "2"]],
+                                                    ["options", {"Automatic Light Control": True}]]))
+        self.assertEqual(state.delta_since(0)[1][0], ["1", "output-values", ["2", "2"]])
+        self.assertEqual(len(state.delta_since(0)[1]), 3)
+        self.assertIsNone(state.delta_since(5))
+
+    def test_delta_since_needs_snapshot(self):
+        state = StateStore(_data(), history=2)
+        for i in range(3):
+            state.set_input_value("1", 0, str(i))
+        self.assertIsNone(state.delta_since(0))
+        self.assertEqual(state.delta_since(1), (3, [["1", "input-values", ["2"]]]))
+        # Deltas cannot go past nodes being added or removed
+        state.add_node("3", {"output-values": [], "input-values": []})
+        self.assertIsNone(state.delta_since(3))
+        self.assertEqual(state.delta_since(4), (4, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
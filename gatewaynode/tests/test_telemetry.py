@@ -0,0 +1,68 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+
+from history import History
+from telemetry import TelemetryLog, restore_state
+
+
+def _data():
+    return {"nodes": {"1": {"output-values": ["0", "0"], "input-values": ["10"]},
+                      "2": {"output-values": [], "input-values": ["0", "0"]}},
+            "options": {"Automatic Light Control": False}}
+
+
+class RestoreStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.work_dir.name, "telemetry.db")
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def log(self, records, options=()):
+        exit_event = threading.Event()
+        log = TelemetryLog(exit_event, queue.Queue(), self.path, flush_interval=0.1)
+        for record in records:
+            log.record(*record)
+        for name, value in options:
+            log.record_option(name, value)
+        exit_event.set()
+        log.run()
+
+    def test_missing_database(self):
+        data = _data()
+        self.assertEqual(restore_state(self.path, data), 0)
+        self.assertEqual(data, _data())
+
+    def test_latest_values_and_options_are_restored(self):
+        self.log([(100, "1", "output-values", ["20.5", "40"]),
+                  (160, "1", "output-values", ["21.5", "41"]),
+                  (170, "1", "input-values", ["30"]),
+                  # Different number of values, or a node that is gone
+                  (180, "2", "input-values", ["1"]),
+                  (190, "3", "output-values", ["1"])],
+                 [("Automatic Light Control", True), ("Unknown", 1)])
+        data = _data()
+        self.assertEqual(restore_state(self.path, data), 3)
+        self.assertEqual(data["nodes"]["1"], {"output-values": ["21.5", "41"], "input-values": ["30"]})
+        self.assertEqual(data["nodes"]["2"], _data()["nodes"]["2"])
+        self.assertEqual(data["options"], {"Automatic Light Control": True})
+
+    def test_history_since_is_restored(self):
+        # Recent readings, older ones are pruned from the log
+        start = int(time.time()) - 1000
+        self.log([(start + t, "1", "output-values", [str(t), "0"]) for t in range(0, 100, 10)]
+                 + [(start + 50, "1", "input-values", ["5"])])
+        history = History({"raw": 100, "minute": 100, "hour": 100})
+        restore_state(self.path, _data(), history, start + 40)
+        self.assertEqual(history.query("1", 0, start + 40, start + 100, 100),
+                         [(start + t, t) for t in range(40, 100, 10)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import os
+import queue
+import socket
+import tempfile
+import threading
+import unittest
+import zlib
+
+from framing import FrameDecoder
+
+try:
+    from securechannel import SecureChannel
+    from upstream import UpstreamThread
+except ImportError:  # cryptography is not installed
+    UpstreamThread = None
+
+KEY = b"0123456789abcdef"
+
+
+class _Server(threading.Thread):
+    """Server accepting one connection. reply(name, previous replies) returns
+    the sealed reply to a batch.
+    """
+
+    def __init__(self, reply):
+        threading.Thread.__init__(self)
+        self._reply = reply
+        self._socket = socket.socket()
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen(1)
+        self.port = self._socket.getsockname()[1]
+        self.batches = []
+
+    def run(self):
+        conn, _ = self._socket.accept()
+        channel = SecureChannel(KEY)
+        decoder = FrameDecoder()
+        replies = []
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    message = bytes(channel.open(frame))
+                    name, batch = message[len(b"TELEMETRY"):].split(b"\n", 1)
+                    self.batches.append(json.loads(zlib.decompress(batch)))
+                    replies.append(self._reply(name, replies, channel))
+                    conn.sendall(replies[-1])
+        self._socket.close()
+
+
+@unittest.skipIf(UpstreamThread is None, "cryptography is not installed")
+class UpstreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.spool_dir = os.path.join(self.work_dir.name, "spool")
+        os.makedirs(self.spool_dir)
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def upstream(self, port=1, **kwargs):
+        return UpstreamThread(threading.Event(), queue.Queue(), "127.0.0.1", port, [KEY],
+                              self.spool_dir, drain_rate=1000, **kwargs)
+
+    def test_records_are_spooled_in_batches(self):
+        upstream = self.upstream(batch_size=2)
+        for i in range(5):
+            upstream.record(i, "1", "output-values", [str(i)])
+        upstream._spool_records()
+        names = upstream._spooled()
+        self.assertEqual(len(names), 3)
+        with open(os.path.join(self.spool_dir, names[0]), "rb") as f:
+            self.assertEqual(json.loads(zlib.decompress(f.read())),
+                             [[0, "1", "output-values", ["0"]], [1, "1", "output-values", ["1"]]])
+
+    def test_oldest_batches_are_dropped_when_spool_is_full(self):
+        upstream = self.upstream(batch_size=1, max_spool_bytes=0)
+        upstream.record(0, "1", "output-values", ["0"])
+        upstream._spool_records()
+        self.assertEqual(upstream._spooled(), [])
+        upstream = self.upstream(batch_size=1, max_spool_bytes=1000)
+        for i in range(100):
+            upstream.record(i, "1", "output-values", [str(i)])
+        upstream._spool_records()
+        self.assertLessEqual(upstream._spool_size(), 1000)
+        with open(os.path.join(self.spool_dir, upstream._spooled()[-1]), "rb") as f:
+            self.assertEqual(json.loads(zlib.decompress(f.read()))[0][0], 99)
+
+    def push(self, reply, batches=3):
+        server = _Server(reply)
+        server.start()
+        upstream = self.upstream(server.port, batch_size=1)
+        for i in range(batches):
+            upstream.record(i, "1", "output-values", [str(i)])
+        upstream._spool_records()
+        upstream._push()
+        server.join(10)
+        return upstream, server
+
+    def test_acknowledged_batches_are_deleted(self):
+        upstream, server = self.push(lambda name, replies, channel: channel.seal_frame(b"OK" + name))
+        self.assertEqual([b[0][0] for b in server.batches], [0, 1, 2])
+        self.assertEqual(upstream._spooled(), [])
+
+    def test_reply_for_another_batch_is_refused(self):
+        upstream, server = self.push(lambda name, replies, channel: channel.seal_frame(b"OK"))
+        self.assertEqual(len(server.batches), 1)
+        self.assertEqual(len(upstream._spooled()), 3)
+
+    def test_replayed_reply_is_refused(self):
+        def reply(name, replies, channel):
+            return replies[0] if replies else channel.seal_frame(b"OK" + name)
+        upstream, server = self.push(reply)
+        self.assertEqual(len(server.batches), 2)
+        self.assertEqual(len(upstream._spooled()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import zlib
+
+from framing import FrameDecoder
+from metrics import METRICS
+from securechannel import SecureChannel
+
+_SENT = METRICS.counter("upstream_batches_sent_total", "Telemetry batches accepted by the server")
+_DROPPED = METRICS.counter(
+    "upstream_batches_dropped_total", "Spooled telemetry batches deleted because the spool was full")
+_SEND_TIME = METRICS.histogram(
+    "upstream_send_seconds", "Time sending one telemetry batch to the server and getting its reply")
+
+
+class UpstreamThread(threading.Thread):
+    """Thread that pushes the readings to the server every interval seconds.
+    Readings are collected in batches of at most batch_size records, each
+    stored as a zlib compressed JSON list of [time, node id, field, values]
+    in the spool directory until the server has accepted it. The spool keeps
+    at most max_spool_bytes, the oldest batches are deleted first.
+
+    On each push the gateway connects to the server, sends the oldest batches
+    as length prefixed frames sealed with the server key, each being
+    "TELEMETRY", the batch name, a newline and the compressed batch, and waits
+    for the sealed reply "OK" followed by the batch name before deleting it. At most drain_rate batches are sent per
+    second, so a long spool does not flood the server when it comes back.
+    """
+
+    REPLY_TIMEOUT = 10
+    # Nonces of the server replies kept, a reply seen before is refused
+    REPLAY_WINDOW = 1024
+
+    def __init__(self, exit_event, thread_output, host, port, server_key, spool_dir,
+                 interval=60, batch_size=500, max_spool_bytes=10 << 20, drain_rate=5):
+        threading.Thread.__init__(self)
+        self._exit_event = exit_event
+        self._thread_output = thread_output
+        self._address = (host, port)
+        self._server_key = server_key
+        self._spool_dir = spool_dir
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_spool_bytes = max_spool_bytes
+        self._drain_rate = drain_rate
+        self._records = queue.Queue()
+        self._sequence = 0
+        self._channel = None
+        METRICS.gauge("upstream_spool_bytes", self._spool_size, "Size of the telemetry spool")
+
+    def record(self, t, node_id, field, values):
+        """Queues the new values of a field of a node"""
+        self._records.put([round(t, 3), node_id, field, values])
+
+    def run(self):
+        try:
+            os.makedirs(self._spool_dir, exist_ok=True)
+        except OSError as e:
+            self._thread_output.put("Error creating upstream spool : " + e.__class__.__name__)
+            return
+        self._thread_output.put("Upstream to {}:{} started, {} batches spooled".format(
+            self._address[0], self._address[1], len(self._spooled())))
+        next_push = time.time() + self._interval
+        while not self._exit_event.wait(min(1, max(0, next_push - time.time()))):
+            if time.time() < next_push:
+                continue
+            self._spool_records()
+            self._push()
+            next_push = time.time() + self._interval
+        # Pending readings are kept for the next start
+        self._spool_records()
+        self._thread_output.put("Exiting...")
+
+    def _spool_records(self):
+        """Writes the queued readings to the spool, in batches"""
+        while True:
+            batch = []
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._records.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._sequence += 1
+            name = "{:020d}-{:06d}.batch".format(time.time_ns(), self._sequence % 1000000)
+            path = os.path.join(self._spool_dir, name)
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(zlib.compress(json.dumps(batch, separators=(',', ':')).encode('utf-8')))
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                self._thread_output.put("Error writing upstream spool : " + e.__class__.__name__)
+                return
+            self._trim_spool()
+
+    def _spooled(self):
+        """Names of the spooled batches, oldest first"""
+        try:
+            return sorted(f for f in os.listdir(self._spool_dir) if f.endswith(".batch"))
+        except OSError:
+            return []
+
+    def _spool_size(self):
+        size = 0
+        for name in self._spooled():
+            try:
+                size += os.path.getsize(os.path.join(self._spool_dir, name))
+            except OSError:
+                pass
+        return size
+
+    def _trim_spool(self):
+        names = self._spooled()
+        sizes = []
+        for name in names:
+            try:
+                sizes.append(os.path.getsize(os.path.join(self._spool_dir, name)))
+            except OSError:
+                sizes.append(0)
+        total = sum(sizes)
+        for name, size in zip(names, sizes):
+            if total <= self._max_spool_bytes:
+                break
+            try:
+                os.remove(os.path.join(self._spool_dir, name))
+            except OSError:
+                pass
+            total -= size
+            _DROPPED.inc()
+            self._thread_output.put("Upstream spool full, dropped " + name)
+
+    def _server_channel(self):
+        if self._channel is None or self._channel.key != self._server_key[0]:
+            self._channel = SecureChannel(self._server_key[0], self.REPLAY_WINDOW)
+        return self._channel
+
+    def _push(self):
+        """Sends the spooled batches, oldest first, until the spool is empty,
+        the server fails or the gateway exits
+        """
+        names = self._spooled()
+        if not names:
+            return
+        try:
+            conn = socket.create_connection(self._address, timeout=self.REPLY_TIMEOUT)
+        except OSError as e:
+            self._thread_output.put("Server unreachable ({}), {} batches spooled".format(
+                e.__class__.__name__, len(names)))
+            return
+        channel = self._server_channel()
+        decoder = FrameDecoder()
+        sent = 0
+        try:
+            for name in names:
+                if self._exit_event.is_set():
+                    break
+                start = time.time()
+                path = os.path.join(self._spool_dir, name)
+                with open(path, "rb") as f:
+                    batch = f.read()
+                # The reply names the batch, so it cannot acknowledge another one
+                tag = name.encode('utf-8')
+                conn.sendall(channel.seal_frame(b"TELEMETRY" + tag + b"\n" + batch))
+                if self._reply(conn, decoder, channel) != b"OK" + tag:
+                    self._thread_output.put("Server refused telemetry batch " + name)
+                    break
+                os.remove(path)
+                _SEND_TIME.observe(time.time() - start)
+                _SENT.inc()
+                sent += 1
+                # Rate limit of the drain
+                time.sleep(max(0, start + 1 / self._drain_rate - time.time()))
+        except Exception as e:
+            self._thread_output.put("Error pushing telemetry : " + e.__class__.__name__)
+        finally:
+            conn.close()
+        self._thread_output.put("Pushed {} telemetry batches, {} spooled".format(
+            sent, len(names) - sent))
+
+    def _reply(self, conn, decoder, channel):
+        frames = []
+        while not frames:
+            data = conn.recv(4096)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            frames = decoder.feed(data)
+        return bytes(channel.open(frames[0]))
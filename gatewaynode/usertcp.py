@@ -1,119 +1,326 @@
+import asyncio
 import json
-import os
+import queue
 import threading
-import socket
 import time
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+import codec
+import securechannel
+from framing import FrameDecoder
+from metrics import METRICS
+from outqueue import DROP_OLDEST, CollapsingBuffer, update_key
+from securechannel import SecureChannel
 
-class UserThreadRX(threading.Thread):
-    """Thread used to handle data from the user.
-    Only created when a user is connected.
-    """
+_ENCRYPT_TIME = METRICS.histogram(
+    "user_encrypt_seconds", "Time encoding and sealing a batch of updates for a user")
+_SEND_TIME = METRICS.histogram(
+    "user_send_seconds", "Time writing a batch of updates to a user until the socket buffer accepts it")
+_FRAMES = METRICS.counter("user_frames_total", "Frames sent to users")
+_DECRYPT_FAILURES = METRICS.counter(
+    "user_decrypt_failures_total", "Messages from users that could not be decrypted")
 
-    def __init__(self, conn, disconnect, thread_output, key, data_from_user):
-        threading.Thread.__init__(self)
-        self._conn = conn
-        self._disconnect = disconnect
-        self._aesgcm = AESGCM(key)
-        self._data_from_user = data_from_user
-        self._thread_output = thread_output
 
-    def run(self):
-        while True:
-            data = self._conn.recv(1024)
-            if not data:
-                break
-            try:
-                message = self._aesgcm.decrypt(
-                    data[:12], data[12:], None).decode()
-                self._data_from_user.put([time.time(), message])
-                self._thread_output.put("<< Valid message received")
-            except:
-                self._thread_output.put("<< Invalid message")
-                break
-        self._disconnect.set()
+def _is_version(update):
+    return isinstance(update, list) and len(update) == 2 and update[0] == "version"
+
+
+def _is_filters(filters):
+    """True if filters are a dict with optional lists of node ids and fields"""
+    if not isinstance(filters, dict):
+        return False
+    for name in ("nodes", "fields"):
+        values = filters.get(name)
+        if values is not None and not (
+                isinstance(values, list) and all(isinstance(v, str) for v in values)):
+            return False
+    return True
+
+
+class UserSession:
+    """State of one connected user"""
+
+    def __init__(self, session_id, channel, filters, high_water, slow_policy):
+        self.id = session_id
+        self.key = channel.key
+        self.channel = channel
+        self.outbound = CollapsingBuffer(high_water, slow_policy)
+        self.set_filters(filters)
+        # "binary" sessions get frames with a type byte (see codec), with
+        # the gateway data compressed if they also asked for "compress"
+        self.binary = filters.get("encoding") == "binary"
+        self.compress = self.binary and bool(filters.get("compress"))
+        self.node_index = {}
+        self.writer = None
+
+    def set_filters(self, filters):
+        """Only updates for the given nodes and fields are sent. A missing or
+        empty list means all of them.
+        """
+        self.nodes = set(filters.get("nodes") or [])
+        self.fields = set(filters.get("fields") or [])
+
+    def wants(self, update):
+        # Node updates are [id, field, values], anything else is always sent
+        if not isinstance(update, list) or len(update) != 3:
+            return True
+        if self.nodes and update[0] not in self.nodes:
+            return False
+        if self.fields and update[1] not in self.fields:
+            return False
+        return True
 
 
 class UserThread(threading.Thread):
-    """Thread used to connect to the user, send data and start the RX thread."""
+    """Thread running an asyncio server for all the user sessions.
+    A user gets a key through the server's KEY exchange, connects and sends a
+    hello message sealed with it: ["hello", {"nodes": [...], "fields": [...]}].
+    The hello can also have "encoding": "binary" and "compress": true, JSON is
+    used otherwise. The gateway then sends the gateway data (structure) and
+    the updates that match the filters. Each batch of updates ends with
+    ["version", n], the state version they bring the user to, which can be
+    given to "sync" after a reconnect. Items in data_to_user are (session id, update), with a
+    session id of None for updates sent to every session.
+    """
 
-    def __init__(self, exit_event, thread_output, port, user_key,
-                 user_connected, gateway_data, gateway_data_lock,
-                 data_to_user, data_from_user
+    HELLO_TIMEOUT = 10
+    # Nonces remembered per session to refuse replayed messages
+    REPLAY_WINDOW = 1024
+
+    def __init__(self, exit_event, thread_output, port, session_keys,
+                 user_connected, state, data_to_user, data_from_user,
+                 high_water=100, slow_policy="drop-oldest"
                  ):
         threading.Thread.__init__(self)
         self._port = port
         self._exit_event = exit_event
         self._thread_output = thread_output
-        self._user_key = user_key
+        self._session_keys = session_keys
         self._user_connected = user_connected
-        self._gateway_data = gateway_data
-        self._gateway_data_lock = gateway_data_lock
+        self._state = state
         self._data_to_user = data_to_user
         self._data_from_user = data_from_user
+        # Maximum updates pending per session and what to do when a session
+        # is too slow to keep up (see CollapsingBuffer)
+        self._high_water = high_water
+        self._slow_policy = slow_policy
 
-        self._disconnect = threading.Event()
+        self._sessions = {}  # session id -> UserSession
+        self._next_session_id = 1
 
     def run(self):
         self._thread_output.put("Starting...")
+        asyncio.run(self._serve())
+
+    async def _serve(self):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.bind(('', self._port))
-            s.listen(1)
-            s.settimeout(1)
+            server = await asyncio.start_server(self._handle_connection, '', self._port)
         except Exception as e:
             self._thread_output.put("Error binding socket.")
             self._thread_output.put(e.__class__.__name__)
             return
+        fan_out = asyncio.create_task(self._fan_out())
+        while not self._exit_event.is_set():
+            await asyncio.sleep(0.5)
+        server.close()
+        fan_out.cancel()
+        # Sessions are ended first, wait_closed waits for their connections
+        for session in list(self._sessions.values()):
+            session.outbound.close()
+            session.writer.close()
+        try:
+            await asyncio.wait_for(server.wait_closed(), 5)
+        except asyncio.TimeoutError:
+            self._thread_output.put("Timed out closing the user connections")
+        self._thread_output.put("Exiting...")
 
+    async def _fan_out(self):
+        """Moves updates from data_to_user to the queues of the sessions"""
+        loop = asyncio.get_running_loop()
         while True:
-            if(self._exit_event.is_set()):
-                break
             try:
-                conn, addr = s.accept()
-            except:
+                session_id, update = await loop.run_in_executor(
+                    None, self._data_to_user.get, True, 0.5)
+            except queue.Empty:
                 continue
-            self._thread_output.put("Got a connection from %s" % str(addr))
-            self._user_connected.set()
+            # Encoded once and shared by all the sessions it goes to
+            encoded = (update if isinstance(update, str) else
+                       json.dumps(update, separators=(',', ':'))).encode('utf-8')
+            key = update_key(update)
+            for session in list(self._sessions.values()):
+                if session_id is None and session.wants(update) or session_id == session.id:
+                    dropped = session.outbound.dropped
+                    session.outbound.put(key, (update, encoded), session_id is not None)
+                    if dropped == 0 and session.outbound.dropped:
+                        self._thread_output.put(
+                            "Session {} is too slow, dropping updates".format(session.id))
 
-            if(self._user_key[0] == None):
-                self._thread_output.put("No key was generated. Disconnecting")
-                conn.close()
-                self._user_connected.clear()
-                continue
+    async def _handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        self._thread_output.put("Got a connection from %s" % str(addr))
+        decoder = FrameDecoder()
+        session = None
+        key = None
+        try:
+            # The hello message tells which issued key the user has
+            frames = []
+            while not frames:
+                data = await asyncio.wait_for(reader.read(4096), self.HELLO_TIMEOUT)
+                if not data:
+                    return
+                frames = decoder.feed(data)
+            hello = {}
 
-            aesgcm = AESGCM(self._user_key[0])
+            def check(key):
+                # Only a well formed hello claims the key
+                try:
+                    channel = SecureChannel(key, self.REPLAY_WINDOW)
+                    message = json.loads(channel.open(frames[0]).decode())
+                except:
+                    return False
+                if not (isinstance(message, list) and 1 <= len(message) <= 2 and message[0] == "hello"
+                        and (len(message) == 1 or _is_filters(message[1]))):
+                    return False
+                hello["filters"] = message[1] if len(message) > 1 else {}
+                hello["channel"] = channel
+                return True
+            key = self._session_keys.claim(check)
+            if key is None:
+                self._thread_output.put("No valid key. Disconnecting")
+                return
 
-            nonce = os.urandom(12)
-            self._gateway_data_lock.acquire()
-            gateway_data_str = json.dumps(
-                self._gateway_data, separators=(',', ':')).encode('utf-8')
-            self._gateway_data_lock.release()
-            ct = aesgcm.encrypt(nonce, gateway_data_str, None)
-            conn.sendall(nonce+ct)
-            self._thread_output.put("Sent gateway data (structure)")
+            session = UserSession(self._next_session_id, hello["channel"], hello["filters"],
+                                  self._high_water, self._slow_policy)
+            session.writer = writer
+            self._next_session_id += 1
+            self._sessions[session.id] = session
+            self._user_connected.set()
+            self._thread_output.put(
+                "User session {} started ({} connected)".format(session.id, len(self._sessions)))
 
-            user_thread_rx = UserThreadRX(
-                conn, self._disconnect, self._thread_output, self._user_key[0], self._data_from_user)
-            user_thread_rx.start()
-            while True:
-                if(self._data_to_user.qsize() != 0):
-                    data = self._data_to_user.get()
-                    self._thread_output.put(">> Sending " + data)
-                    nonce = os.urandom(12)
-                    # data = data + ";"
-                    data = data.encode('utf-8')
-                    ct = aesgcm.encrypt(nonce, data, None)
-                    conn.sendall(nonce+ct)
-                if(self._disconnect.is_set()):
-                    break
-                if(self._exit_event.is_set()):
-                    break
-                time.sleep(0.1)
+            writer.write(session.channel.seal_frames(self._snapshot(session)))
+            await writer.drain()
+            self._thread_output.put("Sent gateway data (structure)")
 
+            sender = asyncio.create_task(self._send(session, writer))
+            try:
+                await self._receive(session, reader, decoder, frames[1:])
+            finally:
+                sender.cancel()
+        except (asyncio.TimeoutError, OSError, ValueError):
+            self._thread_output.put("Connection error")
+        except Exception as e:
+            self._thread_output.put("Session error : " + e.__class__.__name__)
+        finally:
+            if key is not None:
+                # A claimed key is released whatever happened after the claim
+                self._session_keys.release(key)
+                securechannel.forget(key)
+            if session is not None:
+                del self._sessions[session.id]
+                if not self._sessions:
+                    self._user_connected.clear()
+                self._thread_output.put("User session {} ended ({} updates collapsed, {} dropped)".format(
+                    session.id, session.outbound.collapsed, session.outbound.dropped))
             self._thread_output.put("Closing connection")
-            conn.close()
-            user_thread_rx.join()
-            self._user_connected.clear()
-            self._disconnect.clear()
+            writer.close()
+
+    async def _receive(self, session, reader, decoder, frames):
+        while True:
+            for frame in frames:
+                try:
+                    message = session.channel.open(frame).decode()
+                except:
+                    _DECRYPT_FAILURES.inc()
+                    self._thread_output.put("<< Invalid message")
+                    return
+                self._thread_output.put("<< Valid message received")
+                try:
+                    parsed = json.loads(message)
+                except ValueError:
+                    parsed = None
+                if isinstance(parsed, list) and parsed and parsed[0] == "subscribe":
+                    if len(parsed) == 2 and _is_filters(parsed[1]):
+                        session.set_filters(parsed[1])
+                    else:
+                        self._thread_output.put("Invalid subscribe ignored")
+                else:
+                    self._data_from_user.put(
+                        [time.time(), message, session.id])
+            data = await reader.read(4096)
+            if not data:
+                return
+            frames = decoder.feed(data)
+
+    async def _send(self, session, writer):
+        """Sends everything pending for the session in one write. The session
+        is closed if that fails, so it does not stay connected without updates.
+        """
+        try:
+            await self._send_pending(session, writer)
+        except Exception as e:
+            self._thread_output.put("Error sending to session {} : {}. Closing".format(
+                session.id, e.__class__.__name__))
+            writer.close()
+
+    async def _send_pending(self, session, writer):
+        while True:
+            pending = await session.outbound.get_all()
+            if pending is None:
+                writer.close()
+                return
+            start = time.perf_counter()
+            # Only the newest version is sent, after the updates it covers. A
+            # session that lost updates gets none, it has to sync instead
+            versions = [item for item in pending if _is_version(item[0])]
+            if versions:
+                pending = [item for item in pending if not _is_version(item[0])]
+                if not (session.outbound.dropped and self._slow_policy == DROP_OLDEST):
+                    pending.append(max(versions, key=lambda item: item[0][1]))
+            payloads = []
+            if session.outbound.needs_resync:
+                # Updates were dropped, send the current data instead
+                session.outbound.needs_resync = False
+                payloads.extend(self._snapshot(session))
+                self._thread_output.put(
+                    "Resync of session {} from a snapshot".format(session.id))
+            if session.binary:
+                # Consecutive node updates share one frame, anything else is
+                # sent as JSON
+                updates = []
+                for update, encoded in pending:
+                    if codec.can_pack(update, session.node_index):
+                        updates.append(update)
+                        continue
+                    if updates:
+                        payloads.append(codec.pack_updates(updates, session.node_index))
+                        updates = []
+                    if isinstance(update, str):
+                        # Full data, e.g. after nodes were added, comes with
+                        # a new intern table
+                        payloads.extend(self._snapshot(session))
+                    else:
+                        payloads.append(codec.json_frame(encoded))
+                if updates:
+                    payloads.append(codec.pack_updates(updates, session.node_index))
+            else:
+                payloads.extend(encoded for update, encoded in pending)
+            data = session.channel.seal_frames(payloads)
+            _ENCRYPT_TIME.observe(time.perf_counter() - start)
+            _FRAMES.inc(len(payloads))
+            self._thread_output.put(">> Sending {} updates in {} frames to session {}".format(
+                len(pending), len(payloads), session.id))
+            with _SEND_TIME.time():
+                writer.write(data)
+                await writer.drain()
+
+    def _snapshot(self, session):
+        """Payloads with the current gateway data for a session. Binary
+        sessions also get the intern table for the node ids in it.
+        """
+        gateway_data_str = self._state.encoded()[1]
+        if not session.binary:
+            return [gateway_data_str.encode('utf-8')]
+        table = codec.intern_table(self._state.snapshot()[1])
+        session.node_index = {node_id: i for i, node_id in enumerate(table["nodes"])}
+        return [codec.json_frame(gateway_data_str.encode('utf-8'), session.compress),
+                codec.json_frame(json.dumps(["intern", table], separators=(',', ':')).encode('utf-8'))]